@@ -0,0 +1,38 @@
+import argparse
+import os, sys
+if os.getcwd() + '/utils/model/' not in sys.path:
+    sys.path.insert(1, os.getcwd() + '/utils/model/')
+
+from utils.benchmark.common import add_common_args
+from utils.benchmark import sens_acs, roi_crop, alloc, compiled, precision, channels_last, distill, early_exit, tiling, separable, sampling
+
+BENCHMARKS = {
+    'sens_acs': sens_acs,
+    'roi_crop': roi_crop,
+    'alloc': alloc,
+    'compile': compiled,
+    'precision': precision,
+    'channels_last': channels_last,
+    'distill': distill,
+    'early_exit': early_exit,
+    'tiling': tiling,
+    'separable': separable,
+    'sampling': sampling,
+}
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Benchmark FIVarNet on FastMRI challenge shapes',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    for name, module in BENCHMARKS.items():
+        subparser = subparsers.add_parser(name, help=module.__doc__.strip().splitlines()[0],
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        add_common_args(subparser)
+        module.add_args(subparser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse()
+    BENCHMARKS[args.benchmark].run(args)
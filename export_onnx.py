@@ -0,0 +1,88 @@
+import argparse
+from pathlib import Path
+import os, sys
+import torch
+if os.getcwd() + '/utils/model/' not in sys.path:
+    sys.path.insert(1, os.getcwd() + '/utils/model/')
+
+from utils.data.load_data import create_data_loaders, KSPACE_SHAPES
+from utils.model.feature_varnet import FIVarNet_n_att
+from utils.model.compile_cache import dummy_inputs
+from utils.model.onnx_export import export_onnx, onnx_path
+from utils.learning.onnx_backend import OnnxModel
+
+
+def parse_shape(value):
+    return tuple(int(v) for v in value.split('x'))
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Export FIVarNet checkpoints to ONNX',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--checkpoints', type=Path, nargs='+',
+                        default=[Path('../result') / name for name in ('model24_acc45.pt', 'model25_acc45.pt', 'model23_acc89.pt', 'model25_acc89.pt')],
+                        help='Checkpoints to export')
+    parser.add_argument('--onnx_dir', type=Path, default='../result/onnx', help='Output directory of the ONNX files')
+    parser.add_argument('--shapes', type=parse_shape, nargs='+', default=KSPACE_SHAPES, help='k-space geometries as CxHxW, one file each')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset, the DFT op needs 17 or later')
+
+    parser.add_argument('--cascade', type=int, default=3, help='Number of cascades | Should be less than 12')
+    parser.add_argument('--chans', type=int, default=24, help='Number of channels for cascade U-Net')
+    parser.add_argument('--sens_chans', type=int, default=4, help='Number of channels for sensitivity map U-Net')
+    parser.add_argument('--unet_chans', type=int, default=19, help ='Number of channels for cascade U-Net')
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Run the cascade regularisers on the returned 384x384 region only')
+    parser.add_argument('--separable', default=False, action='store_true', help='Depthwise-separable conv blocks in the cascade U-Nets')
+
+    parser.add_argument('--parity_data', type=Path, default=None, help='Directory with kspace/ to compare ONNX Runtime against PyTorch slice by slice')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='Max abs difference relative to the slice maximum, ORT\'s DFT kernel alone is ~3e-4 off on non power-of-2 sizes')
+    parser.add_argument('--ort_threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 lets ORT decide')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size')
+    parser.add_argument("--input_key", type=str, default='kspace', help='Name of input key')
+    return parser.parse_args()
+
+
+def check_parity(args, model, onnx_model):
+    """Per-slice max abs difference between PyTorch and ONNX Runtime, relative to the slice maximum."""
+    data_loader = create_data_loaders(data_path=args.parity_data, args=args, isforward=True)
+    worst = 0.
+    with torch.no_grad():
+        for mask, kspace, _, _, fnames, slices in data_loader:
+            expected = model(kspace, mask)
+            output = onnx_model(kspace, mask)
+            for i in range(expected.shape[0]):
+                error = ((output[i] - expected[i]).abs().max() / expected[i].abs().max()).item()
+                worst = max(worst, error)
+                flag = '' if error <= args.tolerance else ' FAIL'
+                print(f'  {fnames[i]} slice {int(slices[i]):3d} rel. max error = {error:.3e}{flag}')
+    return worst
+
+
+if __name__ == '__main__':
+    args = parse()
+    failed = False
+
+    for checkpoint_path in args.checkpoints:
+        model = FIVarNet_n_att(num_cascades=args.cascade,
+                       chans=args.chans,
+                       sens_chans=args.sens_chans,
+                       unet_chans=args.unet_chans,
+                       roi_crop=args.roi_crop,
+                       separable=args.separable)
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+        model.eval()
+
+        for shape in args.shapes:
+            path = onnx_path(args.onnx_dir, checkpoint_path.stem, shape)
+            kspace, mask = dummy_inputs(shape, 'cpu')
+            export_onnx(model, kspace, mask, path, opset=args.opset)
+            print(f'Exported {path}')
+
+        if args.parity_data is not None:
+            onnx_model = OnnxModel(args.onnx_dir, checkpoint_path.stem, args.ort_threads)
+            worst = check_parity(args, model, onnx_model)
+            print(f'{checkpoint_path.stem}: worst rel. max error = {worst:.3e} (tolerance {args.tolerance:.1e})')
+            failed = failed or worst > args.tolerance
+
+    if failed:
+        sys.exit(1)
@@ -5,45 +5,21 @@ import random
 import glob
 import os
 import torch
-from utils.common.loss_function import SSIMLoss
-import torch.nn.functional as F
+from utils.common.ssim import image_ssim
 import cv2 
 from pathlib import Path
 import time
 
-class SSIM(SSIMLoss):
-    def __init__(self, win_size: int = 7, k1: float = 0.01, k2: float = 0.03):
-        super().__init__(win_size, k1, k2)
-            
-    def forward(self, X, Y, data_range):
-        if len(X.shape) != 2:
-            raise NotImplementedError('Dimension of first input is {} rather than 2'.format(len(X.shape)))
-        if len(Y.shape) != 2:
-            raise NotImplementedError('Dimension of first input is {} rather than 2'.format(len(Y.shape)))
-            
-        X = X.unsqueeze(0).unsqueeze(0)
-        Y = Y.unsqueeze(0).unsqueeze(0)
-        #data_range = data_range[:, None, None, None]
-        C1 = (self.k1 * data_range) ** 2
-        C2 = (self.k2 * data_range) ** 2
-        ux = F.conv2d(X, self.w)
-        uy = F.conv2d(Y, self.w)
-        uxx = F.conv2d(X * X, self.w)
-        uyy = F.conv2d(Y * Y, self.w)
-        uxy = F.conv2d(X * Y, self.w)
-        vx = self.cov_norm * (uxx - ux * ux)
-        vy = self.cov_norm * (uyy - uy * uy)
-        vxy = self.cov_norm * (uxy - ux * uy)
-        A1, A2, B1, B2 = (
-            2 * ux * uy + C1,
-            2 * vxy + C2,
-            ux ** 2 + uy ** 2 + C1,
-            vx + vy + C2,
-        )
-        D = B1 * B2
-        S = (A1 * A2) / D
-        return S.mean()
-    
+def foreground_mask(target):
+    """Binary mask of the anatomy the leaderboard SSIM is evaluated on."""
+    mask = np.zeros(target.shape)
+    mask[target>5e-5] = 1
+    kernel = np.ones((3, 3), np.uint8)
+    mask = cv2.erode(mask, kernel, iterations=1)
+    mask = cv2.dilate(mask, kernel, iterations=15)
+    mask = cv2.erode(mask, kernel, iterations=14)
+    return mask
+
 
 def forward(args):
 
@@ -60,35 +36,25 @@ def forward(args):
     
     ssim_total = 0
     idx = 0
-    ssim_calculator = SSIM().to(device=device)
     with torch.no_grad():
         for i_subject in range(58):
             l_fname = os.path.join(args.leaderboard_data_path, 'brain_test' + str(i_subject+1) + '.h5')
             y_fname = os.path.join(args.your_data_path, 'brain_test' + str(i_subject+1) + '.h5')
+            # 볼륨 단위로 읽어서 모든 slice의 SSIM을 한 번에 계산
             with h5py.File(l_fname, "r") as hf:
-                num_slices = hf['image_label'].shape[0]
-            for i_slice in range(num_slices):
-                with h5py.File(l_fname, "r") as hf:
-                    target = hf['image_label'][i_slice]
-                    mask = np.zeros(target.shape)
-                    mask[target>5e-5] = 1
-                    kernel = np.ones((3, 3), np.uint8)
-                    mask = cv2.erode(mask, kernel, iterations=1)
-                    mask = cv2.dilate(mask, kernel, iterations=15)
-                    mask = cv2.erode(mask, kernel, iterations=14)
-                    
-                    target = torch.from_numpy(target).to(device=device)
-                    mask = (torch.from_numpy(mask).to(device=device)).type(torch.float)
+                target = hf['image_label'][:]
+                maximum = hf.attrs['max']
+            mask = np.stack([foreground_mask(target_slice) for target_slice in target])
+
+            with h5py.File(y_fname, "r") as hf:
+                recon = hf[args.output_key][:]
+
+            target = torch.from_numpy(target).to(device=device, dtype=torch.float64)
+            mask = torch.from_numpy(mask).to(device=device, dtype=torch.float64)
+            recon = torch.from_numpy(recon).to(device=device, dtype=torch.float64)
 
-                    maximum = hf.attrs['max']
-                    
-                with h5py.File(y_fname, "r") as hf:
-                    recon = hf[args.output_key][i_slice]
-                    recon = torch.from_numpy(recon).to(device=device)
-                    
-                #ssim_total += ssim_calculator(recon, target, maximum).cpu().numpy()
-                ssim_total += ssim_calculator(recon*mask, target*mask, maximum).cpu().numpy()
-                idx += 1
+            ssim_total += image_ssim(recon*mask, target*mask, maximum).sum().item()
+            idx += target.shape[0]
             
     return ssim_total/idx
 
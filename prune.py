@@ -0,0 +1,159 @@
+import argparse
+from pathlib import Path
+import os, sys
+import torch
+if os.getcwd() + '/utils/model/' not in sys.path:
+    sys.path.insert(1, os.getcwd() + '/utils/model/')
+
+from utils.common.utils import seed_fix
+from utils.common.loss_function import SSIMLoss
+from utils.data.load_data import create_data_loaders
+from utils.model.feature_varnet import FIVarNet_n_att
+from utils.model.prune import prune_model
+from utils.learning.train_part import train_epoch, validate
+from utils.mraugment.data_augment import DataAugmentor
+from train import add_augmentation_specific_args
+from utils.benchmark.common import parse_shape, synthetic_batch, time_fn
+
+
+def parse_widths(value):
+    """'12:3' -> (unet_chans 12, sens_chans 3)"""
+    unet_chans, sens_chans = value.split(':')
+    return int(unet_chans), int(sens_chans)
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Structured channel pruning of the FIVarNet U-Nets with fine-tuning',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--checkpoint', type=Path, default=Path('../result') / 'model25_acc45.pt', help='Checkpoint to prune')
+    parser.add_argument('--widths', type=parse_widths, nargs='+', default=[(16, 4), (14, 3), (12, 3), (10, 2)],
+                        help='Reduced unet_chans:sens_chans configs to prune to')
+    parser.add_argument('-o', '--out-dir', type=Path, default='../result/pruned', help='Directory of the pruned checkpoints')
+    parser.add_argument('-g', '--GPU-NUM', type=int, default=0, help='GPU number to allocate')
+    parser.add_argument('-t', '--data-path-train', type=Path, default='/home/Data/train', help='Directory of train data used for fine-tuning')
+    parser.add_argument('-v', '--data-path-val', type=Path, default='/home/Data/val', help='Directory of validation data')
+
+    parser.add_argument('-e', '--num-epochs', type=int, default=1, help='Fine-tuning epochs after pruning')
+    parser.add_argument('-l', '--lr', type=float, default=1e-4, help='Fine-tuning learning rate')
+    parser.add_argument('-a', '--acc-steps', type=int, default=4, help='Steps of Gradient Accumulation')
+    parser.add_argument('-m', '--max-norm', type=float, default=1.0, help='max_norm of gradient clipping')
+    parser.add_argument('-r', '--report-interval', type=int, default=50, help='Report interval')
+    parser.add_argument('--shapes', type=parse_shape, nargs='+', default=[(16, 768, 396)], help='k-space geometries the latency is measured on, as CxHxW')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per latency measurement')
+
+    parser.add_argument('--cascade', type=int, default=3, help='Number of cascades | Should be less than 12')
+    parser.add_argument('--chans', type=int, default=24, help='Number of channels for feature-domain')
+    parser.add_argument('--sens_chans', type=int, default=4, help='Number of channels for sensitivity map U-Net of the checkpoint')
+    parser.add_argument('--unet_chans', type=int, default=19, help ='Number of channels for cascade U-Net of the checkpoint')
+    parser.add_argument('--sens_acs_crop', default=False, action='store_true', help='Run the sensitivity map U-Net on the cropped ACS region only')
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Run the cascade regularisers on the returned 384x384 region only')
+
+    parser.add_argument('--acc', type=int, default=[4, 5], nargs='+', help='Accelerations of the fine-tuning and validation masks')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size')
+    parser.add_argument('--input-key', type=str, default='kspace', help='Name of input key')
+    parser.add_argument('--target-key', type=str, default='image_label', help='Name of target key')
+    parser.add_argument('--max-key', type=str, default='max', help='Name of max key in attributes')
+    parser.add_argument('--seed', type=int, default=430, help='Fix random seed')
+    # fine-tuning augments like training, the schedule runs over --num-epochs
+    add_augmentation_specific_args(parser)
+    return parser.parse_args()
+
+
+def build_model(args, unet_chans, sens_chans):
+    return FIVarNet_n_att(num_cascades=args.cascade,
+                   chans=args.chans,
+                   sens_chans=sens_chans,
+                   unet_chans=unet_chans,
+                   sens_acs_crop=args.sens_acs_crop,
+                   roi_crop=args.roi_crop).to(device=args.device)
+
+
+def validation_ssim(args, model):
+    # same masks for every config
+    seed_fix(args.seed)
+    val_loader = create_data_loaders(data_path=args.data_path_val, args=args)
+    metric_loss, num_subjects, *_ = validate(args, model, val_loader)
+    return 1 - metric_loss / num_subjects
+
+
+def latency(args, model):
+    model.eval()
+    with torch.no_grad():
+        times = []
+        for shape in args.shapes:
+            kspace, mask = synthetic_batch(shape, args.acc[0], args, args.device)
+            times.append(time_fn(lambda: model(kspace, mask), 1, args.repeat))
+    return sum(times) / len(times)
+
+
+def fine_tune(args, model):
+    loss_type = SSIMLoss().to(device=args.device)
+    optimizer = torch.optim.RAdam(model.parameters(), lr=args.lr, betas=(0.9, 0.999), eps=1e-08)
+    current_epoch = 0
+    augmentor = DataAugmentor(args, lambda: current_epoch, seed=args.seed)
+    train_loader = create_data_loaders(data_path=args.data_path_train, args=args, DataAugmentor=augmentor, shuffle=True)
+    for epoch in range(args.num_epochs):
+        current_epoch = epoch
+        train_loss, train_time, _ = train_epoch(args, args.acc_steps, epoch, model, train_loader, optimizer, None, None, loss_type)
+        print(f'  fine-tune epoch {epoch}: TrainLoss = {train_loss:.4g} TrainTime = {train_time:.1f}s')
+
+
+def pareto_front(results):
+    """Configs no other config beats on both latency and SSIM."""
+    return [
+        r for r in results
+        if not any(o['latency'] <= r['latency'] and o['ssim'] >= r['ssim'] and o is not r
+                   and (o['latency'] < r['latency'] or o['ssim'] > r['ssim']) for o in results)
+    ]
+
+
+if __name__ == '__main__':
+    args = parse()
+    args.device = torch.device(f'cuda:{args.GPU_NUM}' if torch.cuda.is_available() else 'cpu')
+    # train_epoch options that pruning does not use
+    args.deep_supervision = 0.0
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+
+    model = build_model(args, args.unet_chans, args.sens_chans)
+    model.load_state_dict(torch.load(args.checkpoint, map_location='cpu')['model'])
+
+    results = [{
+        'widths': (args.unet_chans, args.sens_chans),
+        'params': sum(p.numel() for p in model.parameters()),
+        'latency': latency(args, model),
+        'ssim': validation_ssim(args, model),
+        'path': args.checkpoint,
+    }]
+
+    for unet_chans, sens_chans in args.widths:
+        print(f'unet_chans {args.unet_chans} -> {unet_chans}, sens_chans {args.sens_chans} -> {sens_chans}')
+        seed_fix(args.seed)
+        pruned = build_model(args, unet_chans, sens_chans)
+        pruned.load_state_dict(prune_model(model, unet_chans, sens_chans, args.unet_chans, args.sens_chans))
+        ssim_pruned = validation_ssim(args, pruned)
+        if args.num_epochs > 0:
+            fine_tune(args, pruned)
+        ssim = validation_ssim(args, pruned)
+        print(f'  validation SSIM {ssim_pruned:.4f} after pruning, {ssim:.4f} after fine-tuning')
+
+        # the stored args carry the reduced config for load_teacher and friends
+        pruned_args = argparse.Namespace(**{k: v for k, v in vars(args).items() if k != 'device'})
+        pruned_args.unet_chans, pruned_args.sens_chans = unet_chans, sens_chans
+        path = args.out_dir / f'{args.checkpoint.stem}_u{unet_chans}_s{sens_chans}.pt'
+        torch.save({'model': pruned.state_dict(), 'args': pruned_args, 'pruned_from': str(args.checkpoint), 'val_ssim': ssim}, path)
+
+        results.append({
+            'widths': (unet_chans, sens_chans),
+            'params': sum(p.numel() for p in pruned.parameters()),
+            'latency': latency(args, pruned),
+            'ssim': ssim,
+            'path': path,
+        })
+
+    front = pareto_front(results)
+    print(f'{"unet:sens":>10} {"params":>10} {"latency":>9} {"SSIM":>7}  pareto  checkpoint')
+    for r in sorted(results, key=lambda r: r['latency']):
+        print(
+            f'{"%d:%d" % r["widths"]:>10} {r["params"]:>10d} {r["latency"]:>8.4f}s {r["ssim"]:>7.4f}  '
+            f'{"*" if any(r is f for f in front) else " ":^6}  {r["path"]}'
+        )
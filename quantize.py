@@ -0,0 +1,113 @@
+import argparse
+import re
+from pathlib import Path
+import os, sys
+import numpy as np
+import torch
+if os.getcwd() + '/utils/model/' not in sys.path:
+    sys.path.insert(1, os.getcwd() + '/utils/model/')
+
+from utils.common.utils import seed_fix
+from utils.data.load_data import create_data_loaders
+from utils.model.feature_varnet import FIVarNet_n_att
+from utils.model.quantize import prepare_int8, convert_int8, calibrate, save_int8, int8_path
+from leaderboard_eval import foreground_mask
+from utils.common.ssim import image_ssim
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Static INT8 quantisation of the FIVarNet regularisers',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--checkpoints', type=Path, nargs='+',
+                        default=[Path('../result') / name for name in ('model24_acc45.pt', 'model25_acc45.pt', 'model23_acc89.pt', 'model25_acc89.pt')],
+                        help='Checkpoints to quantise, written next to them as *_int8.pt')
+    parser.add_argument('-t', '--data-path-train', type=Path, default='/home/Data/train', help='Directory of train data used for calibration')
+    parser.add_argument('-v', '--data-path-val', type=Path, default='/home/Data/val', help='Directory of validation data used for the SSIM gate')
+    parser.add_argument('--calib-slices', type=int, default=64, help='Number of training slices used for calibration')
+    parser.add_argument('--gate-slices', type=int, default=None, help='Number of validation slices in the SSIM gate, all if not given')
+    parser.add_argument('--max-ssim-drop', type=float, default=0.002, help='Largest allowed drop of the masked leaderboard SSIM')
+
+    parser.add_argument('--cascade', type=int, default=3, help='Number of cascades | Should be less than 12')
+    parser.add_argument('--chans', type=int, default=24, help='Number of channels for cascade U-Net')
+    parser.add_argument('--sens_chans', type=int, default=4, help='Number of channels for sensitivity map U-Net')
+    parser.add_argument('--unet_chans', type=int, default=19, help ='Number of channels for cascade U-Net')
+    parser.add_argument('--sens_acs_crop', default=False, action='store_true', help='Run the sensitivity map U-Net on the cropped ACS region only')
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Run the cascade regularisers on the returned 384x384 region only')
+    parser.add_argument('--separable', default=False, action='store_true', help='Depthwise-separable conv blocks in the cascade U-Nets')
+
+    parser.add_argument('--acc', type=int, default=None, nargs='+', help='Accelerations of the masks, taken from the checkpoint name (acc45 -> 4 5) if not given')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size')
+    parser.add_argument('--input-key', type=str, default='kspace', help='Name of input key')
+    parser.add_argument('--target-key', type=str, default='image_label', help='Name of target key')
+    parser.add_argument('--max-key', type=str, default='max', help='Name of max key in attributes')
+    parser.add_argument('--mask_type', choices=('random', 'equispaced'), default='equispaced', type=str, help='Type of k-space mask')
+    parser.add_argument('--center_fractions', nargs='+', default=[0.08], type=float, help='Number of center lines to use in mask')
+    parser.add_argument('--seed', type=int, default=430, help='Fix random seed')
+    return parser.parse_args()
+
+
+def checkpoint_acc(path):
+    """model25_acc45.pt -> [4, 5]"""
+    match = re.search(r'acc(\d)(\d)', path.stem)
+    if match is None:
+        raise ValueError(f'Cannot infer the accelerations of {path.name}, pass --acc')
+    return [int(match.group(1)), int(match.group(2))]
+
+
+def ssim_gate(args, model, qmodel):
+    """Mean masked leaderboard SSIM of the fp32 and the INT8 model on the same validation slices."""
+    data_loader = create_data_loaders(data_path=args.data_path_val, args=args)
+    ssim_fp32, ssim_int8 = [], []
+    with torch.no_grad():
+        for mask, kspace, target, maximum, _, _ in data_loader:
+            if args.gate_slices is not None and len(ssim_fp32) >= args.gate_slices:
+                break
+            output = model(kspace, mask)
+            qoutput = qmodel(kspace, mask)
+            roi = torch.from_numpy(np.stack([foreground_mask(t) for t in target.numpy()])).double()
+            target = target.double() * roi
+            ssim_fp32 += image_ssim(output.double() * roi, target, maximum).tolist()
+            ssim_int8 += image_ssim(qoutput.double() * roi, target, maximum).tolist()
+    return float(np.mean(ssim_fp32)), float(np.mean(ssim_int8))
+
+
+if __name__ == '__main__':
+    args = parse()
+    failed = False
+
+    for checkpoint_path in args.checkpoints:
+        if args.seed is not None:
+            seed_fix(args.seed)
+        model_args = argparse.Namespace(**vars(args))
+        model_args.acc = args.acc if args.acc is not None else checkpoint_acc(checkpoint_path)
+
+        model = FIVarNet_n_att(num_cascades=args.cascade,
+                       chans=args.chans,
+                       sens_chans=args.sens_chans,
+                       unet_chans=args.unet_chans,
+                       sens_acs_crop=args.sens_acs_crop,
+                       roi_crop=args.roi_crop,
+                       separable=args.separable)
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+        model.eval()
+
+        qmodel = prepare_int8(model)
+        calib_loader = create_data_loaders(data_path=args.data_path_train, args=model_args, shuffle=True)
+        num_slices = calibrate(qmodel, calib_loader, args.calib_slices)
+        convert_int8(qmodel)
+        print(f'{checkpoint_path.stem}: calibrated on {num_slices} training slices')
+
+        ssim_fp32, ssim_int8 = ssim_gate(model_args, model, qmodel)
+        drop = ssim_fp32 - ssim_int8
+        status = 'OK' if drop <= args.max_ssim_drop else 'FAIL'
+        print(f'{checkpoint_path.stem}: masked SSIM fp32 = {ssim_fp32:.4f}, int8 = {ssim_int8:.4f}, drop = {drop:.4f} [{status}]')
+
+        if drop <= args.max_ssim_drop:
+            save_int8(qmodel, int8_path(checkpoint_path))
+            print(f'Saved {int8_path(checkpoint_path)}')
+        else:
+            failed = True
+
+    if failed:
+        sys.exit(1)
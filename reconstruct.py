@@ -20,6 +20,32 @@ def parse():
     parser.add_argument('--chans', type=int, default=24, help='Number of channels for cascade U-Net')
     parser.add_argument('--sens_chans', type=int, default=4, help='Number of channels for sensitivity map U-Net')
     parser.add_argument('--unet_chans', type=int, default=19, help ='Number of channels for cascade U-Net')
+    parser.add_argument('--router_config', type=Path, default=None, help='JSON mapping acceleration ranges to weighted checkpoints (see router.json), overrides --soup / --student')
+    parser.add_argument('--soup', default=False, action='store_true', help='Run model_soup_acc45.pt / model_soup_acc89.pt from soup.py instead of the two checkpoint pairs')
+    parser.add_argument('--student', type=Path, default=None, help='Distilled checkpoint to run instead of the four-model ensemble')
+    parser.add_argument('--sens_acs_crop', default=False, action='store_true', help='Run the sensitivity map U-Net on the cropped ACS region only')
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Run the cascade regularisers on the returned 384x384 region only')
+    parser.add_argument('--separable', default=False, action='store_true', help='Depthwise-separable conv blocks in the cascade U-Nets')
+    parser.add_argument('--fast_inference', default=False, action='store_true', help='Reuse per-shape buffers and update tensors in place during inference')
+    parser.add_argument('--channels_last', default=False, action='store_true', help='Keep the regulariser conv activations in channels_last (NHWC)')
+    parser.add_argument('--early_exit', type=float, default=None, help='Stop once a cascade changes k-space by less than this relative norm (models trained with --deep-supervision)')
+    parser.add_argument('--tile_size', type=int, default=None, help='Run the U-Net regularisers on overlapping tiles of at most this edge, data consistency stays global')
+    parser.add_argument('--tile_memory', type=float, default=None, help='Size the regulariser tiles to keep their activations under this many MB')
+    parser.add_argument('--tile_overlap', type=int, default=32, help='Overlap of neighbouring tiles in pixels, blended linearly')
+    parser.add_argument('--tile_norm_passes', type=int, default=None, help='Passes over the tiles that measure whole-image instance norm statistics, one per norm if not given; fewer are faster and less exact')
+    parser.add_argument('--bf16', default=False, action='store_true', help='Run the U-Net regularisers under bfloat16 autocast, FFTs and data consistency stay fp32')
+    parser.add_argument('--compile', default=False, action='store_true', help='torch.compile the models once per k-space geometry, eager on failure')
+    parser.add_argument('--compile_cache_dir', type=Path, default='../result/compile_cache', help='Directory of the on-disk compiled kernel cache')
+    parser.add_argument('--quantized', default=False, action='store_true', help='Run the INT8 models written by quantize.py (*_int8.pt, CPU only)')
+    parser.add_argument('--backend', choices=('torch', 'onnx'), default='torch', help='Run the ensemble in PyTorch eager or ONNX Runtime (CPU)')
+    parser.add_argument('--onnx_dir', type=Path, default='../result/onnx', help='Directory of the models exported by export_onnx.py')
+    parser.add_argument('--ort_threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 lets ORT decide')
+    parser.add_argument('--profile', default=False, action='store_true', help='Profile the first slices of every split with torch.profiler, see --profile_*')
+    parser.add_argument('--profile_wait', type=int, default=1, help='Slices skipped before profiling')
+    parser.add_argument('--profile_warmup', type=int, default=1, help='Slices traced but discarded before the recorded window')
+    parser.add_argument('--profile_active', type=int, default=3, help='Slices recorded')
+    parser.add_argument('--profile_top', type=int, default=25, help='Rows of the operator table')
+    parser.add_argument('--profile_dir', type=Path, default='../result/profile', help='Directory of the Chrome traces and operator tables')
     parser.add_argument("--input_key", type=str, default='kspace', help='Name of input key')
 
     args = parser.parse_args()
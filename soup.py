@@ -0,0 +1,77 @@
+import argparse
+from pathlib import Path
+import os, sys
+import torch
+if os.getcwd() + '/utils/model/' not in sys.path:
+    sys.path.insert(1, os.getcwd() + '/utils/model/')
+
+from utils.common.utils import seed_fix
+from utils.data.load_data import create_data_loaders
+from utils.model.feature_varnet import FIVarNet_n_att
+from utils.learning.train_part import validate
+from utils.learning.soup import average_state_dicts, greedy_soup
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='Average FIVarNet checkpoints of one run into a single model (model soup)',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--checkpoints', type=Path, nargs='+',
+                        default=[Path('../result') / 'model24_acc45.pt', Path('../result') / 'model25_acc45.pt'],
+                        help='Checkpoints of the same run to average')
+    parser.add_argument('-o', '--out', type=Path, default='../result/model_soup_acc45.pt', help='Output checkpoint')
+    parser.add_argument('--greedy', default=False, action='store_true', help='Add checkpoints best-first and keep them only if validation SSIM does not drop')
+    parser.add_argument('-g', '--GPU-NUM', type=int, default=0, help='GPU number to allocate')
+    parser.add_argument('-v', '--data-path-val', type=Path, default='/home/Data/val', help='Directory of validation data')
+
+    parser.add_argument('--cascade', type=int, default=3, help='Number of cascades | Should be less than 12')
+    parser.add_argument('--chans', type=int, default=24, help='Number of channels for feature-domain')
+    parser.add_argument('--sens_chans', type=int, default=4, help='Number of channels for sensitivity map U-Net')
+    parser.add_argument('--unet_chans', type=int, default=19, help ='Number of channels for cascade U-Net')
+    parser.add_argument('--sens_acs_crop', default=False, action='store_true', help='Run the sensitivity map U-Net on the cropped ACS region only')
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Run the cascade regularisers on the returned 384x384 region only')
+    parser.add_argument('--separable', default=False, action='store_true', help='Depthwise-separable conv blocks in the cascade U-Nets')
+
+    parser.add_argument('--acc', type=int, default=[4, 5], nargs='+', help='Accelerations of the validation masks')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size')
+    parser.add_argument('--input-key', type=str, default='kspace', help='Name of input key')
+    parser.add_argument('--target-key', type=str, default='image_label', help='Name of target key')
+    parser.add_argument('--max-key', type=str, default='max', help='Name of max key in attributes')
+    parser.add_argument('--mask_type', choices=('random', 'equispaced'), default='equispaced', type=str, help='Type of k-space mask')
+    parser.add_argument('--center_fractions', nargs='+', default=[0.08], type=float, help='Number of center lines to use in mask')
+    parser.add_argument('--seed', type=int, default=430, help='Seed of the validation masks, fixed so every soup sees the same ones')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse()
+    args.device = torch.device(f'cuda:{args.GPU_NUM}' if torch.cuda.is_available() else 'cpu')
+
+    model = FIVarNet_n_att(num_cascades=args.cascade,
+                   chans=args.chans,
+                   sens_chans=args.sens_chans,
+                   unet_chans=args.unet_chans,
+                   sens_acs_crop=args.sens_acs_crop,
+                   roi_crop=args.roi_crop,
+                   separable=args.separable)
+    model.to(device=args.device)
+
+    def evaluate(state_dict):
+        # validation picks a random acceleration per slice, reseed so every soup sees the same masks
+        seed_fix(args.seed)
+        model.load_state_dict(state_dict)
+        val_loader = create_data_loaders(data_path=args.data_path_val, args=args)
+        metric_loss, num_subjects, *_ = validate(args, model, val_loader)
+        return 1 - metric_loss / num_subjects
+
+    candidates = [(path.name, torch.load(path, map_location='cpu')['model']) for path in args.checkpoints]
+    if args.greedy:
+        print('Validation SSIM:')
+        names, state_dict, ssim = greedy_soup(candidates, evaluate)
+    else:
+        names = [name for name, _ in candidates]
+        state_dict = average_state_dicts([state_dict for _, state_dict in candidates])
+        ssim = evaluate(state_dict)
+
+    torch.save({'model': state_dict, 'ingredients': names, 'val_ssim': ssim}, args.out)
+    print(f'Soup of {", ".join(names)}: validation SSIM = {ssim:.4f}')
+    print(f'Saved {args.out}')
@@ -7,6 +7,8 @@ from pathlib import Path
 if os.getcwd() + '/utils/model/' not in sys.path:
     sys.path.insert(1, os.getcwd() + '/utils/model/')
 from utils.learning.train_part import train
+from utils.learning.ensemble import ENSEMBLE_CHECKPOINTS
+from utils.learning.distributed import init_distributed
 
 if os.getcwd() + '/utils/common/' not in sys.path:
     sys.path.insert(1, os.getcwd() + '/utils/common/')
@@ -18,6 +20,8 @@ def parse():
     parser.add_argument('-g', '--GPU-NUM', type=int, default=0, help='GPU number to allocate')
     parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size')
     parser.add_argument('-a', '--acc-steps', type=int, default=4, help='Steps of Gradient Accumulation')
+    parser.add_argument('--auto-batch', default=False, action='store_true', help='Probe the peak memory of every k-space shape at startup and pick per-shape micro-batch and accumulation steps for --memory-budget, keeping the effective batch -b x -a')
+    parser.add_argument('--memory-budget', type=float, default=None, help='Memory budget of --auto-batch in MB, 90%% of the GPU if not given')
     parser.add_argument('-e', '--num-epochs', type=int, default=50, help='Number of epochs')
     parser.add_argument('-l', '--lr', type=float, default=1e-3, help='Learning rate')
     parser.add_argument('-p', '--lr-scheduler-patience', type=int, default=5, help='patience of ReduceLROnPlateau')
@@ -32,15 +36,48 @@ def parse():
     parser.add_argument('--chans', type=int, default=24, help='Number of channels for feature-domain | 18 in original varnet') ## important hyperparameter
     parser.add_argument('--sens_chans', type=int, default=4, help='Number of channels for sensitivity map U-Net | 8 in original varnet') ## important hyperparameter
     parser.add_argument('--unet_chans', type=int, default=19, help ='Number of channels for cascade U-Net') ## important hyperparameter
+    parser.add_argument('--sens_acs_crop', default=False, action='store_true', help='Run the sensitivity map U-Net on the cropped ACS region only')
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Run the cascade regularisers on the returned 384x384 region only')
+    parser.add_argument('--separable', default=False, action='store_true', help='Depthwise-separable conv blocks in the cascade U-Nets')
     parser.add_argument('--input-key', type=str, default='kspace', help='Name of input key')
     parser.add_argument('--target-key', type=str, default='image_label', help='Name of target key')
     parser.add_argument('--max-key', type=str, default='max', help='Name of max key in attributes')
     parser.add_argument('--seed', type=int, default=430, help='Fix random seed')
+    parser.add_argument('--fast-val-fraction', type=float, default=None, help='Validate every epoch on this stratified fraction of the validation volumes (LR schedule), the full set only as below (best model)')
+    parser.add_argument('--full-val-every', type=int, default=5, help='Epochs between full validation passes with --fast-val-fraction, also run whenever the subset loss improves')
+    parser.add_argument('--loss-sampling', default=False, action='store_true', help='Draw training slices in proportion to their running loss, with importance weights keeping the gradient unbiased')
+    parser.add_argument('--sampling-floor', type=float, default=0.2, help='Share of --loss-sampling probability spread uniformly, no slice is drawn less than floor / N')
+    parser.add_argument('--uniform-every', type=int, default=5, help='Every N-th epoch of --loss-sampling is a uniform pass refreshing every slice loss')
+    parser.add_argument('--resume', default=False, action='store_true', help='Continue from the resume checkpoint in the checkpoint directory, mid-epoch if it was written mid-epoch')
+    parser.add_argument('--checkpoint-every', type=int, default=100, help='Optimizer steps between mid-epoch resume checkpoints, 0 writes one per epoch only')
+    parser.add_argument('--telemetry', default=False, action='store_true', help='Log the per-step time breakdown (data wait, forward, backward, optimizer, augmentation, peak memory) to telemetry_acc<tag>.jsonl')
+    parser.add_argument('--profile', default=False, action='store_true', help='Profile the first training steps with torch.profiler and exit, see --profile-*')
+    parser.add_argument('--profile-wait', type=int, default=1, help='Steps skipped before profiling')
+    parser.add_argument('--profile-warmup', type=int, default=1, help='Steps traced but discarded before the recorded window')
+    parser.add_argument('--profile-active', type=int, default=3, help='Steps recorded')
+    parser.add_argument('--profile-top', type=int, default=25, help='Rows of the operator table')
+    parser.add_argument('--profile-dir', type=Path, default='../result/profile', help='Directory of the Chrome traces and operator tables')
+    parser.add_argument('--no-save-val-reconstructions', dest='save_val_reconstructions', default=True, action='store_false', help='Do not write the validation reconstructions and targets of every new best epoch to the reconstructions directory')
+    parser.add_argument('--keep-last', type=int, default=None, help='Keep only the last N epoch checkpoints plus the best model, all of them if not given')
+    parser.add_argument('--dist-backend', type=str, default='gloo', help='torch.distributed backend when launched with torchrun, the effective batch is world size x batch size x acc-steps')
+    parser.add_argument('--channels_last', default=False, action='store_true', help='Keep the regulariser conv activations in channels_last (NHWC)')
+    parser.add_argument('--bf16', default=False, action='store_true', help='Run the U-Net regularisers under bfloat16 autocast, FFTs and data consistency stay fp32')
+    parser.add_argument('--compile', default=False, action='store_true', help='torch.compile the model once per k-space geometry, eager on failure')
+    parser.add_argument('--compile-cache-dir', type=Path, default='../result/compile_cache', help='Directory of the on-disk compiled kernel cache')
 
     parser.add_argument('--acc', type=int, default=[4, 5], nargs="+", help='accelerations on which the model will be trained')
+    parser.add_argument('--deep-supervision', type=float, default=0.0, help='Weight of the mean SSIM loss of the outputs after every cascade, needed for --early_exit at inference')
+    parser.add_argument('--distill', default=False, action='store_true', help='Train a single student on the averaged outputs of the --teachers ensemble')
+    parser.add_argument('--teachers', type=Path, nargs=4,
+                        default=[Path('../result') / name for name in ENSEMBLE_CHECKPOINTS],
+                        help='Ensemble checkpoints (acc45, acc45, acc89, acc89), built with their stored args or the student config')
+    parser.add_argument('--distill-alpha', type=float, default=1.0, help='Weight of the teacher target in the loss, the ground truth gets 1 - alpha')
 
     add_augmentation_specific_args(parser)
     args = parser.parse_args()
+    if args.loss_sampling and args.auto_batch:
+        # rejected here, before the auto-batch memory probe runs
+        parser.error('--loss-sampling does not combine with --auto-batch')
     return args
 
 def add_augmentation_specific_args(parser):
@@ -97,13 +134,16 @@ def add_augmentation_specific_args(parser):
 
 if __name__ == '__main__':
     args = parse()
+    init_distributed(args)
 
     # fix seed
     if args.seed is not None:
         seed_fix(args.seed)
 
-    args.exp_dir = '../result' / args.net_name / f'checkpoints_acc{args.acc[0]}{args.acc[1]}'
-    args.val_dir = '../result' / args.net_name / f'reconstructions_val_acc{args.acc[0]}{args.acc[1]}'
+    # acc 4 5 -> 'acc45', a distilled student on 4 5 8 9 -> 'acc4589'
+    args.acc_tag = ''.join(str(acc) for acc in args.acc)
+    args.exp_dir = '../result' / args.net_name / f'checkpoints_acc{args.acc_tag}'
+    args.val_dir = '../result' / args.net_name / f'reconstructions_val_acc{args.acc_tag}'
     args.main_dir = '../result' / args.net_name / __file__
     args.val_loss_dir = '../result' / args.net_name
 
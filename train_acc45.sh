@@ -2,6 +2,7 @@ python train.py \
   -g 0 \
   -b 1 \
   -a 4 \
+  --auto-batch \
   -e 50 \
   -l 0.001 \
   -p 5 \
@@ -0,0 +1,25 @@
+# -a 1 on 4 ranks keeps the effective batch of train_acc45.sh (-a 4 on one process).
+# 4 processes on one host, OMP_NUM_THREADS x nproc_per_node should match the cores.
+# Several hosts: --nnodes N --node_rank i --rdzv_endpoint host0:29500 instead of --standalone.
+OMP_NUM_THREADS=8 torchrun --standalone --nproc_per_node 4 train.py \
+  -b 1 \
+  -a 1 \
+  -e 50 \
+  -l 0.001 \
+  -p 5 \
+  -f 0.1 \
+  -m 1.0 \
+  -r 50 \
+  -n 'FIVarNet_submit' \
+  -t '/home/Data/train' \
+  -v '/home/Data/val' \
+  --cascade 3 \
+  --chans 24 \
+  --sens_chans 4 \
+  --unet_chans 19 \
+  --input-key 'kspace' \
+  --target-key 'image_label' \
+  --max-key 'max' \
+  --seed 430 \
+  --acc 4 5 \
+  --dist-backend gloo
@@ -0,0 +1,24 @@
+python train.py \
+  -g 0 \
+  -b 1 \
+  -a 4 \
+  -e 50 \
+  -l 0.001 \
+  -p 5 \
+  -f 0.1 \
+  -m 1.0 \
+  -r 50 \
+  -n 'FIVarNet_student' \
+  -t '/home/Data/train' \
+  -v '/home/Data/val' \
+  --cascade 3 \
+  --chans 24 \
+  --sens_chans 4 \
+  --unet_chans 19 \
+  --input-key 'kspace' \
+  --target-key 'image_label' \
+  --max-key 'max' \
+  --seed 430 \
+  --acc 4 5 8 9 \
+  --distill \
+  --teachers ../result/model24_acc45.pt ../result/model25_acc45.pt ../result/model23_acc89.pt ../result/model25_acc89.pt
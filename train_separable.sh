@@ -0,0 +1,23 @@
+python train.py \
+  -g 0 \
+  -b 1 \
+  -a 4 \
+  -e 50 \
+  -l 0.001 \
+  -p 5 \
+  -f 0.1 \
+  -m 1.0 \
+  -r 50 \
+  -n 'FIVarNet_separable' \
+  -t '/home/Data/train' \
+  -v '/home/Data/val' \
+  --cascade 3 \
+  --chans 24 \
+  --sens_chans 4 \
+  --unet_chans 43 \
+  --input-key 'kspace' \
+  --target-key 'image_label' \
+  --max-key 'max' \
+  --seed 430 \
+  --acc 4 5 \
+  --separable
@@ -0,0 +1,39 @@
+"""
+Allocator traffic of eager vs fast_inference forward passes.
+
+Reports the number of allocations, bytes allocated, peak bytes and latency
+per geometry, and the max abs difference between both outputs.
+"""
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, setup
+from utils.common.memory import allocation_stats
+
+
+def add_args(parser):
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Also crop the regularisers to the returned ROI')
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    model = build_model(args, device, roi_crop=args.roi_crop)
+
+    print(f'{"mode":>6} {"shape":>14} {"allocs":>8} {"alloc MB":>10} {"peak MB":>9} {"model":>10}')
+    with torch.no_grad():
+        for shape in args.shapes:
+            kspace, mask = synthetic_batch(shape, args.acc[0], args, device)
+            outputs = {}
+            for mode, fast in (('eager', False), ('fast', True)):
+                model.set_fast_inference(fast)
+                # first call fills the workspaces
+                outputs[mode] = model(kspace, mask)
+                stats = allocation_stats(lambda: model(kspace, mask), device)
+                t_model = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+                print(
+                    f'{mode:>6} {"x".join(map(str, shape)):>14} {stats["num_allocs"]:>8d} '
+                    f'{stats["alloc_bytes"] / 2**20:>10.1f} {stats["peak_bytes"] / 2**20:>9.1f} {t_model:>9.4f}s'
+                )
+            diff = (outputs['eager'] - outputs['fast']).abs().max().item()
+            print(f'{"":>6} {"x".join(map(str, shape)):>14} max |eager - fast| = {diff:.3g}')
+    model.set_fast_inference(False)
@@ -0,0 +1,46 @@
+"""
+NCHW vs channels_last latency of each U-Net regulariser and the whole model.
+
+Every Unet2d / NormUnet is timed in isolation on the inputs it saw in a forward
+pass, first as is and then on a channels_last copy, followed by the full model
+both ways. The max abs difference of the outputs is reported alongside.
+"""
+import copy
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, setup, record_regulariser_io
+from utils.model.feature_varnet import set_channels_last
+
+
+def add_args(parser):
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Also crop the regularisers to the returned ROI')
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    model = build_model(args, device, roi_crop=args.roi_crop)
+
+    with torch.no_grad():
+        for shape in args.shapes:
+            print(f'== {"x".join(map(str, shape))} ==')
+            kspace, mask = synthetic_batch(shape, args.acc[0], args, device)
+            model.set_channels_last(False)
+            records = record_regulariser_io(model, kspace, mask)
+
+            print(f'{"module":<40} {"NCHW":>9} {"NHWC":>9} {"speedup":>8} {"max diff":>10}')
+            for name, (module, inputs, reference) in records.items():
+                t_nchw = time_fn(lambda: module(inputs), args.warmup, args.repeat)
+                module_cl = copy.deepcopy(module)
+                set_channels_last(module_cl)
+                diff = (module_cl(inputs) - reference).abs().max().item()
+                t_nhwc = time_fn(lambda: module_cl(inputs), args.warmup, args.repeat)
+                print(f'{name:<40} {t_nchw:>8.4f}s {t_nhwc:>8.4f}s {t_nchw / t_nhwc:>7.2f}x {diff:>10.2e}')
+
+            reference = model(kspace, mask)
+            t_nchw = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+            model.set_channels_last(True)
+            diff = (model(kspace, mask) - reference).abs().max().item()
+            t_nhwc = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+            model.set_channels_last(False)
+            print(f'{"model":<40} {t_nchw:>8.4f}s {t_nhwc:>8.4f}s {t_nchw / t_nhwc:>7.2f}x {diff:>10.2e}')
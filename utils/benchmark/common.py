@@ -0,0 +1,162 @@
+import time
+from pathlib import Path
+import numpy as np
+import torch
+
+from collections import defaultdict
+from utils.common.utils import ssim_loss
+from utils.data.load_data import create_data_loaders, KSPACE_SHAPES
+from utils.model.feature_varnet import FIVarNet_n_att, Unet2d, NormUnet
+from fastmri.data.subsample import create_mask_for_mask_type
+
+
+def parse_shape(value):
+    """'16x768x396' -> (16, 768, 396)"""
+    return tuple(int(v) for v in value.split('x'))
+
+
+def add_common_args(parser):
+    parser.add_argument('--device', type=str, default='cpu', help='Device to benchmark on')
+    parser.add_argument('--num-threads', type=int, default=None, help='torch.set_num_threads for CPU runs')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed warm-up runs per measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement')
+    parser.add_argument('--shapes', type=parse_shape, nargs='+', default=KSPACE_SHAPES, help='k-space geometries as CxHxW')
+
+    parser.add_argument('--cascade', type=int, default=3, help='Number of cascades | Should be less than 12')
+    parser.add_argument('--chans', type=int, default=24, help='Number of channels for feature-domain')
+    parser.add_argument('--sens_chans', type=int, default=4, help='Number of channels for sensitivity map U-Net')
+    parser.add_argument('--unet_chans', type=int, default=19, help='Number of channels for cascade U-Net')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint to load, random weights if not given')
+
+    parser.add_argument('-v', '--data-path-val', type=Path, default=None, help='Directory of validation data, SSIM is skipped if not given')
+    parser.add_argument('--max-slices', type=int, default=None, help='Number of validation slices used for SSIM')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size')
+    parser.add_argument('--input-key', type=str, default='kspace', help='Name of input key')
+    parser.add_argument('--target-key', type=str, default='image_label', help='Name of target key')
+    parser.add_argument('--max-key', type=str, default='max', help='Name of max key in attributes')
+    parser.add_argument('--acc', type=int, default=[4, 8], nargs='+', help='Accelerations of the synthetic masks')
+    parser.add_argument('--mask_type', choices=('random', 'equispaced'), default='equispaced', type=str, help='Type of k-space mask')
+    parser.add_argument('--center_fractions', nargs='+', default=[0.08], type=float, help='Number of center lines to use in mask')
+    return parser
+
+
+def setup(args):
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    return torch.device(args.device)
+
+
+def build_model(args, device, **kwargs):
+    model = FIVarNet_n_att(num_cascades=args.cascade,
+                   chans=args.chans,
+                   sens_chans=args.sens_chans,
+                   unet_chans=args.unet_chans,
+                   **kwargs)
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+    model.to(device=device)
+    model.eval()
+    return model
+
+
+def synthetic_batch(shape, acc, args, device):
+    """Random masked k-space and mask laid out the way DataTransform + DataLoader return them."""
+    coils, height, width = shape
+    kspace = torch.randn(1, coils, height, width, 2) * 1e-4
+    mask_func = create_mask_for_mask_type(args.mask_type, args.center_fractions, [acc])
+    mask = mask_func((1, height, width, 2), seed=0)[0]
+    mask = mask.reshape(1, 1, 1, width, 1).byte()
+    return (kspace * mask).to(device=device), mask.to(device=device)
+
+
+def time_fn(fn, warmup, repeat):
+    """Median wall time of fn() in seconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def evaluate_ssim(model_fn, args, device):
+    """
+    Runs model_fn(kspace, mask) over the validation set and returns
+    (mean SSIM over volumes, seconds per slice).
+    """
+    data_loader = create_data_loaders(data_path=args.data_path_val, args=args)
+    reconstructions = defaultdict(dict)
+    targets = defaultdict(dict)
+    total_time = 0.
+    num_slices = 0
+
+    with torch.no_grad():
+        for mask, kspace, target, _, fnames, slices in data_loader:
+            if args.max_slices is not None and num_slices >= args.max_slices:
+                break
+            kspace = kspace.to(device=device)
+            mask = mask.to(device=device)
+
+            start = time.perf_counter()
+            output = model_fn(kspace, mask)
+            total_time += time.perf_counter() - start
+            num_slices += output.shape[0]
+
+            for i in range(output.shape[0]):
+                reconstructions[fnames[i]][int(slices[i])] = output[i].cpu().numpy()
+                targets[fnames[i]][int(slices[i])] = target[i].numpy()
+
+    ssim = []
+    for fname in reconstructions:
+        recon = np.stack([out for _, out in sorted(reconstructions[fname].items())])
+        target = np.stack([out for _, out in sorted(targets[fname].items())])
+        ssim.append(1 - ssim_loss(target, recon, device=device))
+    return float(np.mean(ssim)), total_time / max(num_slices, 1)
+
+
+def count_conv_flops(model, fn):
+    """FLOPs (2 x MACs) spent in Conv2d / ConvTranspose2d layers while running fn()."""
+    total = [0]
+
+    def conv_hook(module, inputs, output):
+        kernel_ops = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        total[0] += 2 * output.numel() * kernel_ops
+
+    def transpose_conv_hook(module, inputs, output):
+        kernel_ops = module.kernel_size[0] * module.kernel_size[1] * module.out_channels // module.groups
+        total[0] += 2 * inputs[0].numel() * kernel_ops
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, torch.nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, torch.nn.ConvTranspose2d):
+            handles.append(module.register_forward_hook(transpose_conv_hook))
+    try:
+        fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return total[0]
+
+
+def record_regulariser_io(model, kspace, mask):
+    """Inputs and outputs of every Unet2d / NormUnet during one forward pass, by module name."""
+    records = {}
+    handles = []
+    for name, module in model.named_modules():
+        if isinstance(module, (Unet2d, NormUnet)):
+            def hook(module, inputs, output, name=name):
+                records[name] = (module, inputs[0].clone(), output.clone())
+            handles.append(module.register_forward_hook(hook))
+    try:
+        model(kspace, mask)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return records
@@ -0,0 +1,41 @@
+"""
+Eager vs torch.compile'd FIVarNet_n_att.
+
+Reports, per geometry, the eager latency, the first-call compile (or cache
+load) overhead and the steady-state compiled latency. Run twice with the same
+--compile-cache-dir to see the warm-cache start-up cost.
+"""
+import time
+import torch
+from pathlib import Path
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, setup
+from utils.model.compile_cache import CompiledModelCache
+
+
+def add_args(parser):
+    parser.add_argument('--compile-cache-dir', type=Path, default='../result/compile_cache', help='Directory of the on-disk compiled kernel cache')
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    model = build_model(args, device)
+    compiled = CompiledModelCache(model, args.compile_cache_dir)
+
+    print(f'{"shape":>14} {"eager":>10} {"compile":>10} {"compiled":>10} {"speedup":>8}')
+    with torch.no_grad():
+        for shape in args.shapes:
+            kspace, mask = synthetic_batch(shape, args.acc[0], args, device)
+            t_eager = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+
+            start = time.perf_counter()
+            compiled(kspace, mask)
+            t_compile = time.perf_counter() - start
+
+            t_compiled = time_fn(lambda: compiled(kspace, mask), args.warmup, args.repeat)
+            status = ' (eager fallback)' if tuple(shape) in compiled.failed else ''
+            print(
+                f'{"x".join(map(str, shape)):>14} {t_eager:>9.4f}s {t_compile:>9.2f}s '
+                f'{t_compiled:>9.4f}s {t_eager / t_compiled:>7.2f}x{status}'
+            )
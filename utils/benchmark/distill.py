@@ -0,0 +1,47 @@
+"""
+Latency and SSIM of the four-model ensemble vs a distilled student.
+
+For every geometry and acceleration the ensemble runs the members the router
+picks for it (two or four), the student always runs once. With -v both are
+scored on the validation set one acceleration at a time.
+"""
+import copy
+from pathlib import Path
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, evaluate_ssim, setup
+from utils.learning.ensemble import ensemble_forward, load_teachers, detect_acceleration, ENSEMBLE_CHECKPOINTS
+
+
+def add_args(parser):
+    parser.add_argument('--teachers', type=Path, nargs=4, default=[Path('../result') / name for name in ENSEMBLE_CHECKPOINTS],
+                        help='Ensemble checkpoints (acc45, acc45, acc89, acc89), the student is --checkpoint')
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    teachers = load_teachers(args.teachers, args, device)
+    student = build_model(args, device)
+    ensemble_fn = lambda kspace, mask: ensemble_forward(teachers, kspace, mask)
+
+    print(f'{"shape":>14} {"acc":>4} {"members":>8} {"ensemble":>10} {"student":>9} {"speedup":>8}')
+    with torch.no_grad():
+        for shape in args.shapes:
+            for acc in args.acc:
+                kspace, mask = synthetic_batch(shape, acc, args, device)
+                members = 4 if 8 <= detect_acceleration(mask) < 12 else 2
+                t_ensemble = time_fn(lambda: ensemble_fn(kspace, mask), args.warmup, args.repeat)
+                t_student = time_fn(lambda: student(kspace, mask), args.warmup, args.repeat)
+                print(f'{"x".join(map(str, shape)):>14} {acc:>4} {members:>8} {t_ensemble:>9.4f}s {t_student:>8.4f}s {t_ensemble / t_student:>7.2f}x')
+
+    if args.data_path_val is not None:
+        for acc in args.acc:
+            val_args = copy.copy(args)
+            val_args.acc = [acc]
+            ssim_ensemble, t_ensemble = evaluate_ssim(ensemble_fn, val_args, device)
+            ssim_student, t_student = evaluate_ssim(student, val_args, device)
+            print(
+                f'acc {acc}: SSIM ensemble = {ssim_ensemble:.4f} ({t_ensemble:.4f}s/slice), '
+                f'student = {ssim_student:.4f} ({t_student:.4f}s/slice)'
+            )
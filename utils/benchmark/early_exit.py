@@ -0,0 +1,51 @@
+"""
+Cascades used, latency and SSIM per acceleration under early exit.
+
+Each threshold (and the full depth as reference) is run over the validation
+set one acceleration at a time; without -v the synthetic geometries are used
+and only cascades and latency are reported.
+"""
+import copy
+import numpy as np
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, evaluate_ssim, setup
+
+
+def add_args(parser):
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.005, 0.01, 0.02, 0.05], help='Relative k-space update norms to exit at')
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    model = build_model(args, device)
+    depth = len(model.cascades) + len(model.image_cascades)
+    print(f'Full depth = {depth} cascades')
+
+    for threshold in [None] + args.thresholds:
+        model.set_early_exit(threshold)
+        label = 'full' if threshold is None else f'{threshold:g}'
+        for acc in args.acc:
+            if args.data_path_val is not None:
+                used = []
+
+                def model_fn(kspace, mask):
+                    output = model(kspace, mask)
+                    used.append(model.cascades_used)
+                    return output
+
+                val_args = copy.copy(args)
+                val_args.acc = [acc]
+                ssim, t_slice = evaluate_ssim(model_fn, val_args, device)
+                print(f'threshold {label:>6} acc {acc:>2}: cascades = {np.mean(used):.2f}/{depth}, SSIM = {ssim:.4f}, {t_slice:.4f}s/slice')
+            else:
+                with torch.no_grad():
+                    for shape in args.shapes:
+                        kspace, mask = synthetic_batch(shape, acc, args, device)
+                        t_model = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+                        print(
+                            f'threshold {label:>6} acc {acc:>2} {"x".join(map(str, shape)):>14}: '
+                            f'cascades = {model.cascades_used}/{depth}, {t_model:.4f}s'
+                        )
+    model.set_early_exit(None)
@@ -0,0 +1,62 @@
+"""
+Per-module output drift of the U-Net regularisers under autocast.
+
+Every Unet2d / NormUnet is re-run in isolation on the inputs it saw in an fp32
+forward pass, once in fp32 and once under autocast, and the relative max and
+L2 errors of its output are reported with both latencies. The whole model is
+then compared end to end, and on validation SSIM if -v is given.
+"""
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, evaluate_ssim, setup, record_regulariser_io
+
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def add_args(parser):
+    parser.add_argument('--amp-dtype', choices=tuple(AMP_DTYPES), default='bf16', help='Autocast dtype under test')
+    parser.add_argument('--roi_crop', default=False, action='store_true', help='Also crop the regularisers to the returned ROI')
+    return parser
+
+
+def drift(output, reference):
+    """(max abs error, L2 error), both relative to the fp32 reference."""
+    error = (output.float() - reference).flatten()
+    reference = reference.flatten()
+    return (error.abs().max() / reference.abs().max()).item(), (error.norm() / reference.norm()).item()
+
+
+def run(args):
+    device = setup(args)
+    dtype = AMP_DTYPES[args.amp_dtype]
+    model = build_model(args, device, roi_crop=args.roi_crop)
+
+    with torch.no_grad():
+        for shape in args.shapes:
+            print(f'== {"x".join(map(str, shape))} ==')
+            kspace, mask = synthetic_batch(shape, args.acc[0], args, device)
+            model.set_amp_dtype(None)
+            records = record_regulariser_io(model, kspace, mask)
+
+            print(f'{"module":<40} {"max err":>10} {"L2 err":>10} {"fp32":>9} {args.amp_dtype:>9}')
+            for name, (module, inputs, reference) in records.items():
+                t_fp32 = time_fn(lambda: module(inputs), args.warmup, args.repeat)
+                module.amp_dtype = dtype
+                max_err, l2_err = drift(module(inputs), reference)
+                t_amp = time_fn(lambda: module(inputs), args.warmup, args.repeat)
+                module.amp_dtype = None
+                print(f'{name:<40} {max_err:>10.2e} {l2_err:>10.2e} {t_fp32:>8.4f}s {t_amp:>8.4f}s')
+
+            reference = model(kspace, mask)
+            t_fp32 = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+            model.set_amp_dtype(dtype)
+            max_err, l2_err = drift(model(kspace, mask), reference)
+            t_amp = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+            print(f'{"model (all regularisers)":<40} {max_err:>10.2e} {l2_err:>10.2e} {t_fp32:>8.4f}s {t_amp:>8.4f}s')
+
+    if args.data_path_val is not None:
+        for label, amp_dtype in (('fp32', None), (args.amp_dtype, dtype)):
+            model.set_amp_dtype(amp_dtype)
+            ssim, t_slice = evaluate_ssim(lambda kspace, mask: model(kspace, mask), args, device)
+            print(f'{label:>5}: SSIM = {ssim:.4f}, {t_slice:.4f}s/slice')
+    model.set_amp_dtype(None)
@@ -0,0 +1,36 @@
+"""
+Full-image vs ROI-cropped cascade regularisers.
+
+With roi_crop the feature and image cascade U-Nets only process the 384x384
+region that FIVarNet_n_att returns. Reports conv FLOPs and latency of both
+paths per geometry and, given validation data, the SSIM of each.
+"""
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, evaluate_ssim, count_conv_flops, setup
+
+
+def add_args(parser):
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    model = build_model(args, device)
+
+    print(f'{"mode":>6} {"shape":>14} {"GFLOPs":>10} {"model":>10}')
+    results = {}
+    for mode, roi_crop in (('full', False), ('roi', True)):
+        model.roi_crop = roi_crop
+        with torch.no_grad():
+            for shape in args.shapes:
+                kspace, mask = synthetic_batch(shape, args.acc[0], args, device)
+                flops = count_conv_flops(model, lambda: model(kspace, mask))
+                t_model = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+                print(f'{mode:>6} {"x".join(map(str, shape)):>14} {flops / 1e9:>10.1f} {t_model:>9.4f}s')
+
+        if args.data_path_val is not None:
+            results[mode] = evaluate_ssim(model, args, device)
+
+    for mode, (ssim, sec_per_slice) in results.items():
+        print(f'{mode:>6} SSIM = {ssim:.4f} Time = {sec_per_slice:.4f}s/slice')
@@ -0,0 +1,82 @@
+"""
+Time to a target validation SSIM with loss-aware vs uniform slice sampling.
+
+The same initial model (--checkpoint or random weights) is trained on -t once
+per sampling scheme for up to --epochs, without augmentation, and scored on
+the -v validation set after every epoch. Reported is the training time and
+the number of epochs until the mean SSIM reaches --target-ssim, validation
+time not counted.
+"""
+import copy
+from pathlib import Path
+import torch
+
+from utils.benchmark.common import build_model, evaluate_ssim, setup
+from utils.common.loss_function import SSIMLoss
+from utils.data.load_data import create_data_loaders
+from utils.learning.train_part import train_epoch
+from utils.mraugment.data_augment import DataAugmentor
+
+
+def add_args(parser):
+    parser.add_argument('-t', '--data-path-train', type=Path, default='/home/Data/train', help='Directory of train data')
+    parser.add_argument('--epochs', type=int, default=10, help='Maximum training epochs per scheme')
+    parser.add_argument('--target-ssim', type=float, default=0.9, help='Validation SSIM to reach')
+    parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate')
+    parser.add_argument('-a', '--acc-steps', type=int, default=4, help='Steps of Gradient Accumulation')
+    parser.add_argument('--sampling-floor', type=float, default=0.2, help='Share of the loss-aware probability spread uniformly')
+    parser.add_argument('--uniform-every', type=int, default=5, help='Every N-th loss-aware epoch is a uniform pass')
+    parser.add_argument('--seed', type=int, default=430, help='Seed of the data order and masks')
+    return parser
+
+
+def train_to_target(args, device, initial, loss_sampling):
+    """(epochs, training seconds) until the target SSIM, None if not reached, and the SSIM after every epoch."""
+    run_args = copy.copy(args)
+    run_args.__dict__.update(
+        device=device, distributed=False, world_size=1, rank=0, loss_sampling=loss_sampling,
+        num_epochs=args.epochs, report_interval=10 ** 9, deep_supervision=0., roi_crop=False, max_norm=1.0,
+        aug_on=False, max_train_resolution=None,
+    )
+    torch.manual_seed(args.seed)
+    model = build_model(args, device)
+    model.load_state_dict(initial)
+    augmentor = DataAugmentor(run_args, lambda: 0)
+    train_loader = create_data_loaders(data_path=args.data_path_train, args=run_args, DataAugmentor=augmentor, shuffle=True)
+    optimizer = torch.optim.RAdam(model.parameters(), lr=args.lr, betas=(0.9, 0.999), eps=1e-08)
+    loss_type = SSIMLoss().to(device=device)
+
+    train_time, history = 0., []
+    for epoch in range(args.epochs):
+        train_loader.sampler.set_epoch(epoch)
+        _, epoch_time, _ = train_epoch(run_args, args.acc_steps, epoch, model, train_loader, optimizer, None, None, loss_type)
+        train_time += epoch_time
+        if loss_sampling:
+            train_loader.sampler.update([train_loader.sampler.collect()])
+        model.eval()
+        ssim, _ = evaluate_ssim(model, args, device)
+        history.append(ssim)
+        if ssim >= args.target_ssim:
+            return (epoch + 1, train_time), history
+    return None, history
+
+
+def run(args):
+    if args.data_path_val is None:
+        raise ValueError('The sampling benchmark needs -v for the validation SSIM')
+    device = setup(args)
+    initial = copy.deepcopy(build_model(args, device).state_dict())
+
+    results = {}
+    for name, loss_sampling in (('uniform', False), ('loss-aware', True)):
+        results[name] = train_to_target(args, device, initial, loss_sampling)
+        print(f'{name}: SSIM per epoch ' + ' '.join(f'{ssim:.4f}' for ssim in results[name][1]))
+
+    print(f'{"sampling":>12} {"epochs":>7} {"train time":>11} {"final SSIM":>11}')
+    for name, (reached, history) in results.items():
+        epochs, train_time = reached if reached is not None else ('-', None)
+        time_text = f'{train_time:.1f}s' if train_time is not None else 'not reached'
+        print(f'{name:>12} {epochs:>7} {time_text:>11} {history[-1]:>11.4f}')
+    uniform, loss_aware = results['uniform'][0], results['loss-aware'][0]
+    if uniform is not None and loss_aware is not None:
+        print(f'loss-aware sampling reaches SSIM {args.target_ssim} {uniform[1] / loss_aware[1]:.2f}x faster')
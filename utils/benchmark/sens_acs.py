@@ -0,0 +1,38 @@
+"""
+Full-resolution vs ACS-cropped sensitivity estimation.
+
+The sensitivity U-Net only ever sees the masked low-frequency centre, so the
+full-size input is band-limited. This compares the sens_net / whole-model
+latency of both paths and, given validation data, the SSIM of each.
+"""
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, evaluate_ssim, setup
+
+
+def add_args(parser):
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    model = build_model(args, device)
+
+    print(f'{"mode":>6} {"shape":>14} {"acc":>4} {"sens_net":>10} {"model":>10}')
+    results = {}
+    for mode, acs_crop in (('full', False), ('acs', True)):
+        model.sens_net.acs_crop = acs_crop
+        with torch.no_grad():
+            for shape in args.shapes:
+                for acc in args.acc:
+                    kspace, mask = synthetic_batch(shape, acc, args, device)
+                    scaled_kspace = kspace * model.kspace_mult_factor
+                    t_sens = time_fn(lambda: model.sens_net(scaled_kspace, mask), args.warmup, args.repeat)
+                    t_model = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+                    print(f'{mode:>6} {"x".join(map(str, shape)):>14} {acc:>4} {t_sens:>9.4f}s {t_model:>9.4f}s')
+
+        if args.data_path_val is not None:
+            results[mode] = evaluate_ssim(model, args, device)
+
+    for mode, (ssim, sec_per_slice) in results.items():
+        print(f'{mode:>6} SSIM = {ssim:.4f} Time = {sec_per_slice:.4f}s/slice')
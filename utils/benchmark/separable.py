@@ -0,0 +1,60 @@
+"""
+Standard vs depthwise-separable cascade U-Nets at equal parameter budget.
+
+The separable width is the unet_chans whose model has the parameter count
+closest to the standard one at --unet_chans (found by search unless
+--separable-chans is given); the separable model at the same width is
+shown for reference. Reports parameters, conv FLOPs and latency per
+geometry and, given validation data and checkpoints, the SSIM of each.
+"""
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, evaluate_ssim, count_conv_flops, setup
+from utils.model.feature_varnet import FIVarNet_n_att
+
+
+def add_args(parser):
+    parser.add_argument('--separable-chans', type=int, default=None, help='unet_chans of the separable model, matched to the standard parameter count if not given')
+    parser.add_argument('--separable-checkpoint', type=str, default=None, help='Checkpoint of the separable model for the SSIM comparison')
+    return parser
+
+
+def num_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def equal_param_chans(args):
+    """Separable unet_chans with the parameter count closest to the standard model."""
+    def params(unet_chans, separable):
+        return num_params(FIVarNet_n_att(num_cascades=args.cascade, chans=args.chans, sens_chans=args.sens_chans,
+                                         unet_chans=unet_chans, separable=separable))
+
+    target = params(args.unet_chans, False)
+    return min(range(args.unet_chans, 4 * args.unet_chans + 1), key=lambda c: abs(params(c, True) - target))
+
+
+def run(args):
+    device = setup(args)
+    separable_chans = args.separable_chans or equal_param_chans(args)
+
+    models = {'standard': build_model(args, device)}
+    unet_chans, checkpoint = args.unet_chans, args.checkpoint
+    args.checkpoint = None
+    models[f'sep{unet_chans}'] = build_model(args, device, separable=True)
+    args.unet_chans, args.checkpoint = separable_chans, args.separable_checkpoint
+    models[f'sep{separable_chans}'] = build_model(args, device, separable=True)
+    args.unet_chans, args.checkpoint = unet_chans, checkpoint
+
+    print(f'{"model":>9} {"params":>10} {"shape":>14} {"GFLOPs":>8} {"model":>10}')
+    with torch.no_grad():
+        for shape in args.shapes:
+            kspace, mask = synthetic_batch(shape, args.acc[0], args, device)
+            for name, model in models.items():
+                flops = count_conv_flops(model, lambda: model(kspace, mask))
+                t_model = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+                print(f'{name:>9} {num_params(model):>10d} {"x".join(map(str, shape)):>14} {flops / 1e9:>8.1f} {t_model:>9.4f}s')
+
+    if args.data_path_val is not None:
+        for name in ('standard', f'sep{separable_chans}'):
+            ssim, sec_per_slice = evaluate_ssim(models[name], args, device)
+            print(f'{name:>9} SSIM = {ssim:.4f} Time = {sec_per_slice:.4f}s/slice')
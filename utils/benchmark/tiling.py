@@ -0,0 +1,65 @@
+"""
+Tiled vs whole-slice regularisers.
+
+Every Unet2d / NormUnet runs on overlapping tiles (fixed edge or sized from a
+memory cap) while data consistency stays global. Reports peak memory, latency
+and the relative L2 / max abs difference to the untiled output per geometry
+and, given validation data, the SSIM of each setting. Fails if any relative L2
+exceeds --tolerance.
+"""
+import sys
+import torch
+
+from utils.benchmark.common import build_model, synthetic_batch, time_fn, evaluate_ssim, setup
+from utils.common.memory import allocation_stats
+
+
+def add_args(parser):
+    parser.add_argument('--tile-sizes', type=int, nargs='*', default=[256, 192], help='Fixed tile edges to compare')
+    parser.add_argument('--memory-caps', type=float, nargs='*', default=[64.], help='Regulariser memory caps in MB to compare')
+    parser.add_argument('--overlap', type=int, default=32, help='Overlap of neighbouring tiles in pixels')
+    parser.add_argument('--norm-passes', type=int, default=None, help='Passes measuring whole-image instance norm statistics, one per norm if not given')
+    parser.add_argument('--tolerance', type=float, default=1e-2, help='Largest allowed relative L2 difference to the untiled output')
+    return parser
+
+
+def run(args):
+    device = setup(args)
+    model = build_model(args, device)
+
+    settings = [('whole', None, None)]
+    settings += [(f'tile{size}', size, None) for size in args.tile_sizes]
+    settings += [(f'{cap:g}MB', None, cap) for cap in args.memory_caps]
+
+    failed = False
+    print(f'{"mode":>8} {"shape":>14} {"peak MB":>9} {"model":>10} {"rel L2":>9} {"max abs":>9}')
+    with torch.no_grad():
+        for shape in args.shapes:
+            kspace, mask = synthetic_batch(shape, args.acc[0], args, device)
+            reference = None
+            for mode, tile_size, cap in settings:
+                model.set_tiling(tile_size, args.overlap, cap, args.norm_passes)
+                output = model(kspace, mask)
+                if reference is None:
+                    reference = output
+                stats = allocation_stats(lambda: model(kspace, mask), device)
+                t_model = time_fn(lambda: model(kspace, mask), args.warmup, args.repeat)
+                rel_l2 = ((output - reference).norm() / reference.norm()).item()
+                max_abs = (output - reference).abs().max().item()
+                status = 'OK' if rel_l2 <= args.tolerance else 'FAIL'
+                failed |= status == 'FAIL'
+                print(
+                    f'{mode:>8} {"x".join(map(str, shape)):>14} {stats["peak_bytes"] / 2**20:>9.1f} '
+                    f'{t_model:>9.4f}s {rel_l2:>9.2e} {max_abs:>9.2e} [{status}]'
+                )
+
+    if args.data_path_val is not None:
+        for mode, tile_size, cap in settings:
+            model.set_tiling(tile_size, args.overlap, cap, args.norm_passes)
+            ssim, sec_per_slice = evaluate_ssim(model, args, device)
+            print(f'{mode:>8} SSIM = {ssim:.4f} Time = {sec_per_slice:.4f}s/slice')
+    model.set_tiling()
+
+    if failed:
+        print(f'Tiled output differs from the untiled one by more than {args.tolerance:g} relative L2')
+        sys.exit(1)
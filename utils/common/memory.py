@@ -0,0 +1,58 @@
+import resource
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+def allocation_stats(fn, device):
+    """
+    Runs fn() once and reports allocator traffic on device.
+
+    Returns:
+        dict with the number of allocations, the total bytes allocated and the
+        peak bytes in use above the level at the start of the call.
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_stats(device)
+        start_bytes = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        after = torch.cuda.memory_stats(device)
+        return {
+            'num_allocs': after['allocation.all.allocated'] - before['allocation.all.allocated'],
+            'alloc_bytes': after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated'],
+            'peak_bytes': torch.cuda.max_memory_allocated(device) - start_bytes,
+        }
+
+    # CPU allocations are only visible through the profiler's memory events
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted(
+        (e.start_us(), e.nbytes())
+        for e in prof.profiler.kineto_results.events()
+        if e.name() == '[memory]'
+    )
+    num_allocs = alloc_bytes = in_use = peak_bytes = 0
+    for _, nbytes in events:
+        if nbytes > 0:
+            num_allocs += 1
+            alloc_bytes += nbytes
+        in_use += nbytes
+        peak_bytes = max(peak_bytes, in_use)
+    return {'num_allocs': num_allocs, 'alloc_bytes': alloc_bytes, 'peak_bytes': peak_bytes}
+
+
+def peak_memory_bytes(device, reset=True):
+    """
+    Peak memory since the last reset without synchronising: the allocator's
+    high-water mark on CUDA, the process' peak resident set size on the CPU
+    (which cannot be reset).
+    """
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+        if reset:
+            torch.cuda.reset_peak_memory_stats(device)
+        return peak
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -4,12 +4,13 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from skimage.metrics import structural_similarity
 import h5py
 import numpy as np
 import torch
 import random
 
+from utils.common.ssim import image_ssim
+
 def save_reconstructions(reconstructions, out_dir, targets=None, inputs=None):
     """
     Saves the reconstructions from a model into h5 files that is appropriate for submission
@@ -31,20 +32,17 @@ def save_reconstructions(reconstructions, out_dir, targets=None, inputs=None):
             if inputs is not None:
                 f.create_dataset('input', data=inputs[fname])
     
-def ssim_loss(gt, pred, maxval=None):
+def ssim_loss(gt, pred, maxval=None, device=None):
     """Compute Structural Similarity Index Metric (SSIM)
        ssim_loss is defined as (1 - ssim)
+       Scored in float64, all slices at once on the GPU and with skimage on the CPU.
     """
+    gt = torch.as_tensor(gt, device=device).double()
+    pred = torch.as_tensor(pred, device=device).double()
     maxval = gt.max() if maxval is None else maxval
 
-    ssim = 0
-    for slice_num in range(gt.shape[0]):
-        ssim = ssim + structural_similarity(
-            gt[slice_num], pred[slice_num], data_range=maxval
-        )
-
-    ssim = ssim / gt.shape[0]
-    return 1 - ssim
+    ssim_per_slice = image_ssim(gt, pred, data_range=maxval)
+    return 1 - ssim_per_slice.mean().item()
 
 def seed_fix(n):
     torch.manual_seed(n)
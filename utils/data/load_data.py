@@ -1,7 +1,9 @@
 import h5py
 import random
 from utils.data.transforms import DataTransform
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, default_collate
+from torch.utils.data.distributed import DistributedSampler
+from collections import defaultdict
 from pathlib import Path
 import numpy as np
 import time
@@ -11,6 +13,9 @@ from utils.mraugment.data_augment import DataAugmentor
 from fastmri.data.subsample import create_mask_for_mask_type
 from fastmri.data.transforms import apply_mask
 
+# (coils, height, width) of every k-space geometry in the challenge data
+KSPACE_SHAPES = [(16, 768, 396), (16, 396, 768), (4, 768, 392)]
+
 class SliceData(Dataset):
     def __init__(self, root, transform, input_key, target_key, DataAugmentor, args, forward=False):
         self.transform = transform
@@ -31,11 +36,14 @@ class SliceData(Dataset):
             mask_acc = args.acc 
             mask_list = {}
 
-            data_list = [torch.randn(16, 768, 396, 2), torch.randn(16, 396, 768, 2), torch.randn(4, 768, 392, 2)]
+            data_list = [torch.randn(*shape, 2) for shape in KSPACE_SHAPES]
             for acc in mask_acc:
               for data in data_list:
                 mask_func = create_mask_for_mask_type(self.mask_type, self.center_fractions, [acc])
-                _, mask, _ = apply_mask(data, mask_func, None) # mask.shape = [1, 1, ?, 1]
+                # the mask offsets follow --seed, so a resumed run and every DDP rank draw the same masks;
+                # the split is part of the seed, validation does not score on the training offsets
+                seed = None if getattr(args, 'seed', None) is None else (args.seed, acc, data.shape[-2], int(DataAugmentor is None))
+                _, mask, _ = apply_mask(data, mask_func, None, seed=seed) # mask.shape = [1, 1, ?, 1]
                 mask = np.array(torch.squeeze(mask))
                 mask_list[(acc, data.shape[-2])] = mask # 마스크를 찾을 때에는 acc와 input의 열의 개수로 찾아야 함
             self.mask_list = mask_list
@@ -45,9 +53,9 @@ class SliceData(Dataset):
 
             for fname in sorted(image_files):
                 num_slices = self._get_metadata(fname)
-                if self.DataAugmentor != None: # train 하는 경우
-                    self.image_examples += [(fname, slice_ind) for slice_ind in range(num_slices)]
-                    self.image_examples += [(fname, slice_ind) for slice_ind in range(num_slices)]
+                if self.DataAugmentor != None: # train 하는 경우 (acceleration마다 한 번씩)
+                    for _ in args.acc:
+                        self.image_examples += [(fname, slice_ind) for slice_ind in range(num_slices)]
                 else: # val 하는 경우
                     self.image_examples += [(fname, slice_ind) for slice_ind in range(num_slices)]
 
@@ -57,8 +65,8 @@ class SliceData(Dataset):
             num_slices = self._get_metadata(fname)
             if not self.forward:
                 if self.DataAugmentor != None: # train 하는 경우
-                    self.kspace_examples += [(fname, slice_ind, args.acc[0]) for slice_ind in range(num_slices)]
-                    self.kspace_examples += [(fname, slice_ind, args.acc[1]) for slice_ind in range(num_slices)]
+                    for acc in args.acc:
+                        self.kspace_examples += [(fname, slice_ind, acc) for slice_ind in range(num_slices)]
                 else: # val 하는 경우
                     self.kspace_examples += [(fname, slice_ind, args.acc) for slice_ind in range(num_slices)]
             else: # eval 하는 경우
@@ -73,6 +81,15 @@ class SliceData(Dataset):
                 num_slices = hf[self.target_key].shape[0]
         return num_slices
 
+    def restrict(self, volumes):
+        """
+        Keeps only the validation volumes in volumes (file name -> accelerations
+        its masks are drawn from), e.g. a fixed stratified subset.
+        """
+        keep = [i for i, example in enumerate(self.kspace_examples) if example[0].name in volumes]
+        self.image_examples = [self.image_examples[i] for i in keep]
+        self.kspace_examples = [(fname, dataslice, volumes[fname.name]) for fname, dataslice, _ in (self.kspace_examples[i] for i in keep)]
+
     def __len__(self):
         return len(self.kspace_examples)
 
@@ -87,7 +104,7 @@ class SliceData(Dataset):
                 kspace_fname, dataslice, args_acc = self.kspace_examples[i]
             else: # val 하는 경우
                 kspace_fname, dataslice, args_acc_list = self.kspace_examples[i]
-                args_acc = args_acc_list[round(torch.rand(1).item())]
+                args_acc = args_acc_list[int(torch.rand(1).item() * len(args_acc_list))]
                 del args_acc_list
         
         if not self.forward:
@@ -133,7 +150,296 @@ class SliceData(Dataset):
         return self.transform(mask, input, target, attrs, kspace_fname.name, dataslice)
 
 
-def create_data_loaders(data_path, args, DataAugmentor=None, shuffle=False, isforward=False):
+class VolumeShardSampler(Sampler):
+    """
+    Validation sampler for distributed runs: every volume goes whole to exactly
+    one rank, so per-volume SSIM (normalised by the volume maximum) is computed
+    as in a single process and no slice is duplicated as DistributedSampler
+    would to even out the ranks. Volumes are balanced by slice count.
+    """
+
+    def __init__(self, dataset, num_replicas, rank):
+        volumes = defaultdict(list)
+        for index, example in enumerate(dataset.kspace_examples):
+            volumes[example[0]].append(index)
+
+        loads = [0] * num_replicas
+        owner = {}
+        for fname in sorted(volumes, key=lambda fname: (-len(volumes[fname]), fname)):
+            target = loads.index(min(loads))
+            owner[fname] = target
+            loads[target] += len(volumes[fname])
+        self.indices = [index for fname in volumes if owner[fname] == rank for index in volumes[fname]]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class ResumableSampler(DistributedSampler):
+    """
+    Training sampler whose order depends only on seed and epoch, so a resumed
+    run sees the same slices in the same order. set_start skips the samples
+    of the current epoch a mid-epoch checkpoint had already trained on.
+    num_replicas 1 / rank 0 outside distributed training.
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.start = 0
+
+    def set_start(self, start):
+        self.start = start
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class LossAwareSampler(ResumableSampler):
+    """
+    Training sampler drawing slices in proportion to their recent loss.
+
+    The table holds a running (exponential, decay) training loss per slice.
+    train_epoch records the loss of every batch on the device, collect() hands
+    the epoch's records over and update() folds them into the table, on every
+    rank alike. An epoch draws as many slices as a uniform one, with
+    replacement, from p = (1 - floor) x loss / sum(loss) + floor / N, so no
+    slice falls below floor / N; weight() is the importance correction
+    1 / (N p) that keeps the expected gradient that of uniform sampling. Every
+    uniform_every-th epoch (and the first, which fills the table) is a plain
+    uniform pass over all slices with weight 1. The draws depend on seed, epoch
+    and the table at the start of the epoch, state_dict keeps both for resuming.
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0, floor=0.2, uniform_every=5, decay=0.5):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, seed=seed)
+        if not 0 < floor <= 1:
+            raise ValueError('floor must be in (0, 1]')
+        self.floor, self.uniform_every, self.decay = floor, uniform_every, decay
+        self.losses = torch.full((len(dataset),), float('nan'), dtype=torch.float64)
+        self.plan_epoch = self.probs = None
+        self.planned = None
+        self.pending = []
+
+    def is_uniform(self, epoch):
+        return epoch % self.uniform_every == 0 or bool(torch.isnan(self.losses).any())
+
+    def _make_plan(self):
+        if self.plan_epoch != self.epoch:
+            # probabilities of the epoch, fixed when it starts
+            if self.is_uniform(self.epoch):
+                self.probs = None
+            else:
+                self.probs = (1 - self.floor) * self.losses / self.losses.sum() + self.floor / len(self.losses)
+            self.plan_epoch = self.epoch
+        if self.probs is None:
+            self.order = list(super(ResumableSampler, self).__iter__())
+            self.weights = torch.ones(len(self.order), dtype=torch.float64)
+        else:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            draws = torch.multinomial(self.probs, self.num_samples * self.num_replicas, replacement=True, generator=g)
+            draws = draws[self.rank::self.num_replicas]
+            self.order = draws.tolist()
+            self.weights = 1 / (len(self.losses) * self.probs[draws])
+        self.planned = self.epoch
+
+    def _ensure_plan(self):
+        if self.planned != self.epoch:
+            self._make_plan()
+
+    def _positions(self, iter, batch_size):
+        return slice(iter * batch_size, (iter + 1) * batch_size)
+
+    def weight(self, iter, batch_size):
+        """Mean importance weight of the slices of batch iter (counted from the start of the epoch)."""
+        self._ensure_plan()
+        return float(self.weights[self._positions(iter, batch_size)].mean())
+
+    def record(self, iter, batch_size, loss):
+        """Keeps the loss of batch iter for the slices in it, a device tensor is not read back here."""
+        self._ensure_plan()
+        self.pending.append((self.order[self._positions(iter, batch_size)], loss.detach()))
+
+    def collect(self, clear=True):
+        """The recorded (slice indices, loss) of this rank as Python numbers."""
+        if not self.pending:
+            return []
+        losses = torch.stack([torch.as_tensor(loss) for _, loss in self.pending]).cpu().tolist()
+        records = [(indices, loss) for (indices, _), loss in zip(self.pending, losses)]
+        if clear:
+            self.pending = []
+        return records
+
+    def update(self, records_per_rank):
+        """Folds the collected records of every rank into the table, in rank order."""
+        for records in records_per_rank:
+            for indices, loss in records:
+                for index in indices:
+                    old = self.losses[index]
+                    self.losses[index] = loss if torch.isnan(old) else self.decay * old + (1 - self.decay) * loss
+
+    def state_dict(self):
+        return {'losses': self.losses.clone(), 'plan_epoch': self.plan_epoch, 'probs': self.probs}
+
+    def load_state_dict(self, state, pending=()):
+        """pending: records collected mid-epoch but not folded in yet."""
+        self.losses = state['losses'].clone()
+        self.plan_epoch, self.probs = state['plan_epoch'], state['probs']
+        self.planned = None
+        self.pending = [(indices, torch.tensor(loss)) for indices, loss in pending]
+
+    def __iter__(self):
+        self._ensure_plan()
+        return iter(self.order[self.start:])
+
+
+def slice_shapes(kspace_fname, image_fname, input_key, target_key):
+    """(k-space (coils, height, width), target (height, width)) of the slices of a volume, read from the file headers."""
+    with h5py.File(kspace_fname, "r") as hf:
+        kspace_shape = hf[input_key].shape[1:]
+    with h5py.File(image_fname, "r") as hf:
+        target_shape = hf[target_key].shape[1:]
+    return kspace_shape, target_shape
+
+
+def shape_buckets(data_path, args):
+    """Sorted shape buckets (see slice_shapes) of the volumes in data_path."""
+    return sorted({slice_shapes(fname, Path(data_path / "image" / fname.name), args.input_key, args.target_key)
+                   for fname in Path(data_path / "kspace").iterdir()})
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Training batch sampler for micro-batch sizes chosen per shape bucket.
+
+    Slices are grouped by the k-space and target shapes of their volume
+    (batch_sizes: bucket -> micro-batch size). Every optimizer step takes
+    effective_batch slices of a single bucket per rank, split into micro-batches
+    of the bucket's size, so the effective batch is the same whatever the size.
+    Like ResumableSampler the order depends only on seed and epoch and
+    set_start skips micro-batches already trained on. Under DDP every rank gets
+    the same bucket and number of micro-batches at every step, the tail of a
+    bucket that does not split evenly over the ranks is dropped (different
+    slices every epoch). step_size / ends_step tell the training loop how a
+    micro-batch is weighted and when to step.
+    """
+
+    def __init__(self, dataset, batch_sizes, effective_batch, num_replicas=1, rank=0, seed=0):
+        shapes = {}
+        self.buckets = []
+        for (kspace_fname, *_), (image_fname, _) in zip(dataset.kspace_examples, dataset.image_examples):
+            if kspace_fname not in shapes:
+                shapes[kspace_fname] = slice_shapes(kspace_fname, image_fname, dataset.input_key, dataset.target_key)
+            self.buckets.append(shapes[kspace_fname])
+        self.batch_sizes = batch_sizes
+        self.effective_batch = effective_batch
+        self.num_replicas, self.rank, self.seed = num_replicas, rank, seed
+        self.epoch = self.start = 0
+        self.plan = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.plan = None
+
+    def set_start(self, start):
+        self.start = start
+
+    def _make_plan(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        per_bucket = defaultdict(list)
+        for index in torch.randperm(len(self.buckets), generator=g).tolist():
+            per_bucket[self.buckets[index]].append(index)
+
+        steps = []
+        size = self.effective_batch * self.num_replicas
+        for bucket in sorted(per_bucket):
+            indices, batch_size = per_bucket[bucket], self.batch_sizes[bucket]
+            for start in range(0, len(indices), size):
+                chunk = indices[start:start + size]
+                chunk = chunk[:len(chunk) - len(chunk) % self.num_replicas]
+                if chunk:
+                    mine = chunk[self.rank::self.num_replicas]
+                    steps.append([mine[i:i + batch_size] for i in range(0, len(mine), batch_size)])
+
+        self.batches, self.step_sizes, self.step_ends = [], [], []
+        for step in torch.randperm(len(steps), generator=g).tolist():
+            batches = steps[step]
+            self.batches += batches
+            self.step_sizes += [sum(len(batch) for batch in batches)] * len(batches)
+            self.step_ends += [False] * (len(batches) - 1) + [True]
+        self.plan = self.epoch
+
+    def _ensure_plan(self):
+        if self.plan != self.epoch:
+            self._make_plan()
+
+    def step_size(self, iter):
+        """Number of slices in the optimizer step of micro-batch iter (counted from the start of the epoch)."""
+        self._ensure_plan()
+        return self.step_sizes[iter]
+
+    def ends_step(self, iter):
+        self._ensure_plan()
+        return self.step_ends[iter]
+
+    def __iter__(self):
+        self._ensure_plan()
+        return iter(self.batches[self.start:])
+
+    def __len__(self):
+        self._ensure_plan()
+        return len(self.batches) - self.start
+
+
+def collate_by_shape(samples):
+    """
+    Collates the samples into one batch per k-space shape, in order of first
+    appearance: augmentation (rot90) can transpose slices of the same bucket.
+    """
+    groups = defaultdict(list)
+    for sample in samples:
+        groups[tuple(sample[1].shape)].append(sample)
+    return [default_collate(group) for group in groups.values()]
+
+
+def stratified_volumes(data_path, args, fraction):
+    """
+    Fixed validation subset: volumes are grouped by (coils, height, width) and
+    every group is split into one stratum per acceleration of args.acc, each
+    volume scored at a single acceleration. round(fraction x stratum size),
+    at least one volume, is drawn from every stratum with --seed.
+    Returns file name -> [acceleration].
+    """
+    groups = defaultdict(list)
+    for fname in sorted(Path(data_path / "kspace").iterdir()):
+        with h5py.File(fname, "r") as hf:
+            groups[hf[args.input_key].shape[1:]].append(fname.name)
+
+    rng = random.Random(args.seed)
+    volumes = {}
+    for shape in sorted(groups):
+        names = groups[shape]
+        rng.shuffle(names)
+        for i, acc in enumerate(args.acc):
+            stratum = names[i::len(args.acc)]
+            for name in stratum[:max(1, round(fraction * len(stratum)))]:
+                volumes[name] = [acc]
+    return volumes
+
+
+def create_data_loaders(data_path, args, DataAugmentor=None, shuffle=False, isforward=False, volumes=None, batch_sizes=None):
+    """
+    batch_sizes (shape bucket -> micro-batch size) batches shuffled training
+    slices by bucket, see BucketBatchSampler. args.loss_sampling draws them
+    with a LossAwareSampler.
+    """
     if isforward == False:
         max_key_ = args.max_key
         target_key_ = args.target_key
@@ -149,10 +455,41 @@ def create_data_loaders(data_path, args, DataAugmentor=None, shuffle=False, isfo
         DataAugmentor =  DataAugmentor,
         args = args
     )
+    if volumes is not None:
+        data_storage.restrict(volumes)
+
+    sampler = generator = None
+    distributed = getattr(args, 'distributed', False)
+    loss_sampling = getattr(args, 'loss_sampling', False)
+    if shuffle and not isforward and batch_sizes is not None:
+        if loss_sampling:
+            raise ValueError('Loss-aware sampling does not combine with per-bucket batch sizes')
+        batch_sampler = BucketBatchSampler(data_storage, batch_sizes, args.batch_size * args.acc_steps,
+                                           num_replicas=args.world_size if distributed else 1, rank=args.rank if distributed else 0,
+                                           seed=args.seed if args.seed is not None else 0)
+        generator = torch.Generator().manual_seed(args.seed if args.seed is not None else 0)
+        return DataLoader(dataset=data_storage, batch_sampler=batch_sampler, collate_fn=collate_by_shape, generator=generator)
+    if shuffle and not isforward:
+        # training slices are split evenly over the ranks
+        replicas = dict(num_replicas=args.world_size if distributed else 1, rank=args.rank if distributed else 0,
+                        seed=args.seed if args.seed is not None else 0)
+        if loss_sampling:
+            sampler = LossAwareSampler(data_storage, floor=args.sampling_floor, uniform_every=args.uniform_every, **replicas)
+        else:
+            sampler = ResumableSampler(data_storage, **replicas)
+        shuffle = False
+        # the worker seeds of every new iterator come from here instead of the global RNG,
+        # which a resumed run restores as it was mid-epoch, after the iterator was made
+        generator = torch.Generator().manual_seed(args.seed if args.seed is not None else 0)
+    elif distributed and not isforward:
+        # validation volumes go whole to one rank
+        sampler = VolumeShardSampler(data_storage, args.world_size, args.rank)
 
     data_loader = DataLoader(
         dataset=data_storage,
         batch_size=args.batch_size,
         shuffle=shuffle,
+        sampler=sampler,
+        generator=generator,
     )
     return data_loader
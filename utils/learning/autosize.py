@@ -0,0 +1,104 @@
+import functools
+import math
+import torch
+
+from fastmri.data.subsample import create_mask_for_mask_type
+from utils.common.memory import allocation_stats
+from utils.learning.distributed import all_gather_object, is_main_process
+
+
+def memory_budget_bytes(args, device):
+    """--memory-budget in bytes, 90% of the GPU if not given."""
+    if args.memory_budget is not None:
+        return int(args.memory_budget * 2 ** 20)
+    if device.type == 'cuda':
+        return int(0.9 * torch.cuda.get_device_properties(device).total_memory)
+    raise ValueError('--auto-batch on the CPU needs --memory-budget')
+
+
+def fixed_bytes(model, args):
+    """Memory that does not grow with the batch: parameters, the two RAdam moments and the DDP gradient buckets."""
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    return param_bytes * (3 + int(args.distributed))
+
+
+def probe_peak_bytes(model, loss_type, kspace_shape, target_shape, batch_size, args, device):
+    """
+    Peak memory of a dry training forward/backward of batch_size synthetic
+    slices, above what was allocated before. Gradients are dropped afterwards,
+    the weights and the optimizer are untouched. inf if it runs out of memory.
+    """
+    coils, height, width = kspace_shape
+    g = torch.Generator().manual_seed(0)
+    kspace = torch.randn(batch_size, coils, height, width, 2, generator=g) * 1e-4
+    mask_func = create_mask_for_mask_type(args.mask_type, args.center_fractions, [min(args.acc)])
+    mask = mask_func((1, height, width, 2), seed=0)[0].reshape(1, 1, 1, width, 1).byte()
+    kspace, mask = (kspace * mask).to(device), mask.to(device)
+    maximum = torch.ones(batch_size, device=device)
+    crop_size = tuple(target_shape) if args.roi_crop else None
+
+    def step():
+        if args.deep_supervision > 0:
+            outputs = model(kspace, mask, crop_size=crop_size, return_intermediate=True)
+        else:
+            outputs = [model(kspace, mask, crop_size=crop_size)]
+        target = torch.zeros_like(outputs[-1])
+        sum(loss_type(output, target, maximum) for output in outputs).backward()
+
+    model.train()
+    try:
+        return allocation_stats(step, device)['peak_bytes']
+    except torch.cuda.OutOfMemoryError:
+        return math.inf
+    finally:
+        model.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def micro_batch_size(probe, budget, max_batch):
+    """
+    Largest micro-batch up to max_batch whose probe(batch) peak fits the
+    budget: extrapolated linearly from batches 1 and 2, then checked and
+    shrunk until it fits. At least 1.
+    """
+    one = probe(1)
+    if max_batch == 1 or one > budget:
+        return 1
+    per_slice = probe(2) - one
+    batch = max_batch if per_slice <= 0 else int(min(max_batch, 1 + (budget - one) // per_slice))
+    while batch > 2 and probe(batch) > budget:
+        batch -= max(1, batch // 8)
+    return max(batch, 1)
+
+
+def auto_batch_sizes(model, loss_type, buckets, args, device):
+    """
+    Chooses the micro-batch size of every shape bucket (see
+    load_data.shape_buckets) for the memory budget, at most the effective batch
+    --batch-size x --acc-steps, which every optimizer step keeps. The smallest
+    choice of any rank is taken so the ranks step together.
+    Returns bucket -> micro-batch size.
+    """
+    budget = memory_budget_bytes(args, device) - fixed_bytes(model, args)
+    effective_batch = args.batch_size * args.acc_steps
+    probes, batch_sizes = {}, {}
+    for bucket in buckets:
+        # a batch size is probed at most once per bucket
+        probes[bucket] = functools.lru_cache()(
+            lambda batch, bucket=bucket: probe_peak_bytes(model, loss_type, *bucket, batch, args, device))
+        batch_sizes[bucket] = micro_batch_size(probes[bucket], budget, effective_batch)
+
+    gathered = all_gather_object(args, batch_sizes)
+    batch_sizes = {bucket: min(sizes[bucket] for sizes in gathered) for bucket in batch_sizes}
+
+    if is_main_process(args):
+        print(f'Auto batch sizes for a {memory_budget_bytes(args, device) / 2 ** 20:.0f} MB budget, effective batch {effective_batch}:')
+        for bucket, batch_size in batch_sizes.items():
+            kspace_shape, target_shape = bucket
+            peak = probes[bucket](batch_size)
+            fits = '' if peak <= budget else ' (over budget even at 1)'
+            print(f'  k-space {"x".join(map(str, kspace_shape))} target {"x".join(map(str, target_shape))}: '
+                  f'micro-batch {batch_size} x {math.ceil(effective_batch / batch_size)} accumulation steps, '
+                  f'peak {peak / 2 ** 20:.0f} MB{fits}')
+    return batch_sizes
@@ -0,0 +1,174 @@
+import os
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+from pathlib import Path
+
+from utils.common.utils import save_reconstructions
+
+
+def to_cpu(obj):
+    """Copy of obj with every tensor copied to the CPU, so training can keep updating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def link_or_copy(src, dst):
+    """Hard link dst to src, a copy where links are not supported (e.g. across file systems)."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def rng_state(augmentor=None):
+    """State of every random generator training draws from, the augmentation pipeline included."""
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    if getattr(augmentor, 'aug_on', False):
+        state['augment'] = augmentor.augmentation_pipeline.rng.get_state()
+    return state
+
+
+def set_rng_state(state, augmentor=None):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if 'augment' in state and getattr(augmentor, 'aug_on', False):
+        augmentor.augmentation_pipeline.rng.set_state(state['augment'])
+
+
+class BackgroundWriter:
+    """
+    Runs submitted jobs on a background thread in submission order. At most
+    max_pending jobs wait, further submissions block. A failed job is raised
+    by the next call and later jobs are skipped.
+    """
+
+    def __init__(self, max_pending=2, name='background-writer'):
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    fn, args, kwargs = job
+                    fn(*args, **kwargs)
+            except BaseException as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f'Background write of {self.thread.name} failed') from error
+
+    def submit(self, fn, *args, **kwargs):
+        self._raise_error()
+        self.queue.put((fn, args, kwargs))
+
+    def flush(self):
+        """Blocks until everything submitted is on disk."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+class CheckpointWriter(BackgroundWriter):
+    """
+    Writes checkpoints and validation reconstructions on a background thread.
+
+    save_checkpoint snapshots the tensors to the CPU and returns; serialising,
+    linking the best model and deleting old checkpoints happen off the training
+    thread in submission order. At most max_pending snapshots wait in memory,
+    further submissions block. A failed write is raised by the next call.
+
+    keep_last: number of epoch checkpoints to keep, older ones and superseded
+        best models are deleted. None keeps everything.
+    """
+
+    def __init__(self, keep_last=None, max_pending=2):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be at least 1')
+        super().__init__(max_pending, name='checkpoint-writer')
+        self.keep_last = keep_last
+        self.saved = []
+        self.best_path = None
+
+    def restore(self, saved, best_path=None):
+        """
+        Takes over the epoch checkpoints (oldest first) and the best model link a
+        previous run left behind, so keep_last still deletes them. Call before
+        the first save.
+        """
+        self.saved = [str(path) for path in saved]
+        self.best_path = best_path and str(best_path)
+
+    def save_checkpoint(self, checkpoint, path, best_path=None, retained=True):
+        """
+        Saves checkpoint to path and, for a new best, links best_path to it.
+        retained=False is for files overwritten in place (the resume checkpoint),
+        they do not count towards keep_last.
+        """
+        self.submit(self._write_checkpoint, to_cpu(checkpoint), str(path), best_path and str(best_path), retained)
+
+    def save_reconstructions(self, reconstructions, out_dir, targets=None, inputs=None):
+        # validate() hands over freshly stacked numpy arrays, no copy needed
+        self.submit(save_reconstructions, reconstructions, out_dir, targets=targets, inputs=inputs)
+
+    def publish_reconstructions(self, staging_dir, out_dir, keep=True):
+        """Once everything queued before is written, moves the files of staging_dir to out_dir, or deletes them."""
+        self.submit(self._publish, Path(staging_dir), Path(out_dir), keep)
+
+    def _publish(self, staging_dir, out_dir, keep):
+        if not staging_dir.exists():
+            return
+        if keep:
+            out_dir.mkdir(parents=True, exist_ok=True)
+            for path in staging_dir.iterdir():
+                os.replace(path, out_dir / path.name)
+        shutil.rmtree(staging_dir)
+
+    def _write_checkpoint(self, checkpoint, path, best_path, retained):
+        # readers never see a partially written file
+        torch.save(checkpoint, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        if best_path is not None:
+            link_or_copy(path, best_path)
+            if self.keep_last is not None and self.best_path not in (None, best_path) and os.path.exists(self.best_path):
+                os.remove(self.best_path)
+            self.best_path = best_path
+
+        if retained and path not in self.saved:
+            self.saved.append(path)
+        if self.keep_last is not None:
+            # the best model is a separate link, deleting its epoch checkpoint keeps it
+            while len(self.saved) > self.keep_last:
+                old = self.saved.pop(0)
+                if os.path.exists(old):
+                    os.remove(old)
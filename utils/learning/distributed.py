@@ -0,0 +1,51 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """
+    Joins the process group when launched by torchrun (WORLD_SIZE > 1) and sets
+    args.distributed, args.rank, args.local_rank and args.world_size. A plain
+    `python train.py` run is rank 0 of 1.
+    """
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.distributed = args.world_size > 1
+    if args.distributed:
+        dist.init_process_group(backend=args.dist_backend)
+
+
+def cleanup_distributed(args):
+    if args.distributed:
+        dist.destroy_process_group()
+
+
+def is_main_process(args):
+    return getattr(args, 'rank', 0) == 0
+
+
+def all_reduce_sum(args, *values):
+    """Sums the given numbers over all ranks, returned as floats."""
+    if not args.distributed:
+        return tuple(float(value) for value in values)
+    # gloo reduces CPU tensors, NCCL needs them on the GPU
+    device = args.device if dist.get_backend() == 'nccl' else 'cpu'
+    tensor = torch.tensor([float(value) for value in values], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tuple(tensor.tolist())
+
+
+def all_gather_object(args, obj):
+    """List of obj from every rank, in rank order."""
+    if not args.distributed:
+        return [obj]
+    objects = [None] * args.world_size
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def barrier(args):
+    if args.distributed:
+        dist.barrier()
@@ -0,0 +1,64 @@
+import torch
+from pathlib import Path
+
+from utils.model.feature_varnet import FIVarNet_n_att
+
+# submitted ensemble: two acc4/5 models followed by two acc8/9 models
+ENSEMBLE_CHECKPOINTS = ('model24_acc45.pt', 'model25_acc45.pt', 'model23_acc89.pt', 'model25_acc89.pt')
+# the same two pairs, each weight-averaged into one model by soup.py
+SOUP_CHECKPOINTS = ('model_soup_acc45.pt', 'model_soup_acc89.pt')
+
+
+def detect_acceleration(mask):
+    """Spacing of the first two sampled lines of an equispaced mask."""
+    indices_of_ones = torch.where(mask.flatten() == 1)[0]
+    return int(indices_of_ones[1] - indices_of_ones[0])
+
+
+def ensemble_forward(models, kspace, mask):
+    """
+    Averages the ensemble members that cover the detected acceleration. The first
+    half of models are acc4/5 members and the second half acc8/9 ones, i.e.
+    (acc45, acc45, acc89, acc89) or the soups (acc45, acc89). A single model is
+    run as is. Slices of a batch are routed one by one since their masks can differ.
+    """
+    if len(models) == 1:
+        return models[0](kspace, mask)
+    if kspace.shape[0] > 1:
+        return torch.cat([ensemble_forward(models, kspace[i : i + 1], mask[i : i + 1]) for i in range(kspace.shape[0])])
+
+    half = len(models) // 2
+    acceleration = detect_acceleration(mask)
+    if acceleration < 8:
+        members = models[:half]
+    elif acceleration < 12:
+        members = models
+    else:
+        members = models[half:]
+    return sum(model(kspace, mask) for model in members) / len(members)
+
+
+def load_teacher(path, args, device):
+    """
+    Frozen ensemble member for distillation. The architecture comes from the
+    training args stored in the checkpoint, or from args if there are none.
+    """
+    checkpoint = torch.load(path, map_location='cpu')
+    model_args = checkpoint.get('args') or args
+    model = FIVarNet_n_att(num_cascades=model_args.cascade,
+                   chans=model_args.chans,
+                   sens_chans=model_args.sens_chans,
+                   unet_chans=model_args.unet_chans,
+                   sens_acs_crop=getattr(model_args, 'sens_acs_crop', False),
+                   roi_crop=getattr(model_args, 'roi_crop', False),
+                   separable=getattr(model_args, 'separable', False))
+    model.load_state_dict(checkpoint['model'])
+    model.to(device=device)
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def load_teachers(paths, args, device):
+    return tuple(load_teacher(Path(path), args, device) for path in paths)
@@ -0,0 +1,43 @@
+import torch
+import numpy as np
+import onnxruntime as ort
+
+from utils.model.onnx_export import onnx_path
+
+
+class OnnxModel:
+    """
+    ONNX Runtime stand-in for a FIVarNet_n_att checkpoint in test_part.
+
+    Holds one InferenceSession per k-space geometry, created on first use
+    from the files written by export_onnx.py.
+    """
+
+    def __init__(self, onnx_dir, name, num_threads=0):
+        self.onnx_dir = onnx_dir
+        self.name = name
+        self.options = ort.SessionOptions()
+        self.options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.options.intra_op_num_threads = num_threads
+        self.sessions = {}
+
+    def eval(self):
+        return self
+
+    def session(self, shape):
+        if shape not in self.sessions:
+            path = onnx_path(self.onnx_dir, self.name, shape)
+            if not path.exists():
+                raise FileNotFoundError(f'{path} not found, run export_onnx.py for shape {shape}')
+            self.sessions[shape] = ort.InferenceSession(
+                str(path), sess_options=self.options, providers=['CPUExecutionProvider']
+            )
+        return self.sessions[shape]
+
+    def __call__(self, masked_kspace, mask):
+        session = self.session(tuple(masked_kspace.shape[1:4]))
+        output = session.run(None, {
+            'kspace': masked_kspace.cpu().numpy().astype(np.float32),
+            'mask': mask.cpu().numpy().astype(np.uint8),
+        })[0]
+        return torch.from_numpy(output).to(masked_kspace.device)
@@ -0,0 +1,53 @@
+import torch
+from torch.profiler import ProfilerActivity, profile, schedule
+
+from utils.model.feature_varnet import set_profile_labels
+
+# record_function labels of the model and the training loop, reported on their own
+REGIONS = ('sens_net', 'feature_cascade', 'image_cascade', 'fft2c', 'ifft2c', 'loss', 'backward', 'optimizer')
+
+
+def profile_steps(args):
+    return args.profile_wait + args.profile_warmup + args.profile_active
+
+
+def region_table(prof):
+    """Total time of every labelled region, children included, in ms."""
+    cuda = torch.cuda.is_available()
+    rows = [event for event in prof.key_averages() if event.key.startswith(REGIONS)]
+    lines = [f'{"region":<20} {"calls":>6} {"CPU total":>12}' + (f' {"CUDA total":>12}' if cuda else '')]
+    for event in sorted(rows, key=lambda event: event.key):
+        line = f'{event.key:<20} {event.count:>6d} {event.cpu_time_total / 1000:>10.2f}ms'
+        if cuda:
+            line += f' {event.cuda_time_total / 1000:>10.2f}ms'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def make_profiler(args, name):
+    """
+    torch.profiler over a wait / warmup / active schedule of steps; call .step()
+    after every training step or slice. Turns the model's region labels on.
+    When the active window closes, the Chrome trace goes to
+    args.profile_dir / <name>.json and the region totals and the top
+    args.profile_top operators by self time are printed and saved next to it.
+    """
+    set_profile_labels(True)
+    cuda = torch.cuda.is_available()
+
+    def on_trace_ready(prof):
+        args.profile_dir.mkdir(parents=True, exist_ok=True)
+        prof.export_chrome_trace(str(args.profile_dir / f'{name}.json'))
+        sort_by = 'self_cuda_time_total' if cuda else 'self_cpu_time_total'
+        report = region_table(prof) + '\n\n' + prof.key_averages().table(sort_by=sort_by, row_limit=args.profile_top)
+        (args.profile_dir / f'{name}.txt').write_text(report)
+        print(report)
+        print(f'Chrome trace saved to {args.profile_dir / name}.json')
+
+    return profile(
+        activities=[ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if cuda else []),
+        schedule=schedule(wait=args.profile_wait, warmup=args.profile_warmup, active=args.profile_active, repeat=1),
+        on_trace_ready=on_trace_ready,
+        record_shapes=True,
+        profile_memory=True,
+    )
@@ -0,0 +1,92 @@
+import json
+import math
+import h5py
+import numpy as np
+import torch
+from pathlib import Path
+
+from utils.learning.ensemble import detect_acceleration
+
+
+def load_routes(config_path):
+    """
+    Reads a router config:
+
+        {"routes": [{"min_acc": 8, "max_acc": 12,
+                     "models": [{"checkpoint": "../result/model24_acc45.pt", "weight": 0.25}, ...]},
+                    ...]}
+
+    min_acc is inclusive (default 0), max_acc exclusive (default no limit).
+    """
+    with open(config_path) as f:
+        return json.load(f)['routes']
+
+
+def split_routes(acc45_checkpoints, acc89_checkpoints):
+    """
+    The submitted routing as routes: acc4/5 members below 8, all members
+    from 8 to 12, acc8/9 members from 12 on, uniformly weighted.
+    """
+    def members(checkpoints):
+        return [{'checkpoint': str(checkpoint), 'weight': 1.0 / len(checkpoints)} for checkpoint in checkpoints]
+
+    return [
+        {'max_acc': 8, 'models': members(acc45_checkpoints)},
+        {'min_acc': 8, 'max_acc': 12, 'models': members(acc45_checkpoints + acc89_checkpoints)},
+        {'min_acc': 12, 'models': members(acc89_checkpoints)},
+    ]
+
+
+def single_model_routes(checkpoint):
+    """Every acceleration goes to one checkpoint."""
+    return [{'models': [{'checkpoint': str(checkpoint), 'weight': 1.0}]}]
+
+
+def volume_accelerations(kspace_dir):
+    """Acceleration of every volume in kspace_dir, read from its stored mask."""
+    accelerations = {}
+    for fname in sorted(Path(kspace_dir).iterdir()):
+        with h5py.File(fname, 'r') as hf:
+            accelerations[fname.name] = detect_acceleration(torch.from_numpy(np.array(hf['mask'])))
+    return accelerations
+
+
+class EnsembleRouter:
+    """
+    Weighted ensemble per acceleration range. Checkpoints are loaded by
+    load_fn(path) the first time a route needs them and stay resident, so
+    later splits reuse them.
+    """
+
+    def __init__(self, routes, load_fn):
+        self.routes = routes
+        self.load_fn = load_fn
+        self.models = {}
+
+    def route(self, acceleration):
+        for route in self.routes:
+            if route.get('min_acc', 0) <= acceleration < route.get('max_acc', math.inf):
+                return route['models']
+        raise ValueError(f'No route for acceleration {acceleration}')
+
+    def checkpoints(self, accelerations):
+        """Checkpoints needed for the given accelerations, in first-use order."""
+        needed = []
+        for acceleration in accelerations:
+            for member in self.route(acceleration):
+                if member['checkpoint'] not in needed:
+                    needed.append(member['checkpoint'])
+        return needed
+
+    def model(self, checkpoint):
+        if checkpoint not in self.models:
+            model = self.load_fn(Path(checkpoint))
+            model.eval()
+            self.models[checkpoint] = model
+        return self.models[checkpoint]
+
+    def __call__(self, kspace, mask, acceleration):
+        output = 0
+        for member in self.route(acceleration):
+            output = output + member['weight'] * self.model(member['checkpoint'])(kspace, mask)
+        return output
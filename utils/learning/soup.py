@@ -0,0 +1,39 @@
+import torch
+
+
+def average_state_dicts(state_dicts):
+    """Uniform average of the floating point tensors, everything else is taken from the first."""
+    averaged = {}
+    for key, value in state_dicts[0].items():
+        if torch.is_floating_point(value):
+            averaged[key] = sum(state_dict[key].float() for state_dict in state_dicts).div_(len(state_dicts)).to(value.dtype)
+        else:
+            averaged[key] = value.clone()
+    return averaged
+
+
+def greedy_soup(candidates, evaluate):
+    """
+    Greedy model soup: candidates are (name, state_dict) pairs, evaluate(state_dict)
+    returns a score to maximise. Ingredients are tried best-first and kept only if
+    the average with them scores at least as well as without.
+
+    Returns:
+        (names of the kept ingredients, averaged state dict, its score)
+    """
+    scored = sorted(((evaluate(state_dict), name, state_dict) for name, state_dict in candidates), key=lambda c: -c[0])
+    for score, name, _ in scored:
+        print(f'  {name}: {score:.4f}')
+
+    best_score, name, state_dict = scored[0]
+    names, ingredients = [name], [state_dict]
+    for _, name, state_dict in scored[1:]:
+        soup = average_state_dicts(ingredients + [state_dict])
+        score = evaluate(soup)
+        kept = score >= best_score
+        print(f'  + {name}: {score:.4f} ({"kept" if kept else "dropped"})')
+        if kept:
+            names.append(name)
+            ingredients.append(state_dict)
+            best_score = score
+    return names, average_state_dicts(ingredients), best_score
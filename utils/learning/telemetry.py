@@ -0,0 +1,137 @@
+import json
+import multiprocessing as mp
+import time
+from collections import defaultdict
+
+import torch
+
+from utils.common.memory import peak_memory_bytes
+from utils.learning.checkpoint import BackgroundWriter
+
+
+def append_jsonl(path, records):
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+class Telemetry:
+    """
+    Per-step time breakdown of training: data wait, forward, backward,
+    optimizer step, augmentation time and peak memory.
+
+    Phases are delimited with CUDA events on the GPU, so nothing synchronises
+    until flush(), which resolves every flush_every steps at once and appends
+    one JSON line per step to path on a background thread (path None only keeps
+    the epoch summary). Data wait is the host time between the end of a step
+    and the next batch. augment_seconds is a shared counter DataAugmentor.timer
+    adds to, in the main process or in DataLoader workers alike; as workers run
+    ahead, a step is charged with what finished while it waited for its batch
+    and ran.
+    """
+
+    PHASES = ('data', 'forward', 'backward', 'optimizer', 'augment')
+
+    def __init__(self, path, device, flush_every=50):
+        self.path, self.device = path, device
+        self.cuda = device.type == 'cuda'
+        self.flush_every = flush_every
+        self.augment_seconds = mp.Value('d', 0.0)
+        self.writer = BackgroundWriter(max_pending=4, name='telemetry-writer') if path is not None else None
+        self.pending = []
+        self.start_epoch(0)
+
+    def _now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        if self.cuda:
+            return start.elapsed_time(end) / 1000
+        return end - start
+
+    def _augment_seconds(self):
+        with self.augment_seconds.get_lock():
+            return self.augment_seconds.value
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.totals = defaultdict(float)
+        self.num_steps = self.num_slices = 0
+        self.peak_bytes = 0
+        self.epoch_start = self.last_end = time.perf_counter()
+        self.last_augment = self._augment_seconds()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def begin_step(self, iter):
+        self.step = {'iter': iter, 'data': time.perf_counter() - self.last_end}
+        self.marks = [('start', self._now())]
+
+    def mark(self, phase):
+        """Ends phase, the next one starts here."""
+        self.marks.append((phase, self._now()))
+
+    def end_step(self, num_slices):
+        augment = self._augment_seconds()
+        self.step.update({
+            'epoch': self.epoch,
+            'slices': num_slices,
+            'augment': augment - self.last_augment,
+            'peak_mem_mb': peak_memory_bytes(self.device) / 2 ** 20,
+        })
+        self.last_augment = augment
+        self.pending.append((self.step, self.marks))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+        self.last_end = time.perf_counter()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.cuda:
+            # the one synchronisation per flush_every steps
+            self.pending[-1][1][-1][1].synchronize()
+        records = []
+        for step, marks in self.pending:
+            # a phase marked several times in a step (one forward per k-space shape) adds up
+            for (_, start), (phase, end) in zip(marks, marks[1:]):
+                step[phase] = step.get(phase, 0.) + self._elapsed(start, end)
+            for phase in self.PHASES:
+                self.totals[phase] += step.get(phase, 0.)
+            self.num_steps += 1
+            self.num_slices += step['slices']
+            self.peak_bytes = max(self.peak_bytes, step['peak_mem_mb'])
+            records.append(step)
+        self.pending = []
+        if self.writer is not None:
+            self.writer.submit(append_jsonl, self.path, records)
+
+    def summary(self):
+        """Totals of the epoch, also appended to the log as a record of type 'epoch'."""
+        self.flush()
+        wall = time.perf_counter() - self.epoch_start
+        compute = self.totals['forward'] + self.totals['backward'] + self.totals['optimizer']
+        summary = {
+            'type': 'epoch',
+            'epoch': self.epoch,
+            'steps': self.num_steps,
+            'slices': self.num_slices,
+            'wall': wall,
+            'slices_per_sec': self.num_slices / wall if wall > 0 else 0.,
+            **{phase: self.totals[phase] for phase in self.PHASES},
+            'peak_mem_mb': self.peak_bytes,
+            # waiting for batches longer than computing on them: the loader is the bottleneck
+            'bound': 'loader' if self.totals['data'] > compute else 'compute',
+        }
+        if self.writer is not None:
+            self.writer.submit(append_jsonl, self.path, [summary])
+        return summary
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
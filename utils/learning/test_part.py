@@ -1,38 +1,32 @@
 import numpy as np
 import torch
+from pathlib import Path
 
 from collections import defaultdict
 from utils.common.utils import save_reconstructions
-from utils.data.load_data import create_data_loaders
+from utils.data.load_data import create_data_loaders, KSPACE_SHAPES
 from utils.model.feature_varnet import FIVarNet_n_att
+from utils.model.compile_cache import CompiledModelCache
+from utils.model.quantize import load_int8, int8_path
+from utils.learning.ensemble import ENSEMBLE_CHECKPOINTS, SOUP_CHECKPOINTS
+from utils.learning.profiling import make_profiler
+from utils.learning.router import EnsembleRouter, load_routes, split_routes, single_model_routes, volume_accelerations
 
-def test(args, model1, model2, model3, model4, data_loader):
-    # ensemble 적용
-    model1.eval()
-    model2.eval()
-    model3.eval()
-    model4.eval()
-
+def test(args, router, accelerations, data_loader, profiler=None):
+    # ensemble 적용: volume마다 미리 구한 acceleration으로 model 선택
+    # profiler는 slice마다 한 step
     reconstructions = defaultdict(dict)
     
     with torch.no_grad():
         for (mask, kspace, _, _, fnames, slices) in data_loader:
-            kspace = kspace.cuda(non_blocking=True)
-            mask = mask.cuda(non_blocking=True)
-            
-            # calculating acc
-            indices_of_ones = torch.where(mask.flatten() == 1)[0]
-            acceleration = int(indices_of_ones[1]-indices_of_ones[0])
-
-            if acceleration < 8:
-                output = (model1(kspace, mask)+model2(kspace, mask))/2
-            elif acceleration < 12:
-                output = (model1(kspace, mask)+model2(kspace, mask)+model3(kspace, mask)+model4(kspace, mask))/4
-            else:
-                output = (model3(kspace, mask)+model4(kspace, mask))/2
-                
-            for i in range(output.shape[0]):
-                reconstructions[fnames[i]][int(slices[i])] = output[i].cpu().numpy()
+            kspace = kspace.to(args.device, non_blocking=True)
+            mask = mask.to(args.device, non_blocking=True)
+
+            for i in range(kspace.shape[0]):
+                output = router(kspace[i : i + 1], mask[i : i + 1], accelerations[fnames[i]])
+                reconstructions[fnames[i]][int(slices[i])] = output[0].cpu().numpy()
+                if profiler is not None:
+                    profiler.step()
 
     for fname in reconstructions:
         reconstructions[fname] = np.stack(
@@ -41,46 +35,75 @@ def test(args, model1, model2, model3, model4, data_loader):
     return reconstructions, None
 
 
-def forward(args):
-
-    device = torch.device(f'cuda:{args.GPU_NUM}' if torch.cuda.is_available() else 'cpu')
-    torch.cuda.set_device(device)
-    print ('Current cuda device ', torch.cuda.current_device())
+def load_model(args, exp_dir, fname, device):
+    if args.backend == 'onnx':
+        # onnxruntime is only needed for this backend
+        from utils.learning.onnx_backend import OnnxModel
+        return OnnxModel(args.onnx_dir, Path(fname).stem, args.ort_threads)
 
-    model1 = FIVarNet_n_att(num_cascades=args.cascade, 
-                   chans=args.chans, 
-                   sens_chans=args.sens_chans,
-                   unet_chans=args.unet_chans)
-    model2 = FIVarNet_n_att(num_cascades=args.cascade, 
-                   chans=args.chans, 
-                   sens_chans=args.sens_chans,
-                   unet_chans=args.unet_chans)
-    model3 = FIVarNet_n_att(num_cascades=args.cascade, 
-                   chans=args.chans, 
-                   sens_chans=args.sens_chans,
-                   unet_chans=args.unet_chans)
-    model4 = FIVarNet_n_att(num_cascades=args.cascade, 
+    model = FIVarNet_n_att(num_cascades=args.cascade, 
                    chans=args.chans, 
                    sens_chans=args.sens_chans,
-                   unet_chans=args.unet_chans)
-                
-    model1.to(device=device)
-    model2.to(device=device)
-    model3.to(device=device)
-    model4.to(device=device)
+                   unet_chans=args.unet_chans,
+                   sens_acs_crop=args.sens_acs_crop,
+                   roi_crop=args.roi_crop,
+                   separable=args.separable)
+    if args.quantized:
+        return load_int8(model, int8_path(exp_dir / fname))
+    model.to(device=device)
 
+    checkpoint = torch.load(exp_dir / fname, map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    model.set_fast_inference(args.fast_inference)
+    model.set_early_exit(args.early_exit)
+    model.set_tiling(args.tile_size, args.tile_overlap, args.tile_memory, args.tile_norm_passes)
+    if args.channels_last:
+        model.set_channels_last(True)
+    if args.bf16:
+        model.set_amp_dtype(torch.bfloat16)
 
-    checkpoint1 = torch.load(args.exp_dir_acc45 / 'model24_acc45.pt', map_location='cpu')
-    checkpoint2 = torch.load(args.exp_dir_acc45 / 'model25_acc45.pt', map_location='cpu')
-    checkpoint3 = torch.load(args.exp_dir_acc89 / 'model23_acc89.pt', map_location='cpu')
-    checkpoint4 = torch.load(args.exp_dir_acc89 / 'model25_acc89.pt', map_location='cpu')
+    if args.compile:
+        model = CompiledModelCache(model, args.compile_cache_dir)
+        model.warmup(KSPACE_SHAPES, device)
+    return model
 
 
-    model1.load_state_dict(checkpoint1['model'])
-    model2.load_state_dict(checkpoint2['model'])
-    model3.load_state_dict(checkpoint3['model'])
-    model4.load_state_dict(checkpoint4['model'])
-    
+def build_routes(args):
+    if args.router_config is not None:
+        return load_routes(args.router_config)
+    if args.student is not None:
+        # one distilled model in place of the ensemble
+        return single_model_routes(args.student)
+    if args.soup:
+        # one weight-averaged model per acceleration pair
+        return split_routes([args.exp_dir_acc45 / SOUP_CHECKPOINTS[0]], [args.exp_dir_acc89 / SOUP_CHECKPOINTS[1]])
+    return split_routes([args.exp_dir_acc45 / fname for fname in ENSEMBLE_CHECKPOINTS[:2]],
+                        [args.exp_dir_acc89 / fname for fname in ENSEMBLE_CHECKPOINTS[2:]])
+
+
+def forward(args):
+
+    device = torch.device(f'cuda:{args.GPU_NUM}' if torch.cuda.is_available() else 'cpu')
+    if args.quantized:
+        # INT8 kernels (fbgemm / qnnpack) only run on CPU
+        device = torch.device('cpu')
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+        print ('Current cuda device ', torch.cuda.current_device())
+    args.device = device
+
+    if getattr(args, 'router', None) is None:
+        # kept on args so loaded models stay resident across the public and private splits
+        args.router = EnsembleRouter(build_routes(args), lambda path: load_model(args, path.parent, path.name, device))
+
+    accelerations = volume_accelerations(args.data_path / 'kspace')
+    needed = args.router.checkpoints(sorted(set(accelerations.values())))
+    print(f'Accelerations {sorted(set(accelerations.values()))} -> {", ".join(Path(checkpoint).name for checkpoint in needed)}')
+
     forward_loader = create_data_loaders(data_path = args.data_path, args = args, isforward = True)
-    reconstructions, inputs = test(args, model1, model2, model3, model4, forward_loader)
-    save_reconstructions(reconstructions, args.forward_dir, inputs=inputs)
\ No newline at end of file
+    if args.profile:
+        with make_profiler(args, f'reconstruct_{args.forward_dir.name}') as profiler:
+            reconstructions, inputs = test(args, args.router, accelerations, forward_loader, profiler=profiler)
+    else:
+        reconstructions, inputs = test(args, args.router, accelerations, forward_loader)
+    save_reconstructions(reconstructions, args.forward_dir, inputs=inputs)
@@ -1,4 +1,3 @@
-import shutil
 import numpy as np
 import torch
 import torch.nn as nn
@@ -8,14 +7,24 @@ from tqdm import tqdm
 from pathlib import Path
 import copy
 import pprint
+import contextlib
+import re
 
-from collections import defaultdict
-from utils.data.load_data import create_data_loaders
-from utils.common.utils import save_reconstructions, ssim_loss, seed_fix
+from collections import Counter, defaultdict
+from utils.data.load_data import BucketBatchSampler, LossAwareSampler, create_data_loaders, shape_buckets, stratified_volumes, KSPACE_SHAPES
+from utils.common.utils import ssim_loss, seed_fix
 from utils.common.loss_function import SSIMLoss
 
 # FIVarNet without block attention
-from utils.model.feature_varnet import FIVarNet_n_att
+from utils.model.feature_varnet import FIVarNet_n_att, profile_label
+from utils.model.compile_cache import CompiledModelCache
+from utils.learning.ensemble import ensemble_forward, load_teachers
+from utils.learning.distributed import all_gather_object, all_reduce_sum, cleanup_distributed, is_main_process
+from utils.learning.checkpoint import CheckpointWriter, rng_state, set_rng_state
+from utils.learning.telemetry import Telemetry
+from utils.learning.profiling import make_profiler, profile_steps
+from utils.learning.autosize import auto_batch_sizes
+from torch.nn.parallel import DistributedDataParallel
 
 
 from utils.mraugment.data_augment import DataAugmentor
@@ -23,80 +32,216 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 import os, sys
 
-def train_epoch(args, acc_steps, epoch, model, data_loader, optimizer, LRscheduler, best_val_loss, loss_type):
-    model.train()
-    start_epoch = start_iter = time.perf_counter()
-    len_loader = len(data_loader)
-    total_loss = 0
-
-    for iter, data in enumerate(data_loader):
-        mask, kspace, target, maximum, fname, _ = data
-        mask = mask.cuda(non_blocking=True)
-        kspace = kspace.cuda(non_blocking=True)
-        target = target.cuda(non_blocking=True)
-        maximum = maximum.cuda(non_blocking=True)
-
-        output = model(kspace, mask)
-        loss = loss_type(output, target, maximum)
-
-        loss /= acc_steps
-        loss.backward()
-
-        if ((iter + 1) % acc_steps == 0) or (iter + 1 == len_loader):
-            nn.utils.clip_grad_norm_(model.parameters(), args.max_norm)
-            optimizer.step()
-            optimizer.zero_grad()
+def reconstruction_loss(args, loss_type, output, target, maximum, teacher_output=None):
+    if teacher_output is None:
+        return loss_type(output, target, maximum)
+    loss = args.distill_alpha * loss_type(output, teacher_output, maximum)
+    if args.distill_alpha < 1:
+        loss = loss + (1 - args.distill_alpha) * loss_type(output, target, maximum)
+    return loss
 
-        loss *= acc_steps
-        total_loss += loss.item()
 
-        if iter % args.report_interval == 0:
+def train_epoch(args, acc_steps, epoch, model, data_loader, optimizer, LRscheduler, best_val_loss, loss_type, teachers=None,
+                start_iter=0, total_loss=0., on_step=None, telemetry=None, profiler=None):
+    """
+    start_iter / total_loss continue an epoch from a mid-epoch checkpoint, the
+    sampler already skips the first start_iter batches. on_step(iter, total_loss)
+    is called after every optimizer step before the last one, with the number
+    of batches done. telemetry records the time breakdown of every step, an
+    epoch summary is printed either way. With a profiler the epoch stops after
+    its schedule. A loader with a BucketBatchSampler replaces acc_steps by the
+    steps of its plan, a LossAwareSampler weights every batch and records its
+    loss.
+    """
+    model.train()
+    start_epoch = start_time = time.perf_counter()
+    len_loader = start_iter + len(data_loader)
+    if telemetry is None:
+        telemetry = Telemetry(None, args.device)
+    telemetry.start_epoch(epoch)
+    # summed on the device, reading it back every iteration would synchronise
+    total_loss = torch.tensor(float(total_loss), device=args.device)
+
+    # bucketed batches: per-bucket micro-batch sizes, the sampler knows where every optimizer step ends
+    buckets = data_loader.batch_sampler if isinstance(data_loader.batch_sampler, BucketBatchSampler) else None
+    # loss-aware sampling: the sampler weights every batch and keeps its loss
+    loss_sampler = data_loader.sampler if isinstance(data_loader.sampler, LossAwareSampler) else None
+
+    for iter, data in enumerate(data_loader, start_iter):
+        telemetry.begin_step(iter)
+        if buckets is not None:
+            step = buckets.ends_step(iter)
+            step_size = buckets.step_size(iter)
+            # the micro-batch comes split by k-space shape, augmentation can transpose slices
+            groups = data
+        else:
+            step = ((iter + 1) % acc_steps == 0) or (iter + 1 == len_loader)
+            step_size = None
+            groups = [data]
+        importance = loss_sampler.weight(iter, args.batch_size) if loss_sampler is not None else None
+
+        loss, num_slices = 0., 0
+        for i, (mask, kspace, target, maximum, fname, _) in enumerate(groups):
+            mask = mask.to(args.device, non_blocking=True)
+            kspace = kspace.to(args.device, non_blocking=True)
+            target = target.to(args.device, non_blocking=True)
+            maximum = maximum.to(args.device, non_blocking=True)
+            # the gradient of a step is the mean over its slices
+            divisor = acc_steps if step_size is None else step_size / kspace.shape[0]
+
+            crop_size = tuple(target.shape[-2:]) if args.roi_crop else None
+            # DDP all-reduces the gradients only on the backward before an optimizer step
+            no_sync = getattr(model, 'no_sync', None)
+            sync = step and i == len(groups) - 1
+            with no_sync() if no_sync is not None and not sync else contextlib.nullcontext():
+                if args.deep_supervision > 0:
+                    outputs = model(kspace, mask, crop_size=crop_size, return_intermediate=True)
+                    output = outputs[-1]
+                else:
+                    output = model(kspace, mask, crop_size=crop_size)
+
+                teacher_output = None
+                if teachers is not None:
+                    # distillation: the averaged ensemble output is the target
+                    with torch.no_grad():
+                        teacher_output = ensemble_forward(teachers, kspace, mask)
+                with profile_label('loss'):
+                    group_loss = reconstruction_loss(args, loss_type, output, target, maximum, teacher_output)
+                    if args.deep_supervision > 0:
+                        # supervise the output after every cascade so early exits stay valid
+                        aux_loss = sum(reconstruction_loss(args, loss_type, aux, target, maximum, teacher_output) for aux in outputs[:-1])
+                        group_loss = group_loss + args.deep_supervision * aux_loss / (len(outputs) - 1)
+
+                telemetry.mark('forward')
+                scaled_loss = group_loss / divisor
+                if importance is not None:
+                    # slices drawn more often than uniformly count less, the expected gradient is the uniform one
+                    scaled_loss = scaled_loss * importance
+                with profile_label('backward'):
+                    scaled_loss.backward()
+                telemetry.mark('backward')
+            loss = loss + group_loss.detach() * kspace.shape[0]
+            num_slices += kspace.shape[0]
+
+        if step:
+            with profile_label('optimizer'):
+                nn.utils.clip_grad_norm_(model.parameters(), args.max_norm)
+                optimizer.step()
+                optimizer.zero_grad()
+        telemetry.mark('optimizer')
+
+        loss = loss / num_slices
+        total_loss += loss
+        if loss_sampler is not None:
+            loss_sampler.record(iter, args.batch_size, loss)
+        telemetry.end_step(num_slices)
+        if step and on_step is not None and iter + 1 < len_loader:
+            on_step(iter + 1, total_loss)
+
+        if iter % args.report_interval == 0 and is_main_process(args):
             print(
                 f'Epoch = [{epoch:3d}/{args.num_epochs:3d}] '
-                f'Iter = [{iter:4d}/{len(data_loader):4d}] '
+                f'Iter = [{iter:4d}/{len_loader:4d}] '
                 f'Loss = {loss.item():.4g} '
-                f'Time = {time.perf_counter() - start_iter:.4f}s',
+                f'Time = {time.perf_counter() - start_time:.4f}s',
             )
-            start_iter = time.perf_counter()
+            start_time = time.perf_counter()
+
+        if profiler is not None:
+            profiler.step()
+            if profiler.step_num >= profile_steps(args):
+                break
+
+    summary = telemetry.summary()
+    if is_main_process(args):
+        print(
+            f'Epoch = [{epoch:3d}/{args.num_epochs:3d}] {summary["slices_per_sec"]:.2f} slices/s, '
+            f'data {summary["data"]:.1f}s (augment {summary["augment"]:.1f}s) '
+            f'forward {summary["forward"]:.1f}s backward {summary["backward"]:.1f}s optimizer {summary["optimizer"]:.1f}s '
+            f'peak {summary["peak_mem_mb"]:.0f} MB -> {summary["bound"]}-bound',
+        )
 
-    total_loss = total_loss / len_loader
+    total_loss = total_loss.item() / len_loader
     return total_loss, time.perf_counter() - start_epoch, len_loader
 
 
-def validate(args, model, data_loader):
+def validate(args, model, data_loader, on_volume=None):
+    """
+    Scores every volume as soon as its last slice is reconstructed and frees it,
+    so only the volumes in flight are held in memory. The expected slice counts
+    come from the dataset. on_volume(fname, reconstruction, target, loss) receives
+    every finished volume as numpy arrays with its SSIM loss, e.g. to queue it
+    for writing.
+    Returns the summed SSIM loss, the number of volumes and the time taken.
+    """
     model.eval()
+    expected = Counter(example[0].name for example in data_loader.dataset.kspace_examples)
     reconstructions = defaultdict(dict)
     targets = defaultdict(dict)
+    metric_loss, num_subjects = 0., 0
     start = time.perf_counter()
 
+    def finish(fname):
+        nonlocal metric_loss, num_subjects
+        order = sorted(reconstructions[fname])
+        reconstruction = np.stack([reconstructions[fname][i] for i in order])
+        target = np.stack([targets[fname][i] for i in order])
+        del reconstructions[fname], targets[fname]
+        loss = ssim_loss(target, reconstruction, device=args.device)
+        metric_loss += loss
+        num_subjects += 1
+        if on_volume is not None:
+            on_volume(fname, reconstruction, target, loss)
+
     with torch.no_grad():
         for iter, data in enumerate(data_loader):
             mask, kspace, target, _, fnames, slices = data
-            kspace = kspace.cuda(non_blocking=True)
-            mask = mask.cuda(non_blocking=True)
+            kspace = kspace.to(args.device, non_blocking=True)
+            mask = mask.to(args.device, non_blocking=True)
 
-            output = model(kspace, mask)
+            crop_size = tuple(target.shape[-2:]) if args.roi_crop else None
+            output = model(kspace, mask, crop_size=crop_size)
 
             for i in range(output.shape[0]):
                 reconstructions[fnames[i]][int(slices[i])] = output[i].cpu().numpy()
                 targets[fnames[i]][int(slices[i])] = target[i].numpy()
+                if len(reconstructions[fnames[i]]) == expected[fnames[i]]:
+                    finish(fnames[i])
 
-    for fname in reconstructions:
-        reconstructions[fname] = np.stack(
-            [out for _, out in sorted(reconstructions[fname].items())]
-        )
-    for fname in targets:
-        targets[fname] = np.stack(
-            [out for _, out in sorted(targets[fname].items())]
-        )
-    metric_loss = sum([ssim_loss(targets[fname], reconstructions[fname]) for fname in reconstructions])
-    num_subjects = len(reconstructions)
-    return metric_loss, num_subjects, reconstructions, targets, None, time.perf_counter() - start
+    # volumes the sampler did not hand over completely
+    for fname in list(reconstructions):
+        finish(fname)
+    return metric_loss, num_subjects, time.perf_counter() - start
 
 
-def save_model(args, exp_dir, epoch, model, optimizer, LRscheduler, best_val_loss, is_new_best):
+def stage_best_candidate(writer, staging_dir, out_dir, best_val_loss, num_volumes):
+    """
+    on_volume callback for validate() that queues every scored volume into
+    staging_dir while the epoch can still be a new best. No volume has a
+    negative SSIM loss, so once the loss summed so far reaches best_val_loss
+    over all num_volumes the epoch cannot beat it: the staged volumes are
+    dropped and the rest are not written.
+    """
+    budget = float(best_val_loss) * num_volumes
+    running_loss = 0.
+
+    def on_volume(fname, reconstruction, target, loss):
+        nonlocal running_loss
+        if running_loss >= budget:
+            return
+        running_loss += loss
+        if running_loss >= budget:
+            writer.publish_reconstructions(staging_dir, out_dir, keep=False)
+        else:
+            writer.save_reconstructions({fname: reconstruction}, staging_dir, targets={fname: target})
+    return on_volume
+
+
+def save_model(args, exp_dir, epoch, model, optimizer, LRscheduler, best_val_loss, is_new_best, writer):
     # 각 epoch마다 train과 validate이 끝난 model 개별 저장
-    torch.save(
+    # 각 epoch마다 validate이 끝난 후 best_val_loss 가진 model이면 best_model 개별 저장 (hard link)
+    # the writer snapshots the state to CPU here and serialises it in the background
+    writer.save_checkpoint(
         {
             'epoch': epoch,
             'args': args,
@@ -106,14 +251,60 @@ def save_model(args, exp_dir, epoch, model, optimizer, LRscheduler, best_val_los
             'best_val_loss': best_val_loss,
             'exp_dir': exp_dir
         },
-        f=os.path.join(exp_dir, 'model'+str(epoch)+'_acc'+str(args.acc[0])+str(args.acc[1])+'.pt')
+        os.path.join(exp_dir, 'model'+str(epoch)+'_acc'+args.acc_tag+'.pt'),
+        best_path=os.path.join(exp_dir, 'best_model'+str(epoch)+'_acc'+args.acc_tag+'.pt') if is_new_best else None,
     )
 
-    # 각 epoch마다 validate이 끝난 후 best_val_loss 가진 model이면 best_model 개별 저장
-    if is_new_best:
-        shutil.copyfile(
-            os.path.join(exp_dir, 'model'+str(epoch)+'_acc'+str(args.acc[0])+str(args.acc[1])+'.pt'),
-            os.path.join(exp_dir, 'best_model'+str(epoch)+'_acc'+str(args.acc[0])+str(args.acc[1])+'.pt')
+
+def set_train_position(train_loader, epoch, start_iter, args):
+    # the order only depends on seed and epoch, a resumed epoch skips what it already trained on
+    if isinstance(train_loader.batch_sampler, BucketBatchSampler):
+        train_loader.batch_sampler.set_epoch(epoch)
+        train_loader.batch_sampler.set_start(start_iter)
+    else:
+        train_loader.sampler.set_epoch(epoch)
+        train_loader.sampler.set_start(start_iter * args.batch_size)
+
+
+def saved_checkpoints(args):
+    """Epoch checkpoints of exp_dir oldest first and the latest best model link, as save_model names them."""
+    def epochs(prefix):
+        pattern = re.compile(prefix + r'(\d+)_acc' + re.escape(args.acc_tag) + r'\.pt')
+        matches = (pattern.fullmatch(path.name) for path in Path(args.exp_dir).iterdir())
+        return sorted((int(match.group(1)), os.path.join(args.exp_dir, match.group(0))) for match in matches if match)
+    best = epochs('best_model')
+    return [path for _, path in epochs('model')], best[-1][1] if best else None
+
+
+def resume_path(args):
+    return os.path.join(args.exp_dir, 'resume_acc'+args.acc_tag+'.pt')
+
+
+def save_resume(args, epoch, iter, model, optimizer, LRscheduler, best_val_loss, val_loss_log, total_loss, augmentor, writer,
+                best_fast_val_loss=float('inf'), sampler=None):
+    # 중단된 학습을 이어가기 위한 checkpoint, 매번 같은 파일에 덮어쓴다
+    # epoch / iter: the next batch to train, iter 0 after the epoch is validated
+    # random generators, the running loss and the slice losses not yet in the sampler's table differ per rank, rank 0 stores all of them
+    per_rank = all_gather_object(args, {'rng': rng_state(augmentor), 'total_loss': float(total_loss),
+                                        'sampler_pending': sampler.collect(clear=False) if sampler is not None else []})
+    if is_main_process(args):
+        writer.save_checkpoint(
+            {
+                'epoch': epoch,
+                'iter': iter,
+                'args': args,
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'LRscheduler': LRscheduler.state_dict(),
+                'best_val_loss': best_val_loss,
+                'val_loss_log': val_loss_log,
+                'best_fast_val_loss': best_fast_val_loss,
+                'world_size': args.world_size,
+                'per_rank': per_rank,
+                'sampler': sampler.state_dict() if sampler is not None else None,
+            },
+            resume_path(args),
+            retained=False,
         )
 
 
@@ -137,104 +328,234 @@ def download_model(url, fname):
 
         
 def train(args):
-    device = torch.device(f'cuda:{args.GPU_NUM}' if torch.cuda.is_available() else 'cpu')
-    torch.cuda.set_device(device)
-    print('Current cuda device: ', torch.cuda.current_device())
+    # one GPU per process under torchrun, gloo runs on the CPU
+    gpu = args.local_rank if args.distributed else args.GPU_NUM
+    device = torch.device(f'cuda:{gpu}' if torch.cuda.is_available() else 'cpu')
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+        print('Current cuda device: ', torch.cuda.current_device())
+    args.device = device
 
     model = FIVarNet_n_att(num_cascades=args.cascade, 
                    chans=args.chans, 
                    sens_chans=args.sens_chans,
-                   unet_chans=args.unet_chans)
+                   unet_chans=args.unet_chans,
+                   sens_acs_crop=args.sens_acs_crop,
+                   roi_crop=args.roi_crop,
+                   separable=args.separable)
 
     model.to(device=device)
+    if args.channels_last:
+        model.set_channels_last(True)
+    if args.bf16:
+        model.set_amp_dtype(torch.bfloat16)
+
+    # checkpoints and validation use the bare network, DDP only wraps training
+    net = model
+    if args.distributed:
+        # the only buffers are constant zeros, nothing to broadcast before every forward
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None,
+                                        broadcast_buffers=False)
+
+    if args.compile:
+        model = CompiledModelCache(model, args.compile_cache_dir)
+        model.warmup(KSPACE_SHAPES, device, train=True)
+        model.warmup(KSPACE_SHAPES, device, train=False)
 
     loss_type = SSIMLoss().to(device=device)
+    teachers = load_teachers(args.teachers, args, device) if args.distill else None
 
     # optimizer, LRscheduler 설정
     optimizer = torch.optim.RAdam(model.parameters(), lr=args.lr, betas=(0.9, 0.999), eps=1e-08)
     LRscheduler = ReduceLROnPlateau(optimizer, mode='min', patience=args.lr_scheduler_patience, factor=args.lr_scheduler_factor, verbose=True)
 
     best_val_loss = 1.
-    start_epoch = 0
-    
+    best_fast_val_loss = float('inf')
+    start_epoch = start_iter = 0
+    total_loss = 0.
+    val_loss_log = np.empty((0, 2))
+
+    # 중단된 학습 이어가기: model, optimizer, LRscheduler, validation log, 데이터 순서, random state 복원
+    resume = None
+    if args.resume:
+        if not os.path.exists(resume_path(args)):
+            raise FileNotFoundError(f'No resume checkpoint at {resume_path(args)}')
+        resume = torch.load(resume_path(args), map_location='cpu')
+        net.load_state_dict(resume['model'])
+        optimizer.load_state_dict(resume['optimizer'])
+        LRscheduler.load_state_dict(resume['LRscheduler'])
+        best_val_loss = resume['best_val_loss']
+        val_loss_log = resume['val_loss_log']
+        best_fast_val_loss = resume.get('best_fast_val_loss', best_fast_val_loss)
+        start_epoch, start_iter = resume['epoch'], resume['iter']
+        if is_main_process(args):
+            print(f'Resuming from {resume_path(args)} at epoch {start_epoch}, iteration {start_iter}')
 
-    """
-    # pretrained model 가져오기
-    MODEL_FNAMES = '/root/result/model25_acc45.pt'
-    
-    if Path(MODEL_FNAMES).exists():
-      pretrained = torch.load(MODEL_FNAMES)
-      pretrained_copy = copy.deepcopy(pretrained['model'])
-      for layer in pretrained_copy.keys():
-        if layer.split('.',2)[1].isdigit() and (args.cascade <= int(layer.split('.',2)[1]) <=11):
-            del pretrained['model'][layer]
-      del pretrained_copy
-
-      model.load_state_dict(pretrained['model'])
-      optimizer.load_state_dict(pretrained['optimizer'])
-      LRscheduler.load_state_dict(pretrained['LRscheduler'])
-      best_val_loss = pretrained['best_val_loss']
-      start_epoch = pretrained['epoch']
-
-      del pretrained
-    """
-    
     # -----------------
     # data augmentation
     # -----------------
     # initialize data augmentation pipeline
     current_epoch = start_epoch
     current_epoch_func = lambda: current_epoch
-    augmentor = DataAugmentor(args, current_epoch_func)
+    # every rank draws its own augmentations
+    augmentor = DataAugmentor(args, current_epoch_func, seed=None if args.seed is None else args.seed + args.rank)
     # ------------------
 
-    train_loader = create_data_loaders(data_path = args.data_path_train, args = args, DataAugmentor = augmentor ,shuffle=True) #여기에 dataaugmentor를 argument 로 넣어줘야 함.
+    # per-step time breakdown, one JSONL log per rank
+    telemetry_path = None
+    if args.telemetry:
+        telemetry_path = os.path.join(args.val_loss_dir, f'telemetry_acc{args.acc_tag}' + (f'.rank{args.rank}' if args.distributed else '') + '.jsonl')
+    telemetry = Telemetry(telemetry_path, device, flush_every=args.report_interval)
+    augmentor.timer = telemetry.augment_seconds
+
+    # micro-batch size per shape bucket from the memory budget, a resumed run keeps those of the checkpoint
+    batch_sizes = None
+    if args.auto_batch:
+        batch_sizes = getattr(resume['args'], 'batch_sizes', None) if resume is not None else None
+        if batch_sizes is None:
+            batch_sizes = auto_batch_sizes(net, loss_type, shape_buckets(args.data_path_train, args), args, device)
+        args.batch_sizes = batch_sizes
+
+    train_loader = create_data_loaders(data_path = args.data_path_train, args = args, DataAugmentor = augmentor ,shuffle=True, batch_sizes=batch_sizes) #여기에 dataaugmentor를 argument 로 넣어줘야 함.
     val_loader = create_data_loaders(data_path = args.data_path_val, args = args, DataAugmentor = None)
-
-    val_loss_log = np.empty((0, 2))
+    fast_val_loader = None
+    if args.fast_val_fraction is not None:
+        fast_val_loader = create_data_loaders(data_path = args.data_path_val, args = args, DataAugmentor = None,
+                                              volumes = stratified_volumes(args.data_path_val, args, args.fast_val_fraction))
+        if is_main_process(args):
+            print(f'Fast validation on {len(fast_val_loader.dataset)} of {len(val_loader.dataset)} validation slices')
+
+    loss_sampler = train_loader.sampler if args.loss_sampling else None
+    if resume is not None:
+        if resume['world_size'] == args.world_size:
+            # after the loaders, building them draws random masks
+            set_rng_state(resume['per_rank'][args.rank]['rng'], augmentor)
+            total_loss = resume['per_rank'][args.rank]['total_loss']
+            pending = resume['per_rank'][args.rank].get('sampler_pending', [])
+        else:
+            # the data order is still the same, the slices are split differently
+            start_iter = start_iter * resume['world_size'] // args.world_size
+            total_loss = sum(rank['total_loss'] for rank in resume['per_rank']) / args.world_size
+            # every rank folds in what all ranks collected at the end of the epoch, rank 0 can hold it all
+            pending = [record for rank in resume['per_rank'] for record in rank.get('sampler_pending', [])] if is_main_process(args) else []
+            if is_main_process(args):
+                print(f'Checkpoint of {resume["world_size"]} ranks, random states not restored')
+        if loss_sampler is not None and resume.get('sampler') is not None:
+            loss_sampler.load_state_dict(resume['sampler'], pending)
+        del resume
+
+    if args.profile:
+        # 학습 step 몇 개만 profiling 하고 종료, validation과 저장은 하지 않음
+        current_epoch = start_epoch
+        set_train_position(train_loader, start_epoch, start_iter, args)
+        name = f'train_acc{args.acc_tag}' + (f'_rank{args.rank}' if args.distributed else '')
+        with make_profiler(args, name) as profiler:
+            train_epoch(args, args.acc_steps, start_epoch, model, train_loader, optimizer, LRscheduler, best_val_loss, loss_type, teachers,
+                        telemetry=telemetry, profiler=profiler)
+        telemetry.close()
+        cleanup_distributed(args)
+        return
+
+    writer = CheckpointWriter(keep_last=args.keep_last)
+    if args.resume:
+        # --keep-last also covers what was written before the resume
+        writer.restore(*saved_checkpoints(args))
+    staging_dir = args.val_dir.parent / f'{args.val_dir.name}.rank{args.rank}.tmp'
     for epoch in range(start_epoch, args.num_epochs):
         if epoch == 25:
             break
 
-        print(f'Epoch #{epoch:2d} ............... {args.net_name} ...............')
+        if is_main_process(args):
+            print(f'Epoch #{epoch:2d} ............... {args.net_name} ...............')
         
         # current_epoch 업데이트
         current_epoch = epoch
-
-        train_loss, train_time, end_itr = train_epoch(args, args.acc_steps, epoch, model, train_loader, optimizer, LRscheduler, best_val_loss, loss_type)
-        
-        val_loss, num_subjects, reconstructions, targets, inputs, val_time = validate(args, model, val_loader)
+        set_train_position(train_loader, epoch, start_iter, args)
+        steps_done = 0
+
+        def on_step(iter, total_loss):
+            # optimizer steps since the epoch (re)started, bucketed batches step at uneven intervals
+            nonlocal steps_done
+            steps_done += 1
+            if args.checkpoint_every and steps_done % args.checkpoint_every == 0:
+                save_resume(args, epoch, iter, net, optimizer, LRscheduler, best_val_loss, val_loss_log, total_loss, augmentor, writer,
+                            best_fast_val_loss=best_fast_val_loss, sampler=loss_sampler)
+
+        train_loss, train_time, end_itr = train_epoch(args, args.acc_steps, epoch, model, train_loader, optimizer, LRscheduler, best_val_loss, loss_type, teachers,
+                                                      start_iter=start_iter, total_loss=total_loss, on_step=on_step, telemetry=telemetry)
+        start_iter, total_loss = 0, 0.
+        if loss_sampler is not None:
+            # the slice losses of every rank, so all ranks draw the next epoch from the same table
+            loss_sampler.update(all_gather_object(args, loss_sampler.collect()))
         
-        val_loss_log = np.append(val_loss_log, np.array([[epoch, val_loss]]), axis=0)
-        file_path = os.path.join(args.val_loss_dir, f'val_loss_log_acc{args.acc[0]}{args.acc[1]}')
-        np.save(file_path, val_loss_log)
-        print(f"loss file saved! {file_path}")
-
-        train_loss = torch.tensor(train_loss).cuda(non_blocking=True)
-        val_loss = torch.tensor(val_loss).cuda(non_blocking=True)
-        num_subjects = torch.tensor(num_subjects).cuda(non_blocking=True)
-
-        val_loss = val_loss / num_subjects
-
-        LRscheduler.step(val_loss)
-
-        is_new_best = val_loss < best_val_loss
-        best_val_loss = min(best_val_loss, val_loss)
+        val_net = net if args.distributed else model
+        full_val = True
+        if fast_val_loader is not None:
+            # the same stratified subset every epoch, the plateau scheduler follows it
+            fast_val_loss, fast_subjects, fast_val_time = validate(args, val_net, fast_val_loader)
+            fast_val_loss, fast_subjects = all_reduce_sum(args, fast_val_loss, fast_subjects)
+            fast_val_loss /= fast_subjects
+            LRscheduler.step(fast_val_loss)
+            # a full pass on a suspected new best, every full_val_every epochs and at the end
+            full_val = (fast_val_loss < best_fast_val_loss or (epoch + 1) % args.full_val_every == 0
+                        or epoch + 1 == args.num_epochs)
+            best_fast_val_loss = min(best_fast_val_loss, fast_val_loss)
+            if is_main_process(args):
+                print(f'Epoch = [{epoch:4d}/{args.num_epochs:4d}] FastValLoss = {fast_val_loss:.4g} '
+                      f'FastValTime = {fast_val_time:.4f}s {"-> full validation" if full_val else ""}')
+
+        train_loss, = all_reduce_sum(args, train_loss)
+        train_loss /= args.world_size
+        val_loss, val_time, is_new_best = None, 0., False
+        if full_val:
+            save_volume = None
+            if args.save_val_reconstructions:
+                # volumes are queued for writing as soon as they are scored, only while the epoch can still be a new best,
+                # and kept below only if it is one; the dataset lists the volumes of every rank
+                num_volumes = len({example[0].name for example in val_loader.dataset.kspace_examples})
+                save_volume = stage_best_candidate(writer, staging_dir, args.val_dir, best_val_loss, num_volumes)
+            val_loss, num_subjects, val_time = validate(args, val_net, val_loader, on_volume=save_volume)
+            # every rank validated whole volumes of its own, the sums give the full-set SSIM
+            val_loss, num_subjects = all_reduce_sum(args, val_loss, num_subjects)
+
+            if is_main_process(args):
+                val_loss_log = np.append(val_loss_log, np.array([[epoch, val_loss]]), axis=0)
+                file_path = os.path.join(args.val_loss_dir, f'val_loss_log_acc{args.acc_tag}')
+                np.save(file_path, val_loss_log)
+                print(f"loss file saved! {file_path}")
+
+            val_loss = torch.tensor(val_loss).to(device, non_blocking=True)
+            num_subjects = torch.tensor(num_subjects).to(device, non_blocking=True)
+
+            val_loss = val_loss / num_subjects
+
+            if fast_val_loader is None:
+                LRscheduler.step(val_loss)
+
+            # best model 선택은 항상 전체 validation set 기준
+            is_new_best = val_loss < best_val_loss
+            best_val_loss = min(best_val_loss, val_loss)
 
         # 각 epoch마다 train과 validate이 끝난 model 개별 저장
         # 각 epoch마다 validate이 끝난 후 best_val_loss 가진 model이면 best_model 개별 저장
-        save_model(args, args.exp_dir, epoch + 1, model, optimizer, LRscheduler, best_val_loss, is_new_best)
-        print(
-            f'Epoch = [{epoch:4d}/{args.num_epochs:4d}] TrainLoss = {train_loss:.4g} '
-            f'ValLoss = {val_loss:.4g} TrainTime = {train_time:.4f}s ValTime = {val_time:.4f}s',
-        )
-        
-        if is_new_best:
-            print("@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@NewRecord@@@@@@@@@@@@@@@@@@@@@@@@@@@@")
-      
-            start = time.perf_counter()
-            save_reconstructions(reconstructions, args.val_dir, targets=targets, inputs=inputs)
+        if is_main_process(args):
+            save_model(args, args.exp_dir, epoch + 1, net, optimizer, LRscheduler, best_val_loss, is_new_best, writer)
             print(
-                f'Epoch {epoch + 1} val reconstructions saved!'
-                f'ForwardTime = {time.perf_counter() - start:.4f}s',
+                f'Epoch = [{epoch:4d}/{args.num_epochs:4d}] TrainLoss = {train_loss:.4g} '
+                f'ValLoss = {"-" if val_loss is None else f"{val_loss:.4g}"} TrainTime = {train_time:.4f}s ValTime = {val_time:.4f}s',
             )
+        
+        if full_val and args.save_val_reconstructions:
+            # each rank moves the volumes it validated into val_dir, or drops them
+            writer.publish_reconstructions(staging_dir, args.val_dir, keep=bool(is_new_best))
+        if is_new_best and is_main_process(args):
+            print("@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@NewRecord@@@@@@@@@@@@@@@@@@@@@@@@@@@@")
+            if args.save_val_reconstructions:
+                print(f'Epoch {epoch + 1} val reconstructions queued!')
+
+        save_resume(args, epoch + 1, 0, net, optimizer, LRscheduler, best_val_loss, val_loss_log, 0., augmentor, writer,
+                    best_fast_val_loss=best_fast_val_loss, sampler=loss_sampler)
+
+    telemetry.close()
+    writer.close()
+    cleanup_distributed(args)
@@ -0,0 +1,83 @@
+import os
+import time
+import numpy as np
+import torch
+from pathlib import Path
+
+
+def dummy_inputs(shape, device, acc=4, center_fraction=0.08):
+    """Random k-space with an equispaced mask for one (coils, H, W) geometry."""
+    coils, height, width = shape
+    mask = np.zeros(width, dtype=np.float32)
+    mask[::acc] = 1
+    num_low_freqs = int(round(width * center_fraction))
+    pad = (width - num_low_freqs + 1) // 2
+    mask[pad:pad + num_low_freqs] = 1
+    mask = torch.from_numpy(mask).reshape(1, 1, 1, width, 1).byte().to(device=device)
+    kspace = torch.randn(1, coils, height, width, 2, device=device) * mask
+    return kspace, mask
+
+
+class CompiledModelCache:
+    """
+    Runs a model through torch.compile, specialised per k-space geometry.
+
+    Each (coils, H, W) gets its own static-shape graph, and Inductor's FX graph
+    cache keeps the generated kernels in cache_dir so later processes only pay
+    for loading them. A geometry whose compilation fails falls back to eager;
+    the backward is only compiled when it first runs, so training needs
+    warmup(train=True) to catch its failures too.
+    Everything else (train, eval, parameters, state_dict, ...) is forwarded to
+    the wrapped model, so checkpoints keep their usual keys.
+    """
+
+    def __init__(self, model, cache_dir):
+        self.model = model
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = str(self.cache_dir.resolve())
+        try:
+            import torch._inductor.config as inductor_config
+            inductor_config.fx_graph_cache = True
+        except (ImportError, AttributeError):
+            pass
+        # one graph per geometry, train/eval mode and ensemble member
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        self.compiled = torch.compile(model, dynamic=False)
+        self.failed = set()
+
+    def __getattr__(self, name):
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def __call__(self, masked_kspace, mask, *args, **kwargs):
+        key = tuple(masked_kspace.shape[1:4])
+        if key not in self.failed:
+            try:
+                return self.compiled(masked_kspace, mask, *args, **kwargs)
+            except Exception as e:
+                print(f'Compilation failed for shape {key}, falling back to eager: {e}')
+                self.failed.add(key)
+        return self.model(masked_kspace, mask, *args, **kwargs)
+
+    def warmup(self, shapes, device, train=False):
+        """Compiles (or loads from cache_dir) every geometry before the first real batch."""
+        for shape in shapes:
+            start = time.perf_counter()
+            kspace, mask = dummy_inputs(shape, device)
+            if train:
+                self.model.train()
+                try:
+                    # AOTAutograd compiles the backward on its first call, here rather than mid-epoch
+                    self(kspace, mask).mean().backward()
+                except Exception as e:
+                    print(f'Backward compilation failed for shape {tuple(shape)}, falling back to eager: {e}')
+                    self.failed.add(tuple(shape))
+                self.model.zero_grad(set_to_none=True)
+            else:
+                self.model.eval()
+                with torch.no_grad():
+                    self(kspace, mask)
+            status = 'eager' if tuple(shape) in self.failed else 'compiled'
+            print(f'Warm-up {"x".join(map(str, shape))} ({status}) = {time.perf_counter() - start:.2f}s')
@@ -5,7 +5,8 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from typing import NamedTuple, Optional, Tuple, List
+from typing import Dict, NamedTuple, Optional, Tuple, List
+import contextlib
 import math
 import torch
 import torch.nn as nn
@@ -16,12 +17,249 @@ import torch.distributed as dist
 import numpy as np
 import math
 import fastmri
-from fastmri.data.transforms import center_crop, batched_mask_center
-from fastmri.fftc import ifft2c_new as ifft2c
-from fastmri.fftc import fft2c_new as fft2c
+from fastmri.data.transforms import center_crop, complex_center_crop
+from fastmri.fftc import ifft2c_new, fft2c_new
 from fastmri.coil_combine import rss_complex, rss
 from fastmri.math import complex_abs, complex_mul, complex_conj
 from fastmri.data import transforms
+from utils.model.onnx_export import fft2c_dft, ifft2c_dft
+
+
+# record_function labels for torch.profiler, off unless profiling as every label is a dispatcher call
+_profile_labels = False
+
+
+def set_profile_labels(enabled: bool):
+    global _profile_labels
+    _profile_labels = enabled
+
+
+def profile_label(name: str):
+    if not _profile_labels:
+        return contextlib.nullcontext()
+    return torch.profiler.record_function(name)
+
+
+def fft2c(data: Tensor) -> Tensor:
+    # complex tensors cannot be exported, ONNX gets the DFT op instead
+    if torch.onnx.is_in_onnx_export():
+        return fft2c_dft(data)
+    with profile_label('fft2c'):
+        return fft2c_new(data)
+
+
+def ifft2c(data: Tensor) -> Tensor:
+    if torch.onnx.is_in_onnx_export():
+        return ifft2c_dft(data)
+    with profile_label('ifft2c'):
+        return ifft2c_new(data)
+
+
+def autocast_region(x: Tensor, dtype: Optional[torch.dtype]):
+    """Mixed-precision context for a regulariser, fp32 when dtype is None."""
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=x.device.type, dtype=dtype)
+
+
+class Tiling(NamedTuple):
+    """
+    Tiled regulariser execution, see FIVarNet_n_att.set_tiling.
+
+    Args:
+        tile_size: Longest tile edge, None leaves it to max_bytes.
+        overlap: Pixels shared by neighbouring tiles, blended linearly.
+        max_bytes: Activation memory a regulariser may use at once.
+        norm_passes: Passes over the tiles that measure the whole-image
+            instance norm statistics, see GlobalInstanceNorms. None gives every
+            norm a pass of its own, 0 normalises every tile on its own.
+    """
+
+    tile_size: Optional[int] = None
+    overlap: int = 32
+    max_bytes: Optional[int] = None
+    norm_passes: Optional[int] = None
+
+
+def tile_shape(
+    tiling: Tiling, image: Tensor, chans: int, multiple: int, amp_dtype: Optional[torch.dtype] = None
+) -> Optional[Tuple[int, int]]:
+    """
+    (tile height, tile width) of a regulariser with chans first-level channels
+    on image, None if it runs in one piece. Split edges are kept a multiple of
+    the U-Net downsampling factor so tiles need no padding.
+    """
+    batch, in_chans, height, width = image.shape
+    tile_height, tile_width = height, width
+    if tiling.tile_size is not None:
+        tile_height, tile_width = min(height, tiling.tile_size), min(width, tiling.tile_size)
+    if tiling.max_bytes is not None:
+        # measured no-grad peak of Unet2d / Unet is 6-7.5 * chans floats per pixel plus the input
+        element_size = 2 if amp_dtype is not None else image.element_size()
+        max_pixels = tiling.max_bytes // (batch * (8 * chans + 2 * in_chans) * element_size)
+        if tile_height * tile_width > max_pixels:
+            tile_height = min(tile_height, math.isqrt(max_pixels))
+            tile_width = min(tile_width, max_pixels // max(tile_height, 1))
+    if tile_height == height and tile_width == width:
+        return None
+
+    if tile_height < height:
+        tile_height = tile_height // multiple * multiple
+    if tile_width < width:
+        tile_width = tile_width // multiple * multiple
+    if min(tile_height, tile_width) <= tiling.overlap:
+        raise ValueError(
+            f"Tiles of {tile_height}x{tile_width} do not fit an overlap of {tiling.overlap}, raise the memory cap or lower the overlap"
+        )
+    return tile_height, tile_width
+
+
+def tile_starts(size: int, tile: int, overlap: int, multiple: int = 1) -> List[int]:
+    # starts on the U-Net pooling grid, so every tile downsamples like the whole image
+    step = max((tile - overlap) // multiple, 1) * multiple
+    starts = list(range(0, size - tile, step))
+    return starts + [size - tile]
+
+
+def blend_window(start: int, tile: int, size: int, overlap: int, like: Tensor) -> Tensor:
+    """Tile weights along one axis, ramping down over the overlap with each neighbour."""
+    window = like.new_ones(tile)
+    if overlap > 0:
+        ramp = torch.arange(1, overlap + 1, dtype=like.dtype, device=like.device) / (overlap + 1)
+        if start > 0:
+            window[:overlap] = ramp
+        if start + tile < size:
+            window[-overlap:] = ramp.flip(0)
+    return window
+
+
+def tile_windows(image: Tensor, tile_height: int, tile_width: int, overlap: int, multiple: int):
+    """(top, left, blend window) of every tile of image."""
+    _, _, height, width = image.shape
+    for top in tile_starts(height, tile_height, overlap, multiple):
+        window_y = blend_window(top, tile_height, height, overlap, image)
+        for left in tile_starts(width, tile_width, overlap, multiple):
+            yield top, left, window_y[:, None] * blend_window(left, tile_width, width, overlap, image)[None, :]
+
+
+class StopTile(Exception):
+    """Ends a statistics pass over a tile once the norms it measures are done."""
+
+
+class GlobalInstanceNorms:
+    """
+    Lets the instance norms of a tiled regulariser normalise every tile with
+    the statistics of the whole image, as the untiled run does. A norm's input
+    depends on the norms before it, so they are measured in execution order:
+    each measure() pass runs the tiles up to the last norm of the next group,
+    sums the inputs of that group weighted by the tile's blend window and fixes
+    their mean and variance. Norms after the group still normalise every tile
+    on its own. With a group per norm the statistics match the untiled run up
+    to the tile borders.
+    """
+
+    def __init__(self, norms: List[nn.Module]):
+        self.norms = norms
+        self.order: List[nn.Module] = []
+        self.stats: Dict[nn.Module, Tuple[Tensor, Tensor]] = {}
+        self.group: List[nn.Module] = []
+        self.sums: Dict[nn.Module, List[Tensor]] = {}
+        self.window: Optional[Tensor] = None
+        self.recording = False
+        self.handles = []
+
+    def __enter__(self):
+        self.handles = [norm.register_forward_hook(self.hook) for norm in self.norms]
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def hook(self, norm: nn.Module, inputs: Tuple[Tensor], output: Tensor) -> Tensor:
+        x = inputs[0]
+        if self.recording:
+            self.order.append(norm)
+        if norm in self.group:
+            # the window at the resolution of this norm, float64 as the sums run over the whole image
+            weight = F.interpolate(self.window[None, None], size=x.shape[-2:], mode="area").double()
+            values = x.double()
+            sums = self.sums.setdefault(norm, [0.0, 0.0, 0.0])
+            sums[0] = sums[0] + weight.sum()
+            sums[1] = sums[1] + (values * weight).sum(dim=(-2, -1))
+            sums[2] = sums[2] + (values * values * weight).sum(dim=(-2, -1))
+            if norm is self.group[-1]:
+                raise StopTile
+        if norm not in self.stats:
+            return output
+        mean, var = self.stats[norm]
+        return ((x.float() - mean) * torch.rsqrt(var + norm.eps)).to(output.dtype)
+
+    def measure(self, fn, tiles: List[Tuple[Tensor, Tensor]], passes: Optional[int]):
+        """Whole-image statistics of every norm from passes runs over tiles, a list of (tile, blend window)."""
+        self.recording = True
+        fn(tiles[0][0])
+        self.recording = False
+        passes = len(self.order) if passes is None else min(passes, len(self.order))
+        for i in range(passes):
+            self.group = self.order[i * len(self.order) // passes : (i + 1) * len(self.order) // passes]
+            self.sums = {}
+            for tile, window in tiles:
+                self.window = window
+                try:
+                    fn(tile)
+                except StopTile:
+                    pass
+            for norm, (weight, weighted, squares) in self.sums.items():
+                mean = weighted / weight
+                var = (squares / weight - mean * mean).clamp(min=0)
+                self.stats[norm] = (mean.float()[..., None, None], var.float()[..., None, None])
+        self.group, self.sums, self.window = [], {}, None
+
+
+def tiled_apply(
+    fn,
+    image: Tensor,
+    tile_height: int,
+    tile_width: int,
+    overlap: int,
+    multiple: int = 1,
+    norms: List[nn.Module] = (),
+    norm_passes: Optional[int] = 0,
+) -> Tensor:
+    """
+    fn over overlapping tiles of image, the seams are a weighted average of
+    the tiles covering them. fn must keep the spatial size. The instance norms
+    in norms get whole-image statistics from norm_passes passes over the tiles
+    first, see GlobalInstanceNorms.
+    """
+    _, _, height, width = image.shape
+    windows = list(tile_windows(image, tile_height, tile_width, overlap, multiple))
+    tiles = [(image[..., top : top + tile_height, left : left + tile_width], window) for top, left, window in windows]
+    output = weight = None
+    with GlobalInstanceNorms(list(norms) if norm_passes != 0 else []) as global_norms:
+        if global_norms.norms:
+            global_norms.measure(fn, tiles, norm_passes)
+        for (top, left, window), (tile, _) in zip(windows, tiles):
+            tile = fn(tile)
+            if output is None:
+                output = tile.new_zeros(tile.shape[0], tile.shape[1], height, width)
+                weight = tile.new_zeros(height, width)
+            output[..., top : top + tile_height, left : left + tile_width] += tile * window
+            weight[top : top + tile_height, left : left + tile_width] += window
+    return output / weight
+
+
+def instance_norms(module: nn.Module) -> List[nn.Module]:
+    return [m for m in module.modules() if isinstance(m, nn.InstanceNorm2d)]
+
+
+def mask_center_lines(x: Tensor, mask_from: Tensor, mask_to: Tensor) -> Tensor:
+    """batched_mask_center without Python-side indexing, so it traces and exports."""
+    cols = torch.arange(x.shape[-2], device=x.device).view(1, 1, 1, -1, 1)
+    keep = (cols >= mask_from.view(-1, 1, 1, 1, 1)) & (cols < mask_to.view(-1, 1, 1, 1, 1))
+    return x * keep
 
 
 def image_crop(image: Tensor, crop_size: Optional[Tuple[int, int]] = None) -> Tensor:
@@ -42,14 +280,16 @@ def _calc_uncrop(crop_height: int, in_height: int) -> Tuple[int, int]:
     return pad_height_top, pad_height
 
 
-def image_uncrop(image: Tensor, original_image: Tensor) -> Tensor:
+def image_uncrop(image: Tensor, original_image: Tensor, inplace: bool = False) -> Tensor:
     """Insert values back into original image."""
     in_shape = original_image.shape
-    original_image = original_image.clone()
 
     if in_shape == image.shape:
         return image
 
+    if not inplace:
+        original_image = original_image.clone()
+
     pad_height_top, pad_height = _calc_uncrop(image.shape[-2], in_shape[-2])
     pad_height_left, pad_width = _calc_uncrop(image.shape[-1], in_shape[-1])
 
@@ -73,15 +313,35 @@ def image_uncrop(image: Tensor, original_image: Tensor) -> Tensor:
     return original_image
 
 
+def complex_image_crop(image: Tensor, crop_size: Optional[Tuple[int, int]] = None) -> Tensor:
+    if crop_size is None:
+        return image
+    return complex_center_crop(image, crop_size).contiguous()
+
+
+def complex_image_uncrop(image: Tensor, in_shape: torch.Size) -> Tensor:
+    """Zero-fill a complex (last dim 2) image back to in_shape."""
+    if in_shape == image.shape:
+        return image
+
+    pad_height_top, pad_height = _calc_uncrop(image.shape[-3], in_shape[-3])
+    pad_width_left, pad_width = _calc_uncrop(image.shape[-2], in_shape[-2])
+
+    output = image.new_zeros(in_shape)
+    output[..., pad_height_top:pad_height, pad_width_left:pad_width, :] = image
+
+    return output
+
+
 def norm_fn(image: Tensor, means: Tensor, variances: Tensor) -> Tensor:
-    means = means.view(1, -1, 1, 1)
-    variances = variances.view(1, -1, 1, 1)
+    means = means.view(*means.shape, 1, 1)
+    variances = variances.view(*variances.shape, 1, 1)
     return (image - means) * torch.rsqrt(variances)
 
 
 def unnorm_fn(image: Tensor, means: Tensor, variances: Tensor) -> Tensor:
-    means = means.view(1, -1, 1, 1)
-    variances = variances.view(1, -1, 1, 1)
+    means = means.view(*means.shape, 1, 1)
+    variances = variances.view(*variances.shape, 1, 1)
     return image * torch.sqrt(variances) + means
 
 
@@ -109,23 +369,50 @@ def sens_reduce(x: Tensor, sens_maps: Tensor) -> Tensor:
     )
 
 
+class ChannelsLastInstanceNorm2d(nn.InstanceNorm2d):
+    """
+    InstanceNorm2d that keeps channels_last activations in channels_last.
+    instance_norm returns NCHW for them, a group norm with one channel per group
+    is the same normalisation and has an NHWC kernel.
+    """
+
+    def forward(self, input: Tensor) -> Tensor:
+        if input.dim() == 4 and not input.is_contiguous() and input.is_contiguous(memory_format=torch.channels_last):
+            return F.group_norm(input, input.shape[1], eps=self.eps)
+        return super().forward(input)
+
+
+def set_channels_last(module: nn.Module, enabled: bool = True):
+    """
+    Keep the conv activations of every Unet2d / NormUnet below module in channels_last.
+    Conv weights are converted and the (affine-free) instance norms swapped for
+    ChannelsLastInstanceNorm2d. Tensors go back to NCHW where the channels are
+    split into complex pairs before the FFTs.
+    """
+    memory_format = torch.channels_last if enabled else torch.contiguous_format
+    norm_type = ChannelsLastInstanceNorm2d if enabled else nn.InstanceNorm2d
+    for submodule in module.modules():
+        if isinstance(submodule, (Unet2d, NormUnet)):
+            submodule.memory_format = memory_format
+        if isinstance(submodule, (nn.Conv2d, nn.ConvTranspose2d)):
+            submodule.to(memory_format=memory_format)
+        for name, child in submodule.named_children():
+            if type(child) in (nn.InstanceNorm2d, ChannelsLastInstanceNorm2d):
+                setattr(submodule, name, norm_type(child.num_features, eps=child.eps))
+
+
 class NormStats(nn.Module):
     def forward(self, data: Tensor) -> Tuple[Tensor, Tensor]:
-        # group norm
+        # group norm, statistics of every slice of the batch on its own
         batch, chans, _, _ = data.shape
 
-        if batch != 1:
-            raise ValueError("Unexpected input dimensions.")
-
-        data = data.view(chans, -1)
+        data = data.reshape(batch, chans, -1)
 
-        mean = data.mean(dim=1)
-        variance = data.var(dim=1, unbiased=False)
+        mean = data.mean(dim=2)
+        variance = data.var(dim=2, unbiased=False)
 
-        assert mean.ndim == 1
-        assert variance.ndim == 1
-        assert mean.shape[0] == chans
-        assert variance.shape[0] == chans
+        assert mean.shape == (batch, chans)
+        assert variance.shape == (batch, chans)
 
         return mean, variance
 
@@ -157,8 +444,8 @@ class FeatureEncoder(nn.Module):
         )
 
     def forward(self, image: Tensor, means: Tensor, variances: Tensor) -> Tensor:
-        means = means.view(1, -1, 1, 1)
-        variances = variances.view(1, -1, 1, 1)
+        means = means.view(*means.shape, 1, 1)
+        variances = variances.view(*variances.shape, 1, 1)
         return self.encoder((image - means) * torch.rsqrt(variances))
 
 
@@ -176,8 +463,8 @@ class FeatureDecoder(nn.Module):
         )
 
     def forward(self, features: Tensor, means: Tensor, variances: Tensor) -> Tensor:
-        means = means.view(1, -1, 1, 1)
-        variances = variances.view(1, -1, 1, 1)
+        means = means.view(*means.shape, 1, 1)
+        variances = variances.view(*variances.shape, 1, 1)
         return self.decoder(features) * torch.sqrt(variances) + means
 
 
@@ -197,6 +484,7 @@ class Unet(nn.Module):
         chans: int = 32,
         num_pool_layers: int = 4,
         drop_prob: float = 0.0,
+        separable: bool = False,
     ):
         """
         Args:
@@ -205,6 +493,7 @@ class Unet(nn.Module):
             chans: Number of output channels of the first convolution layer.
             num_pool_layers: Number of down-sampling and up-sampling layers.
             drop_prob: Dropout probability.
+            separable: Use depthwise-separable conv blocks.
         """
         super().__init__()
 
@@ -213,25 +502,26 @@ class Unet(nn.Module):
         self.chans = chans
         self.num_pool_layers = num_pool_layers
         self.drop_prob = drop_prob
+        block = SeparableConvBlock if separable else ConvBlock
 
-        self.down_sample_layers = nn.ModuleList([ConvBlock(in_chans, chans, drop_prob)])
+        self.down_sample_layers = nn.ModuleList([block(in_chans, chans, drop_prob)])
         ch = chans
         for _ in range(num_pool_layers - 1):
-            self.down_sample_layers.append(ConvBlock(ch, ch * 2, drop_prob))
+            self.down_sample_layers.append(block(ch, ch * 2, drop_prob))
             ch *= 2
-        self.conv = ConvBlock(ch, ch * 2, drop_prob)
+        self.conv = block(ch, ch * 2, drop_prob)
 
         self.up_conv = nn.ModuleList()
         self.up_transpose_conv = nn.ModuleList()
         for _ in range(num_pool_layers - 1):
             self.up_transpose_conv.append(TransposeConvBlock(ch * 2, ch))
-            self.up_conv.append(ConvBlock(ch * 2, ch, drop_prob))
+            self.up_conv.append(block(ch * 2, ch, drop_prob))
             ch //= 2
 
         self.up_transpose_conv.append(TransposeConvBlock(ch * 2, ch))
         self.up_conv.append(
             nn.Sequential(
-                ConvBlock(ch * 2, ch, drop_prob),
+                block(ch * 2, ch, drop_prob),
                 nn.Conv2d(ch, self.out_chans, kernel_size=1, stride=1),
             )
         )
@@ -322,6 +612,48 @@ class ConvBlock(nn.Module):
         return self.layers(image)
 
 
+class SeparableConvBlock(nn.Module):
+    """
+    ConvBlock with every 3x3 convolution split into a depthwise 3x3 and a
+    pointwise 1x1 convolution, about 1/9 of the weights and FLOPs at equal width.
+    """
+
+    def __init__(self, in_chans: int, out_chans: int, drop_prob: float):
+        """
+        Args:
+            in_chans: Number of channels in the input.
+            out_chans: Number of channels in the output.
+            drop_prob: Dropout probability.
+        """
+        super().__init__()
+
+        self.in_chans = in_chans
+        self.out_chans = out_chans
+        self.drop_prob = drop_prob
+
+        self.layers = nn.Sequential(
+            nn.Conv2d(in_chans, in_chans, kernel_size=3, padding=1, groups=in_chans, bias=False),
+            nn.Conv2d(in_chans, out_chans, kernel_size=1, bias=False),
+            nn.InstanceNorm2d(out_chans),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+            nn.Dropout2d(drop_prob),
+            nn.Conv2d(out_chans, out_chans, kernel_size=3, padding=1, groups=out_chans, bias=False),
+            nn.Conv2d(out_chans, out_chans, kernel_size=1, bias=False),
+            nn.InstanceNorm2d(out_chans),
+            nn.LeakyReLU(negative_slope=0.2, inplace=True),
+            nn.Dropout2d(drop_prob),
+        )
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            image: Input 4D tensor of shape `(N, in_chans, H, W)`.
+        Returns:
+            Output tensor of shape `(N, out_chans, H, W)`.
+        """
+        return self.layers(image)
+
+
 class TransposeConvBlock(nn.Module):
     """
     A Transpose Convolutional Block that consists of one convolution transpose
@@ -373,6 +705,7 @@ class NormUnet(nn.Module):
         in_chans: int = 2,
         out_chans: int = 2,
         drop_prob: float = 0.0,
+        separable: bool = False,
     ):
         """
         Args:
@@ -381,6 +714,7 @@ class NormUnet(nn.Module):
             in_chans: Number of channels in the input to the U-Net model.
             out_chans: Number of channels in the output to the U-Net model.
             drop_prob: Dropout probability.
+            separable: Use depthwise-separable conv blocks.
         """
         super().__init__()
 
@@ -390,7 +724,16 @@ class NormUnet(nn.Module):
             chans=chans,
             num_pool_layers=num_pools,
             drop_prob=drop_prob,
+            separable=separable,
         )
+        self.fast_inference = False
+        # zero-bordered padding buffers per input shape, only used under fast_inference
+        self.pad_workspaces = {}
+        # autocast dtype of the U-Net, normalisation statistics stay fp32
+        self.amp_dtype: Optional[torch.dtype] = None
+        self.memory_format = torch.contiguous_format
+        # tiled U-Net at inference, the input normalisation and the instance norms use whole-image statistics
+        self.tiling: Optional[Tiling] = None
 
     def complex_to_chan_dim(self, x: torch.Tensor) -> torch.Tensor:
         b, c, h, w, two = x.shape
@@ -424,10 +767,23 @@ class NormUnet(nn.Module):
         self, x: torch.Tensor
     ) -> Tuple[torch.Tensor, Tuple[List[int], List[int], int, int]]:
         _, _, h, w = x.shape
-        w_mult = ((w - 1) | 15) + 1
-        h_mult = ((h - 1) | 15) + 1
-        w_pad = [math.floor((w_mult - w) / 2), math.ceil((w_mult - w) / 2)]
-        h_pad = [math.floor((h_mult - h) / 2), math.ceil((h_mult - h) / 2)]
+        # integer arithmetic only, shapes are traced tensors during ONNX export
+        w_mult = (w + 15) // 16 * 16
+        h_mult = (h + 15) // 16 * 16
+        w_pad = [(w_mult - w) // 2, w_mult - w - (w_mult - w) // 2]
+        h_pad = [(h_mult - h) // 2, h_mult - h - (h_mult - h) // 2]
+        if h_mult == h and w_mult == w:
+            return x, (h_pad, w_pad, h_mult, w_mult)
+
+        if self.fast_inference and not torch.is_grad_enabled():
+            # the border of the workspace is never written, so it stays zero
+            key = (x.shape, x.dtype, x.device)
+            if key not in self.pad_workspaces:
+                self.pad_workspaces[key] = x.new_zeros(x.shape[0], x.shape[1], h_mult, w_mult)
+            workspace = self.pad_workspaces[key]
+            workspace[..., h_pad[0] : h_mult - h_pad[1], w_pad[0] : w_mult - w_pad[1]].copy_(x)
+            return workspace, (h_pad, w_pad, h_mult, w_mult)
+
         # TODO: fix this type when PyTorch fixes theirs
         # the documentation lies - this actually takes a list
         # https://github.com/pytorch/pytorch/blob/master/torch/nn/functional.py#L3457
@@ -446,6 +802,12 @@ class NormUnet(nn.Module):
     ) -> torch.Tensor:
         return x[..., h_pad[0] : h_mult - h_pad[1], w_pad[0] : w_mult - w_pad[1]]
 
+    def run_unet(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.contiguous(memory_format=self.memory_format)
+        with autocast_region(x, self.amp_dtype):
+            x = self.unet(x)
+        return x.float()
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         if not x.shape[-1] == 2:
             raise ValueError("Last dimension must be 2 for complex.")
@@ -455,7 +817,16 @@ class NormUnet(nn.Module):
         x, mean, std = self.norm(x)
         x, pad_sizes = self.pad(x)
 
-        x = self.unet(x)
+        tiles = None
+        if self.tiling is not None and not torch.is_grad_enabled():
+            tiles = tile_shape(self.tiling, x, self.unet.chans, 2**self.unet.num_pool_layers, self.amp_dtype)
+        if tiles is not None:
+            x = tiled_apply(
+                self.run_unet, x, *tiles, self.tiling.overlap, 2**self.unet.num_pool_layers,
+                instance_norms(self.unet), self.tiling.norm_passes,
+            )
+        else:
+            x = self.run_unet(x)
 
         # get shapes back and unnormalize
         x = self.unpad(x, *pad_sizes)
@@ -482,6 +853,7 @@ class SensitivityModel(nn.Module):
         out_chans: int = 2,
         drop_prob: float = 0.0,
         mask_center: bool = True,
+        acs_crop: bool = False,
     ):
         """
         Args:
@@ -492,9 +864,13 @@ class SensitivityModel(nn.Module):
             drop_prob: Dropout probability.
             mask_center: Whether to mask center of k-space for sensitivity map
                 calculation.
+            acs_crop: Whether to crop the ACS lines out of k-space and run the
+                U-Net on the low-resolution coil images. The sensitivities are
+                brought back to full size by zero-padding in k-space.
         """
         super().__init__()
         self.mask_center = mask_center
+        self.acs_crop = acs_crop
         self.norm_unet = NormUnet(
             chans,
             num_pools,
@@ -517,28 +893,46 @@ class SensitivityModel(nn.Module):
     def divide_root_sum_of_squares(self, x: torch.Tensor) -> torch.Tensor:
         return x / fastmri.rss_complex(x, dim=1).unsqueeze(-1).unsqueeze(1)
 
+    def get_pad_and_num_low_freqs(self, mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # get low frequency line locations
+        squeezed_mask = mask[:, 0, 0, :, 0].byte()
+        cent = squeezed_mask.shape[1] // 2
+        # running argmin returns the first non-zero
+        left = torch.argmin(squeezed_mask[:, :cent].flip(1), dim=1)
+        right = torch.argmin(squeezed_mask[:, cent:], dim=1)
+        num_low_freqs = torch.max(
+            2 * torch.min(left, right), torch.ones_like(left)
+        )  # force a symmetric center unless 1
+        pad = (mask.shape[-2] - num_low_freqs + 1) // 2
+
+        return pad, num_low_freqs
+
+    def upsample_from_acs(self, x: torch.Tensor, left: int, width: int) -> torch.Tensor:
+        # zero-pad the low-resolution maps back to full width in k-space
+        right = width - left - x.shape[-2]
+        return ifft2c(F.pad(fft2c(x), (0, 0, left, right)))
+
     def forward(self, masked_kspace: torch.Tensor, mask: torch.Tensor, num_low_frequencies: int = None) -> torch.Tensor:
-        if self.mask_center:
-            # get low frequency line locations and mask them out
-            squeezed_mask = mask[:, 0, 0, :, 0]
-            cent = squeezed_mask.shape[1] // 2
-            # running argmin returns the first non-zero
-            left = torch.argmin(squeezed_mask[:, :cent].flip(1), dim=1)
-            right = torch.argmin(squeezed_mask[:, cent:], dim=1)
-            num_low_freqs = torch.max(
-                2 * torch.min(left, right), torch.ones_like(left)
-            )  # force a symmetric center unless 1
-            pad = (mask.shape[-2] - num_low_freqs + 1) // 2
-
-            masked_kspace = transforms.batched_mask_center(masked_kspace, pad, pad + num_low_freqs)
+        if self.mask_center or self.acs_crop:
+            pad, num_low_freqs = self.get_pad_and_num_low_freqs(mask)
+            masked_kspace = mask_center_lines(masked_kspace, pad, pad + num_low_freqs)
+
+        if self.acs_crop:
+            # the whole batch shares the widest ACS region
+            width = masked_kspace.shape[-2]
+            num_acs = int(num_low_freqs.max())
+            left = (width - num_acs + 1) // 2
+            masked_kspace = masked_kspace[..., left : left + num_acs, :]
 
         # convert to image space
-        x = fastmri.ifft2c(masked_kspace)
+        x = ifft2c(masked_kspace)
         x, b = self.chans_to_batch_dim(x)
 
         # estimate sensitivities
         x = self.norm_unet(x)
         x = self.batch_chans_to_chan_dim(x, b)
+        if self.acs_crop:
+            x = self.upsample_from_acs(x, left, width)
         x = self.divide_root_sum_of_squares(x)
 
         return x
@@ -563,29 +957,50 @@ class VarNetBlock(nn.Module):
 
         self.model = model
         self.dc_weight = nn.Parameter(torch.ones(1))
+        self.fast_inference = False
+
+        self.zero: Tensor
+        self.register_buffer("zero", torch.zeros(1, 1, 1, 1, 1), persistent=False)
 
     def sens_expand(self, x: torch.Tensor, sens_maps: torch.Tensor) -> torch.Tensor:
-        return fastmri.fft2c(fastmri.complex_mul(x, sens_maps))
+        return fft2c(fastmri.complex_mul(x, sens_maps))
 
     def sens_reduce(self, x: torch.Tensor, sens_maps: torch.Tensor) -> torch.Tensor:
-        x = fastmri.ifft2c(x)
+        x = ifft2c(x)
         return fastmri.complex_mul(x, fastmri.complex_conj(sens_maps)).sum(
             dim=1, keepdim=True
         )
 
+    def apply_model_with_crop(
+        self, image: torch.Tensor, crop_size: Optional[Tuple[int, int]]
+    ) -> torch.Tensor:
+        # regularise the returned ROI only, no model term outside of it
+        if crop_size is not None:
+            return complex_image_uncrop(
+                self.model(complex_image_crop(image, crop_size)), image.shape
+            )
+
+        return self.model(image)
+
     def forward(
         self,
         current_kspace: torch.Tensor,
         ref_kspace: torch.Tensor,
         mask: torch.Tensor,
         sens_maps: torch.Tensor,
+        crop_size: Optional[Tuple[int, int]] = None,
     ) -> torch.Tensor:
-        zero = torch.zeros(1, 1, 1, 1, 1).to(current_kspace)
-        soft_dc = torch.where(mask, current_kspace - ref_kspace, zero) * self.dc_weight
         model_term = self.sens_expand(
-            self.model(self.sens_reduce(current_kspace, sens_maps)), sens_maps
+            self.apply_model_with_crop(self.sens_reduce(current_kspace, sens_maps), crop_size),
+            sens_maps,
         )
 
+        if self.fast_inference and not torch.is_grad_enabled():
+            soft_dc = (current_kspace - ref_kspace).mul_(mask).mul_(self.dc_weight)
+            return model_term.neg_().add_(current_kspace).sub_(soft_dc)
+
+        soft_dc = torch.where(mask, current_kspace - ref_kspace, self.zero) * self.dc_weight
+
         return current_kspace - soft_dc - model_term
 
 
@@ -599,11 +1014,16 @@ class Unet2d(nn.Module):
         num_pool_layers: int = 4,
         drop_prob: float = 0.0,
         output_bias: bool = False,
+        separable: bool = False,
     ):
         super().__init__()
         self.in_chans = in_chans
         self.out_planes = out_chans
         self.factor = 2**num_pool_layers
+        self.chans = chans
+        self.amp_dtype: Optional[torch.dtype] = None
+        self.memory_format = torch.contiguous_format
+        self.tiling: Optional[Tiling] = None
 
         # Build from the middle of the UNet outwards
         planes = 2 ** (num_pool_layers)
@@ -615,10 +1035,11 @@ class Unet2d(nn.Module):
                 in_planes=planes * chans,
                 out_planes=2 * planes * chans,
                 drop_prob=drop_prob,
+                separable=separable,
             )
 
         self.layer = UnetLevel(
-            layer, in_planes=in_chans, out_planes=chans, drop_prob=drop_prob
+            layer, in_planes=in_chans, out_planes=chans, drop_prob=drop_prob, separable=separable
         )
 
         if output_bias:
@@ -657,8 +1078,24 @@ class Unet2d(nn.Module):
         return image, (height, width)
 
     def forward(self, image: Tensor) -> Tensor:
+        if self.tiling is not None and not torch.is_grad_enabled():
+            # padded as a whole first, so the tiles sit on the same pooling grid as the untiled run
+            padded, (output_y, output_x) = self.pad_input_image(image)
+            tiles = tile_shape(self.tiling, padded, self.chans, self.factor, self.amp_dtype)
+            if tiles is not None:
+                output = tiled_apply(
+                    self.run_unet, padded, *tiles, self.tiling.overlap, self.factor,
+                    instance_norms(self), self.tiling.norm_passes,
+                )
+                return output[:, :, :output_y, :output_x]
+        return self.run_unet(image)
+
+    def run_unet(self, image: Tensor) -> Tensor:
         image, (output_y, output_x) = self.pad_input_image(image)
-        return self.final_conv(self.layer(image))[:, :, :output_y, :output_x]
+        image = image.contiguous(memory_format=self.memory_format)
+        with autocast_region(image, self.amp_dtype):
+            output = self.final_conv(self.layer(image))
+        return output.float()[:, :, :output_y, :output_x]
 
 
 class UnetLevel(nn.Module):
@@ -668,12 +1105,14 @@ class UnetLevel(nn.Module):
         in_planes: int,
         out_planes: int,
         drop_prob: float = 0.0,
+        separable: bool = False,
     ):
         super().__init__()
         self.in_planes = in_planes
         self.out_planes = out_planes
+        block = SeparableConvBlock if separable else ConvBlock
 
-        self.left_block = ConvBlock(
+        self.left_block = block(
             in_chans=in_planes, out_chans=out_planes, drop_prob=drop_prob
         )
 
@@ -688,7 +1127,7 @@ class UnetLevel(nn.Module):
             else:
                 raise TypeError("Child must be an instance of UnetLevel")
 
-            self.right_block = ConvBlock(
+            self.right_block = block(
                 in_chans=2 * out_planes, out_chans=out_planes, drop_prob=drop_prob
             )
 
@@ -721,6 +1160,9 @@ class FIVarNet_n_att(nn.Module):
         mask_center: bool = True,
         image_conv_cascades: Optional[List[int]] = None,
         kspace_mult_factor: float = 1e6,
+        sens_acs_crop: bool = False,
+        roi_crop: bool = False,
+        separable: bool = False,
     ):
         super().__init__()
         if image_conv_cascades is None:
@@ -728,10 +1170,14 @@ class FIVarNet_n_att(nn.Module):
 
         self.image_conv_cascades = image_conv_cascades
         self.kspace_mult_factor = kspace_mult_factor
+        # size of the returned image, regularisers run on this region when roi_crop is set
+        self.output_size = (384, 384)
+        self.roi_crop = roi_crop
         self.sens_net = SensitivityModel(
             chans=sens_chans,
             num_pools=sens_pools,
             mask_center=mask_center,
+            acs_crop=sens_acs_crop,
         )
         self.encoder = FeatureEncoder(in_chans=2, feature_chans=chans)
         self.decoder = FeatureDecoder(feature_chans=chans, out_chans=2)
@@ -743,19 +1189,86 @@ class FIVarNet_n_att(nn.Module):
                     encoder=self.encoder,
                     decoder=self.decoder,
                     feature_processor=Unet2d(
-                        in_chans=chans, out_chans=chans, chans=unet_chans, num_pool_layers=pools
+                        in_chans=chans, out_chans=chans, chans=unet_chans, num_pool_layers=pools, separable=separable
                     ),
                     use_extra_feature_conv=use_image_conv,
                 )
             )
 
         self.image_cascades = nn.ModuleList(
-            [VarNetBlock(NormUnet(unet_chans, pools)) for _ in range(num_cascades)]
+            [VarNetBlock(NormUnet(unet_chans, pools, separable=separable)) for _ in range(num_cascades)]
         )
 
         self.decode_norm = nn.InstanceNorm2d(chans)
         self.cascades = nn.Sequential(*cascades)
         self.norm_fn = NormStats()
+        # early exit at inference, see set_early_exit
+        self.exit_threshold: Optional[float] = None
+        self.cascades_used = 0
+
+    def set_fast_inference(self, enabled: bool = True):
+        """
+        Reuse buffers and update tensors in place while gradients are disabled.
+        Has no effect on training or on forward passes with autograd enabled.
+        """
+        for module in self.modules():
+            if isinstance(module, (FeatureVarNetBlock, VarNetBlock, NormUnet)):
+                module.fast_inference = enabled
+                if not enabled and isinstance(module, NormUnet):
+                    module.pad_workspaces.clear()
+
+    def set_amp_dtype(self, dtype: Optional[torch.dtype] = torch.bfloat16):
+        """
+        Run the convs and normalisation of every Unet2d / NormUnet under autocast.
+        FFTs, data consistency, NormStats and the k-space scaling stay fp32.
+        """
+        for module in self.modules():
+            if isinstance(module, (Unet2d, NormUnet)):
+                module.amp_dtype = dtype
+
+    def set_early_exit(self, threshold: Optional[float]):
+        """
+        Stop after the first cascade whose relative k-space update
+        ||k_new - k_old|| / ||k_old|| is below threshold, None runs every cascade.
+        Only applies with gradients disabled; cascades_used holds the count of the
+        last forward pass.
+        """
+        self.exit_threshold = threshold
+
+    def set_tiling(
+        self,
+        tile_size: Optional[int] = None,
+        overlap: int = 32,
+        max_memory_mb: Optional[float] = None,
+        norm_passes: Optional[int] = None,
+    ):
+        """
+        Run every Unet2d / NormUnet (sensitivity U-Net included) on overlapping
+        tiles while gradients are disabled, blending the seams. Encoder, decoder,
+        FFTs and data consistency still see the whole slice. Tiles are at most
+        tile_size wide and sized to keep the activations of one regulariser
+        under max_memory_mb. Nothing is tiled if both are None. The instance
+        norms use whole-image statistics measured in norm_passes extra passes
+        over the tiles, one per norm if None; fewer passes are faster and less
+        exact.
+        """
+        tiling = None
+        if tile_size is not None or max_memory_mb is not None:
+            max_bytes = None if max_memory_mb is None else int(max_memory_mb * 2**20)
+            tiling = Tiling(tile_size=tile_size, overlap=overlap, max_bytes=max_bytes, norm_passes=norm_passes)
+        for module in self.modules():
+            if isinstance(module, (Unet2d, NormUnet)):
+                module.tiling = tiling
+
+    def set_channels_last(self, enabled: bool = True, sens_net: bool = False):
+        """
+        Run the regularisers in channels_last. The sensitivity U-Net only has
+        sens_chans channels, too few for NHWC convs to pay off, so it is left
+        in NCHW unless sens_net is set.
+        """
+        set_channels_last(self, enabled)
+        if enabled and not sens_net:
+            set_channels_last(self.sens_net, False)
 
     def _decode_output(self, feature_image: FeatureImage) -> Tensor:
         image = self.decoder(
@@ -772,7 +1285,8 @@ class FIVarNet_n_att(nn.Module):
         crop_size: Optional[Tuple[int, int]],
         num_low_frequencies: Optional[int],
     ) -> FeatureImage:
-        sens_maps = self.sens_net(masked_kspace, mask, num_low_frequencies)
+        with profile_label('sens_net'):
+            sens_maps = self.sens_net(masked_kspace, mask, num_low_frequencies)
         image = sens_reduce(masked_kspace, sens_maps)
         # detect FLAIR 203
         if crop_size is not None and image.shape[-1] < crop_size[1]:
@@ -790,14 +1304,87 @@ class FIVarNet_n_att(nn.Module):
             mask=mask,
         )
 
+    def _kspace_to_image(self, kspace_pred: Tensor) -> Tensor:
+        # Divide with k-space factor and Return Final Image
+        kspace_pred = (
+            kspace_pred / self.kspace_mult_factor
+        )  # Ensure kspace_pred is a Tensor
+        result = rss(
+            complex_abs(ifft2c(kspace_pred)), dim=1
+        )  # Ensure kspace_pred is a Tensor
+        height = result.shape[-2]
+        width = result.shape[-1]
+        out_height, out_width = self.output_size
+        return result[..., (height - out_height) // 2 : out_height + (height - out_height) // 2, (width - out_width) // 2 : out_width + (width - out_width) // 2]
+
+    @staticmethod
+    def _relative_update(new_kspace: Tensor, old_kspace: Tensor) -> float:
+        # worst slice of the batch decides
+        update = (new_kspace - old_kspace).flatten(1).norm(dim=1)
+        return (update / old_kspace.flatten(1).norm(dim=1)).max().item()
+
+    def _run_cascades_monitored(
+        self, feature_image: FeatureImage, mask: Tensor, return_intermediate: bool
+    ) -> Tuple[Tensor, List[Tensor]]:
+        """
+        Feature then image cascades, decoding to k-space after every one of them.
+        Returns the last k-space and, if return_intermediate, the image after
+        every cascade. Stops early under set_early_exit.
+        """
+        check_exit = self.exit_threshold is not None and not torch.is_grad_enabled()
+        kspace_pred = feature_image.ref_kspace
+        intermediate = []
+        self.cascades_used = 0
+
+        for i, cascade in enumerate(self.cascades):
+            with profile_label(f'feature_cascade{i}'):
+                feature_image = cascade(feature_image)
+            new_kspace = self._decode_output(feature_image)
+            self.cascades_used += 1
+            if return_intermediate:
+                intermediate.append(self._kspace_to_image(new_kspace))
+            converged = check_exit and self._relative_update(new_kspace, kspace_pred) < self.exit_threshold
+            kspace_pred = new_kspace
+            if converged:
+                return kspace_pred, intermediate
+
+        for i, cascade in enumerate(self.image_cascades):
+            with profile_label(f'image_cascade{i}'):
+                new_kspace = cascade(
+                    kspace_pred,
+                    feature_image.ref_kspace,
+                    mask,
+                    feature_image.sens_maps,
+                    feature_image.crop_size,
+                )
+            self.cascades_used += 1
+            if return_intermediate:
+                intermediate.append(self._kspace_to_image(new_kspace))
+            converged = check_exit and self._relative_update(new_kspace, kspace_pred) < self.exit_threshold
+            kspace_pred = new_kspace
+            if converged:
+                break
+
+        return kspace_pred, intermediate
+
     def forward(
         self,
         masked_kspace: Tensor,
         mask: Tensor,
         num_low_frequencies: Optional[int] = None,
         crop_size: Optional[Tuple[int, int]] = None,
-    ) -> Tensor:
+        return_intermediate: bool = False,
+    ):
+        """
+        Returns the reconstruction, or with return_intermediate the list of
+        reconstructions after every feature and image cascade (the last one
+        being the final output), for deep supervision of the early exits.
+        """
         masked_kspace = masked_kspace * self.kspace_mult_factor
+        # byte masks are deprecated as torch.where conditions and break torch.compile
+        mask = mask.bool()
+        if crop_size is None and self.roi_crop:
+            crop_size = self.output_size
         # Encode to features and get sensitivities
         feature_image = self._encode_input(
             masked_kspace=masked_kspace,
@@ -805,25 +1392,28 @@ class FIVarNet_n_att(nn.Module):
             crop_size=crop_size,
             num_low_frequencies=num_low_frequencies,
         )
+        if return_intermediate or (self.exit_threshold is not None and not torch.is_grad_enabled()):
+            kspace_pred, intermediate = self._run_cascades_monitored(feature_image, mask, return_intermediate)
+            return intermediate if return_intermediate else self._kspace_to_image(kspace_pred)
+
         # Do DC in feature-space
-        feature_image = self.cascades(feature_image)
+        for i, cascade in enumerate(self.cascades):
+            with profile_label(f'feature_cascade{i}'):
+                feature_image = cascade(feature_image)
         # Find last k-space
         kspace_pred = self._decode_output(feature_image)
         # Run E2EVN
-        for cascade in self.image_cascades:
-            kspace_pred = cascade(
-                kspace_pred, feature_image.ref_kspace, mask, feature_image.sens_maps
-            )
-        # Divide with k-space factor and Return Final Image
-        kspace_pred = (
-            kspace_pred / self.kspace_mult_factor
-        )  # Ensure kspace_pred is a Tensor
-        result = rss(
-            complex_abs(ifft2c(kspace_pred)), dim=1
-        )  # Ensure kspace_pred is a Tensor
-        height = result.shape[-2]
-        width = result.shape[-1]
-        return result[..., (height - 384) // 2 : 384 + (height - 384) // 2, (width - 384) // 2 : 384 + (width - 384) // 2]
+        for i, cascade in enumerate(self.image_cascades):
+            with profile_label(f'image_cascade{i}'):
+                kspace_pred = cascade(
+                    kspace_pred,
+                    feature_image.ref_kspace,
+                    mask,
+                    feature_image.sens_maps,
+                    feature_image.crop_size,
+                )
+        self.cascades_used = len(self.cascades) + len(self.image_cascades)
+        return self._kspace_to_image(kspace_pred)
 
 
 class FeatureVarNetBlock(nn.Module):
@@ -840,6 +1430,7 @@ class FeatureVarNetBlock(nn.Module):
         self.feature_processor = feature_processor
         self.use_image_conv = use_extra_feature_conv
         self.dc_weight = nn.Parameter(torch.ones(1))
+        self.fast_inference = False
         feature_chans = self.encoder.feature_chans
 
         self.input_norm = nn.InstanceNorm2d(feature_chans)
@@ -887,9 +1478,13 @@ class FeatureVarNetBlock(nn.Module):
 
         return sens_expand(image, feature_image.sens_maps)
 
-    def compute_dc_term(self, feature_image: FeatureImage) -> Tensor:
+    def compute_dc_term(self, feature_image: FeatureImage, inplace: bool = False) -> Tensor:
         est_kspace = self.decode_to_kspace(feature_image)
 
+        if inplace:
+            residual = est_kspace.sub_(feature_image.ref_kspace).mul_(feature_image.mask)
+            return self.encode_from_kspace(residual, feature_image).mul_(self.dc_weight)
+
         return self.dc_weight * self.encode_from_kspace(
             torch.where(
                 feature_image.mask, est_kspace - feature_image.ref_kspace, self.zero
@@ -897,13 +1492,15 @@ class FeatureVarNetBlock(nn.Module):
             feature_image,
         )
 
-    def apply_model_with_crop(self, feature_image: FeatureImage) -> Tensor:
+    def apply_model_with_crop(self, feature_image: FeatureImage, inplace: bool = False) -> Tensor:
         if feature_image.crop_size is not None:
+            # image_uncrop copies the features unless they may be overwritten
             features = image_uncrop(
                 self.feature_processor(
                     image_crop(feature_image.features, feature_image.crop_size)
                 ),
-                feature_image.features.clone(),
+                feature_image.features,
+                inplace=inplace,
             )
         else:
             features = self.feature_processor(feature_image.features)
@@ -911,23 +1508,23 @@ class FeatureVarNetBlock(nn.Module):
         return features
 
     def forward(self, feature_image: FeatureImage) -> FeatureImage:
+        inplace = self.fast_inference and not torch.is_grad_enabled()
         feature_image = feature_image._replace(
             features=self.input_norm(feature_image.features)
         )
 
-        new_features = feature_image.features - self.compute_dc_term(feature_image)
-        """
-        new_features_np = feature_image.features.cpu().numpy()
-        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        file_name = f'new_features_before_{timestamp}.mat'
-        savemat(file_name, {'new_features_before': new_features_np})
+        if inplace:
+            new_features = feature_image.features - self.compute_dc_term(feature_image, inplace=True)
+            # the normalised features are not needed after this, the uncrop may reuse them
+            new_features.sub_(self.apply_model_with_crop(feature_image, inplace=True))
 
-        new_ref_kspace = feature_image.ref_kspace.cpu().numpy()
-        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        file_name = f'kspace_{timestamp}.mat'
-        savemat(file_name, {'kspace_': new_ref_kspace})
-        """
+            if self.use_image_conv:
+                new_features = self.output_norm(new_features)
+                new_features.add_(self.output_conv(new_features))
 
+            return feature_image._replace(features=new_features)
+
+        new_features = feature_image.features - self.compute_dc_term(feature_image)
         new_features = new_features - self.apply_model_with_crop(feature_image)
 
         if self.use_image_conv:
@@ -0,0 +1,60 @@
+from pathlib import Path
+import torch
+from fastmri.fftc import fftshift, ifftshift
+
+
+class CenteredDFT(torch.autograd.Function):
+    """
+    Orthonormal 1D DFT along one spatial dim of a (..., 2) real/imag tensor.
+    Exports to the ONNX DFT op, whose complex layout is the same trailing 2.
+    """
+
+    @staticmethod
+    def forward(ctx, data, dim, inverse):
+        dim = dim % data.dim()
+        fft = torch.fft.ifft if inverse else torch.fft.fft
+        return torch.view_as_real(fft(torch.view_as_complex(data.contiguous()), dim=dim, norm="ortho"))
+
+    @staticmethod
+    def symbolic(g, data, dim, inverse):
+        # ORT only accepts a non-negative axis
+        dim = dim % data.type().dim()
+        output = g.op("DFT", data, axis_i=dim, inverse_i=int(inverse))
+        # ONNX DFT is unnormalised forward and 1/n inverse, rescale to ortho
+        length = g.op("Gather", g.op("Shape", data), g.op("Constant", value_t=torch.tensor(dim)), axis_i=0)
+        sqrt_length = g.op("Sqrt", g.op("Cast", length, to_i=1))  # to float
+        return g.op("Mul" if inverse else "Div", output, sqrt_length)
+
+
+def fft2c_dft(data):
+    data = ifftshift(data, dim=[-3, -2])
+    data = CenteredDFT.apply(CenteredDFT.apply(data, -3, False), -2, False)
+    return fftshift(data, dim=[-3, -2])
+
+
+def ifft2c_dft(data):
+    data = ifftshift(data, dim=[-3, -2])
+    data = CenteredDFT.apply(CenteredDFT.apply(data, -3, True), -2, True)
+    return fftshift(data, dim=[-3, -2])
+
+
+def onnx_path(onnx_dir, name, shape):
+    """ONNX file of checkpoint `name` exported for one (coils, H, W) geometry."""
+    return Path(onnx_dir) / f'{name}_{"x".join(map(str, shape))}.onnx'
+
+
+def export_onnx(model, kspace, mask, path, opset=17):
+    """Exports model(kspace, mask) with static shapes to path."""
+    if model.sens_net.acs_crop:
+        raise ValueError("sens_acs_crop picks the ACS width per batch and cannot be exported")
+    model.eval()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (kspace, mask),
+            str(path),
+            input_names=['kspace', 'mask'],
+            output_names=['reconstruction'],
+            opset_version=opset,
+        )
@@ -0,0 +1,164 @@
+"""
+Structured channel pruning of the FIVarNet regularisers.
+
+Every Unet2d / Unet is described as a list of ConvSpecs: the channel group
+a conv writes and the groups its input is concatenated from. A group is one
+activation tensor, so keeping the same channels in all of its producers and
+consumers keeps the network consistent. Group widths are multiples of
+unet_chans / sens_chans, pruning all of them by the same ratio gives a state
+dict that FIVarNet_n_att loads with the smaller config.
+"""
+from typing import Dict, List, NamedTuple, Optional
+
+import torch
+from torch import Tensor
+
+from utils.model.feature_varnet import FIVarNet_n_att, NormUnet, SeparableConvBlock, Unet2d
+
+
+class ConvSpec(NamedTuple):
+    key: str
+    transpose: bool
+    # None for channels that are not pruned (regulariser input / output)
+    out_group: Optional[str]
+    in_groups: List[Optional[str]]
+
+
+def unet2d_specs(prefix: str, num_pool_layers: int) -> List[ConvSpec]:
+    specs = []
+    path, in_group = prefix + 'layer.', None
+    for level in range(num_pool_layers + 1):
+        group = f'{prefix}level{level}'
+        specs.append(ConvSpec(path + 'left_block.layers.0.weight', False, group + '.left_mid', [in_group]))
+        specs.append(ConvSpec(path + 'left_block.layers.4.weight', False, group + '.left', [group + '.left_mid']))
+        path, in_group = path + 'child.', group + '.left'
+
+    # the innermost level has no right block, its left block output goes up
+    out_group = in_group
+    for level in reversed(range(num_pool_layers)):
+        path = prefix + 'layer.' + 'child.' * level
+        group = f'{prefix}level{level}'
+        specs.append(ConvSpec(path + 'upsample.layers.0.weight', True, group + '.up', [out_group]))
+        specs.append(ConvSpec(path + 'right_block.layers.0.weight', False, group + '.right_mid', [group + '.left', group + '.up']))
+        specs.append(ConvSpec(path + 'right_block.layers.4.weight', False, group + '.right', [group + '.right_mid']))
+        out_group = group + '.right'
+    specs.append(ConvSpec(prefix + 'final_conv.0.weight', False, None, [out_group]))
+    return specs
+
+
+def unet_specs(prefix: str, num_pool_layers: int) -> List[ConvSpec]:
+    specs = []
+    in_group = None
+    for level in range(num_pool_layers):
+        path, group = f'{prefix}down_sample_layers.{level}.layers.', f'{prefix}down{level}'
+        specs.append(ConvSpec(path + '0.weight', False, group + '.mid', [in_group]))
+        specs.append(ConvSpec(path + '4.weight', False, group, [group + '.mid']))
+        in_group = group
+    specs.append(ConvSpec(prefix + 'conv.layers.0.weight', False, prefix + 'bottom.mid', [in_group]))
+    specs.append(ConvSpec(prefix + 'conv.layers.4.weight', False, prefix + 'bottom', [prefix + 'bottom.mid']))
+
+    out_group = prefix + 'bottom'
+    for level in range(num_pool_layers):
+        group = f'{prefix}up{level}'
+        skip = f'{prefix}down{num_pool_layers - 1 - level}'
+        block = f'{prefix}up_conv.{level}.' + ('0.' if level == num_pool_layers - 1 else '')
+        specs.append(ConvSpec(f'{prefix}up_transpose_conv.{level}.layers.0.weight', True, group + '.transpose', [out_group]))
+        # forward concatenates the upsampled output before the skip connection
+        specs.append(ConvSpec(block + 'layers.0.weight', False, group + '.mid', [group + '.transpose', skip]))
+        specs.append(ConvSpec(block + 'layers.4.weight', False, group, [group + '.mid']))
+        out_group = group
+    specs.append(ConvSpec(f'{prefix}up_conv.{num_pool_layers - 1}.1.weight', False, None, [out_group]))
+    return specs
+
+
+def regulariser_specs(model: FIVarNet_n_att) -> Dict[str, List[ConvSpec]]:
+    """ConvSpecs of every Unet2d / NormUnet by module name."""
+    specs = {}
+    for name, module in model.named_modules():
+        if isinstance(module, SeparableConvBlock):
+            raise ValueError('Pruning of depthwise-separable blocks is not supported')
+        if isinstance(module, Unet2d):
+            specs[name] = unet2d_specs(name + '.', module.factor.bit_length() - 1)
+        elif isinstance(module, NormUnet):
+            specs[name] = unet_specs(name + '.unet.', module.unet.num_pool_layers)
+    return specs
+
+
+def _dims(spec: ConvSpec):
+    # (output dim, input dim) of the weight
+    return (1, 0) if spec.transpose else (0, 1)
+
+
+def group_widths(state_dict: Dict[str, Tensor], specs: List[ConvSpec]) -> Dict[str, int]:
+    return {spec.out_group: state_dict[spec.key].shape[_dims(spec)[0]] for spec in specs if spec.out_group is not None}
+
+
+def channel_importance(state_dict: Dict[str, Tensor], specs: List[ConvSpec]) -> Dict[str, Tensor]:
+    """
+    Importance of every channel of every group: the L1 norm of the weights that
+    read it, summed over its consumers after dividing each by its mean. Every
+    group is instance normalised, so the weights that write a channel say
+    nothing about its scale, the ones that read it do.
+    """
+    widths = group_widths(state_dict, specs)
+    importance = {group: torch.zeros(width) for group, width in widths.items()}
+    for spec in specs:
+        weight = state_dict[spec.key].detach().float().abs()
+        out_dim, in_dim = _dims(spec)
+        per_input = weight.sum(dim=[d for d in range(weight.dim()) if d != in_dim])
+        per_input = per_input / per_input.mean().clamp_min(1e-12)
+        offset = 0
+        for group in spec.in_groups:
+            width = widths[group] if group is not None else per_input.shape[0]
+            if group is not None:
+                importance[group] += per_input[offset : offset + width]
+            offset += width
+    return importance
+
+
+def select_channels(importance: Dict[str, Tensor], ratio: float) -> Dict[str, Tensor]:
+    """The round(width * ratio) most important channels of every group, in their original order."""
+    keep = {}
+    for group, scores in importance.items():
+        num_keep = max(1, round(scores.shape[0] * ratio))
+        keep[group] = scores.topk(num_keep).indices.sort().values
+    return keep
+
+
+def prune_state_dict(state_dict: Dict[str, Tensor], specs: List[ConvSpec], keep: Dict[str, Tensor]) -> Dict[str, Tensor]:
+    """Copy of state_dict with the conv weights of specs cut down to the kept channels."""
+    widths = group_widths(state_dict, specs)
+    pruned = dict(state_dict)
+    for spec in specs:
+        weight = state_dict[spec.key]
+        out_dim, in_dim = _dims(spec)
+        if spec.out_group is not None:
+            weight = weight.index_select(out_dim, keep[spec.out_group])
+            bias_key = spec.key[: -len('weight')] + 'bias'
+            if bias_key in state_dict:
+                pruned[bias_key] = state_dict[bias_key].index_select(0, keep[spec.out_group])
+
+        indices, offset = [], 0
+        for group in spec.in_groups:
+            width = widths[group] if group is not None else weight.shape[in_dim]
+            indices.append(keep[group] + offset if group is not None else torch.arange(offset, offset + width))
+            offset += width
+        pruned[spec.key] = weight.index_select(in_dim, torch.cat(indices)).clone()
+    return pruned
+
+
+def prune_model(model: FIVarNet_n_att, unet_chans: int, sens_chans: int, unet_chans_old: int, sens_chans_old: int) -> Dict[str, Tensor]:
+    """
+    State dict of model with the cascade U-Nets pruned from unet_chans_old to
+    unet_chans and the sensitivity U-Net from sens_chans_old to sens_chans.
+    It loads into FIVarNet_n_att(unet_chans=unet_chans, sens_chans=sens_chans).
+    """
+    state_dict = model.state_dict()
+    for name, specs in regulariser_specs(model).items():
+        if name.startswith('sens_net.'):
+            ratio = sens_chans / sens_chans_old
+        else:
+            ratio = unet_chans / unet_chans_old
+        keep = select_channels(channel_importance(state_dict, specs), ratio)
+        state_dict = prune_state_dict(state_dict, specs, keep)
+    return state_dict
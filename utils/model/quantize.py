@@ -0,0 +1,113 @@
+import copy
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from utils.model.feature_varnet import (
+    ChannelsLastInstanceNorm2d,
+    ConvBlock,
+    SeparableConvBlock,
+    TransposeConvBlock,
+    Unet,
+    Unet2d,
+    FeatureEncoder,
+    FeatureDecoder,
+    FeatureVarNetBlock,
+)
+
+# the x86 engine in torch 2.x returns wrong results for quantised ConvTranspose2d,
+# fbgemm runs the same conv kernels without that path
+QUANT_ENGINE = 'fbgemm' if 'fbgemm' in torch.backends.quantized.supported_engines else 'qnnpack'
+
+
+def quant_targets(model):
+    """
+    (parent, attribute name) of every conv stack that runs in INT8.
+
+    Only the leaf stacks are quantised: the U-Nets branch on the input shape and
+    cannot be FX-traced as a whole, and keeping the boundaries here leaves the
+    FFTs, data consistency and normalisation in fp32. The sensitivity map
+    U-Net is skipped, its maps stay fp32 as well.
+    """
+    sens_modules = {id(module) for module in model.sens_net.modules()}
+    targets = []
+    for module in model.modules():
+        if id(module) in sens_modules:
+            continue
+        if isinstance(module, (ConvBlock, SeparableConvBlock, TransposeConvBlock)):
+            targets.append((module, 'layers'))
+        elif isinstance(module, Unet):
+            # up_conv[-1] = Sequential(ConvBlock, 1x1 Conv2d)
+            targets.append((module.up_conv[-1], '1'))
+        elif isinstance(module, Unet2d):
+            targets.append((module, 'final_conv'))
+        elif isinstance(module, FeatureEncoder):
+            targets.append((module, 'encoder'))
+        elif isinstance(module, FeatureDecoder):
+            targets.append((module, 'decoder'))
+        elif isinstance(module, FeatureVarNetBlock) and module.use_image_conv:
+            targets.append((module, 'output_conv'))
+    return targets
+
+
+def _in_chans(module):
+    conv = next(m for m in module.modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)))
+    return conv.in_channels
+
+
+def prepare_int8(model, engine=QUANT_ENGINE):
+    """
+    Returns a copy of the fp32 model with observers inserted in every quant_targets
+    stack. Run it on calibration data, then pass it to convert_int8.
+    """
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).cpu().eval()
+    # instance norms inside the quantised stacks run in fp32 between dequantize/quantize
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    for norm in (nn.InstanceNorm2d, ChannelsLastInstanceNorm2d):
+        qconfig_mapping.set_object_type(norm, None)
+    for parent, name in quant_targets(model):
+        module = getattr(parent, name)
+        if not isinstance(module, nn.Sequential):
+            module = nn.Sequential(module)
+        example_inputs = (torch.randn(1, _in_chans(module), 32, 32),)
+        setattr(parent, name, prepare_fx(module, qconfig_mapping, example_inputs))
+    return model
+
+
+def convert_int8(model):
+    """Replaces the calibrated observer stacks of prepare_int8 with INT8 kernels, in place."""
+    for parent, name in quant_targets(model):
+        setattr(parent, name, convert_fx(getattr(parent, name)))
+    return model
+
+
+def calibrate(model, data_loader, num_slices):
+    """Runs the prepared model over num_slices training slices to collect activation ranges."""
+    seen = 0
+    with torch.no_grad():
+        for mask, kspace, _, _, _, _ in data_loader:
+            if seen >= num_slices:
+                break
+            model(kspace, mask)
+            seen += kspace.shape[0]
+    return seen
+
+
+def save_int8(model, path):
+    torch.save({'model': model.state_dict(), 'engine': QUANT_ENGINE}, path)
+
+
+def load_int8(model, path):
+    """Rebuilds the INT8 layout on an fp32 FIVarNet and loads the calibrated weights and scales into it."""
+    checkpoint = torch.load(path, map_location='cpu')
+    model = convert_int8(prepare_int8(model, checkpoint['engine']))
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+    return model
+
+
+def int8_path(path):
+    """model24_acc45.pt -> model24_acc45_int8.pt"""
+    return path.with_name(f'{path.stem}_int8{path.suffix}')
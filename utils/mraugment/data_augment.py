@@ -4,6 +4,7 @@ For example usage on the fastMRI and Stanford MRI datasets check out the scripts
 in mraugment_examples.
 """
 import numpy as np
+import time
 from math import exp
 import torch
 import torchvision.transforms.functional as TF
@@ -17,7 +18,7 @@ class AugmentationPipeline:
     augmentation probabilities including generating random parameters for 
     each augmentation.
     """
-    def __init__(self, hparams):
+    def __init__(self, hparams, seed=None):
         self.hparams = hparams
         self.weight_dict ={
                       'translation': hparams.aug_weight_translation,
@@ -33,7 +34,8 @@ class AugmentationPipeline:
         self.upsample_order = hparams.aug_upsample_order
         self.transform_order = hparams.aug_interpolation_order
         self.augmentation_strength = 0.0
-        self.rng = np.random.RandomState()
+        # seeded per rank in distributed training, so ranks draw different augmentations
+        self.rng = np.random.RandomState(seed)
 
     def augment_image(self, im, max_output_size=None):
         # Trailing dims must be image height and width (for torchvision) 
@@ -216,18 +218,22 @@ class DataAugmentor:
     to the training data.
     """
         
-    def __init__(self, hparams, current_epoch_func):
+    def __init__(self, hparams, current_epoch_func, seed=None):
         """
         hparams: refer to the arguments below in add_augmentation_specific_args
         current_epoch_fn: this function has to return the current epoch as an integer 
         and is used to schedule the augmentation probability.
+        seed: seed of the augmentation parameters, drawn from the OS if None
         """
         self.current_epoch_func = current_epoch_func
         self.hparams = hparams
         self.aug_on = hparams.aug_on
         if self.aug_on:
-            self.augmentation_pipeline = AugmentationPipeline(hparams)
+            self.augmentation_pipeline = AugmentationPipeline(hparams, seed)
         self.max_train_resolution = hparams.max_train_resolution
+        # shared multiprocessing.Value the seconds spent here are added to,
+        # set by the training telemetry so DataLoader workers can report them
+        self.timer = None
         
     def __call__(self, kspace, target_size):
         """
@@ -236,6 +242,7 @@ class DataAugmentor:
             where last dim is for real/imaginary channels
         target_size: [H, W] shape of the generated augmented target
         """
+        start = time.perf_counter()
         # Set augmentation probability
         if self.aug_on:
             p = self.schedule_p()
@@ -257,6 +264,9 @@ class DataAugmentor:
                     kspace = fft2c(im)
             target=None
 
+        if self.timer is not None:
+            with self.timer.get_lock():
+                self.timer.value += time.perf_counter() - start
         return kspace, target
         
     def schedule_p(self):